@@ -0,0 +1,226 @@
+import os
+import json
+import asyncio
+import logging
+from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import database as db
+import search_match as sm
+import server
+import metrics
+
+as_logger = logging.getLogger('freezam.async_server')
+
+MAX_SNIPPET_BYTES = 64*1024*1024  # larger bodies are refused with 413
+
+
+class TitleBatcher:
+    """ Read the titles of many identify requests with one query: the
+    requests asking for titles while a query is running wait for the next
+    one, which reads the titles of all of them with song_id = ANY(...).
+
+        batcher = TitleBatcher(executor)
+        titles = await batcher.titles(song_ids)
+    """
+
+    def __init__(self, executor, fetch=None):
+        """
+        Parameters:
+            + executor: the threads the blocking database calls run in
+            + fetch: a function of a list of song_ids returning a dict of
+            their titles, search_match.retriv_titles by default
+        """
+        self._executor = executor
+        self._fetch = fetch or sm.retriv_titles
+        self._waiting = []  # (song_ids, future) of the next query
+        self._running = False
+
+    def titles(self, song_ids):
+        """ A future of the dict from song_id to title of song_ids """
+        future = asyncio.get_running_loop().create_future()
+        if len(song_ids) == 0:
+            future.set_result({})
+            return future
+        self._waiting.append((song_ids, future))
+        if not self._running:
+            self._running = True
+            asyncio.ensure_future(self._run())
+        return future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._waiting:
+                await asyncio.sleep(0)  # let the requests of this turn join
+                waiting, self._waiting = self._waiting, []
+                song_ids = sorted(set(int(sid) for ids, _ in waiting for sid in ids))
+                try:
+                    titles = await loop.run_in_executor(self._executor, self._fetch,
+                                                        song_ids)
+                except Exception as error:
+                    for _, future in waiting:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+                for _, future in waiting:
+                    if not future.done():
+                        future.set_result(titles)
+        finally:
+            self._running = False
+
+
+class IdentifyService:
+    """ Identify snippets from a single asyncio event loop, so one process
+    keeps many requests in flight without a thread per request. Snippets
+    are fingerprinted in worker processes; the index lookup and the
+    database queries (psycopg2 blocks) run in a few threads, one per pooled
+    connection, and the titles of concurrent requests are read together.
+
+    Attributes:
+        + state (dict): the warm index, see server.warm_state
+    """
+
+    def __init__(self, window_size, shift, window_method, m, workers=None,
+                 index_dir=None, analysis_rate=None, n_shards=None,
+                 subvectors=None):
+        """
+        Parameters:
+            + see async_server.serve
+        """
+        self.analysis = (window_method, window_size, shift, m, analysis_rate)
+        self.state = server.warm_state(index_dir, n_shards, subvectors)
+        workers = workers or os.cpu_count()
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        # fork the workers now: a worker forked while a request is in flight
+        # inherits its socket, and the client would never see it closed
+        for future in [self._pool.submit(os.getpid) for _ in range(workers)]:
+            future.result()
+        self._threads = ThreadPoolExecutor(max_workers=db._settings['maxconn'])
+        self._titles = TitleBatcher(self._threads)
+
+    async def identify(self, snippet):
+        """ Identify one snippet with the warm index
+
+        Parameter:
+            + snippet (bytes): the content of the snippet file
+
+        Return:
+            + A ranked list of (song_id, title, window_center, score)
+        """
+        loop = asyncio.get_running_loop()
+        (fingerprint2, t), recorded = await loop.run_in_executor(
+            self._pool, metrics.run_collected, server.analyze_snippet, snippet,
+            *self.analysis)
+        metrics.merge(recorded)
+        voted = await loop.run_in_executor(self._threads, server.vote, self.state,
+                                           fingerprint2, t)
+        titles = await self._titles.titles([song[0] for song in voted])
+        return sm.with_titles(voted, sm.snippet_times(fingerprint2, t), titles)
+
+    async def respond(self, method, path, body):
+        """ The answer to one request, as (status, payload, content type),
+        with the same paths as server.IdentifyHandler """
+        if method == 'GET' and path == '/health':
+            return 200, {'generation': self.state['generation']}, 'application/json'
+        if method == 'GET' and path == '/metrics':
+            return (200, metrics.prometheus_text(),
+                    'text/plain; version=0.0.4; charset=utf-8')
+        if method != 'POST' or path != '/identify':
+            return 404, {'error': 'unknown path'}, 'application/json'
+        if len(body) == 0:
+            return 400, {'error': 'empty snippet'}, 'application/json'
+        try:
+            with metrics.timer('identify'):
+                results = await self.identify(body)
+        except Exception:
+            as_logger.exception("Identify failed")
+            metrics.inc('freezam_identify_requests_total', status='error')
+            return 500, {'error': 'could not identify the snippet'}, 'application/json'
+        metrics.inc('freezam_identify_requests_total', status='ok')
+        return (200, [{'song_id': sid, 'title': title, 'window_center': center,
+                       'score': score} for sid, title, center, score in results],
+                'application/json')
+
+    async def handle(self, reader, writer):
+        """ Serve one HTTP/1.1 connection: a single request, then close """
+        try:
+            try:
+                method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_SNIPPET_BYTES:
+                    status, payload, content_type = (413, {'error': 'snippet too large'},
+                                                     'application/json')
+                else:
+                    body = await reader.readexactly(length) if length > 0 else b''
+                    status, payload, content_type = await self.respond(
+                        method, urlparse(target).path, body)
+            except (ValueError, asyncio.IncompleteReadError):
+                status, payload, content_type = 400, {'error': 'bad request'}, 'application/json'
+            if content_type == 'application/json':
+                payload = json.dumps(payload)
+            body = payload.encode('utf-8')
+            writer.write(('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+                          'Connection: close\r\n\r\n' % (
+                              status, server.IdentifyHandler.responses[status][0],
+                              content_type, len(body))).encode('latin-1') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        """ Stop the worker processes and threads, and the shards """
+        self._pool.shutdown()
+        self._threads.shutdown()
+        if self.state['coordinator'] is not None:
+            self.state['coordinator'].close()
+
+
+def serve(window_size, shift, window_method, m, host='127.0.0.1', port=8765,
+          socket_path=None, workers=None, index_dir=None, analysis_rate=None,
+          n_shards=None, subvectors=None):
+
+    """ Run the identify daemon on an asyncio event loop. It answers the
+    same requests as server.serve (POST /identify, GET /health and
+    GET /metrics), one request per connection.
+
+    Parameters:
+        + the same as server.serve
+
+    Return:
+        Serve requests until interrupted
+    """
+    service = IdentifyService(window_size, shift, window_method, m, workers,
+                              index_dir, analysis_rate, n_shards, subvectors)
+
+    async def run():
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            listener = await asyncio.start_unix_server(service.handle, socket_path)
+            where = socket_path
+        else:
+            listener = await asyncio.start_server(service.handle, host, port)
+            where = '%s:%d' % (host, port)
+        as_logger.info("Serving identify requests on %s with asyncio", where)
+        print("Freezam is listening on " + where)
+        async with listener:
+            await listener.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+    return
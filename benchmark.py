@@ -0,0 +1,344 @@
+import os
+import sys
+import json
+import time
+import wave
+import shutil
+import resource
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import conversion_and_read as cr
+import index_store as ist
+import hash_index as hi
+import pq_index as pqi
+import search_match as sm
+
+# Reproducible benchmark of ingest and identify on synthetic catalogs.
+#
+#   python benchmark.py --sizes 100 1000 10000 --output bench.json
+#   python benchmark.py --sizes 100 --compare bench.json
+#
+# Every song is generated from its number and the seed (chords of sines
+# or bursts of filtered noise over a noise floor), so two runs with the same
+# arguments analyze exactly the same audio. Snippets are cut at random,
+# non integer offsets and can be mixed with white noise. --db also times
+# the database writes and the index build from the database configured for
+# Freezam (see database.py), use a scratch database for it.
+#
+# --pq 2 4 8 also compresses fingerprint2 to that many bytes per window and
+# reports the recall of the compressed search with and without re-ranking
+# next to the bytes the index keeps per window (index_bytes_per_window).
+
+STAGES = ('decode', 'spectrogram', 'fingerprint', 'hashes')
+
+
+def synth_song(number, seconds, rate, seed=0):
+    """ The mono samples of synthetic song number; half of the songs are
+    sine chords, the other half filtered noise bursts """
+    rng = np.random.RandomState([seed, number])
+    samples = 0.05*rng.randn(seconds*rate)  # the noise floor
+    start = 0
+    while start < len(samples):
+        length = int(rate*rng.uniform(0.25, 1.0))
+        t = np.arange(min(length, len(samples) - start))/rate
+        if number % 2 == 0:
+            note = sum(np.sin(2*np.pi*f*t + rng.uniform(0, 2*np.pi))
+                       for f in rng.uniform(80, 4000, 3))
+        else:
+            # noise through a random band, a rough percussive texture
+            burst = np.fft.rfft(rng.randn(len(t)))
+            freqs = np.fft.rfftfreq(len(t), 1/rate)
+            low = rng.uniform(50, 3000)
+            burst[(freqs < low) | (freqs > 2*low)] = 0
+            note = np.fft.irfft(burst, len(t))
+            note *= 3/max(np.abs(note).max(), 1e-9)
+        samples[start:start + len(t)] += note
+        start += length
+    return samples
+
+def _write_wav(path, samples, rate):
+    pcm = np.clip(samples/np.abs(samples).max()*20000, -32768, 32767).astype('<i2')
+    with wave.open(path, 'wb') as fh:
+        fh.setnchannels(1)
+        fh.setsampwidth(2)
+        fh.setframerate(rate)
+        fh.writeframes(pcm.tobytes())
+
+def analyze_song(number, config, work_dir):
+    """ Generate, store and fingerprint one song, timing every stage
+
+    Returns:
+        + number, fingerprint1, fingerprint2, t, (hashes, offsets)
+        + timings (dict): the seconds spent in every stage
+    """
+    timings = {}
+    path = os.path.join(work_dir, 'song-%d.wav' % number)
+    _write_wav(path, synth_song(number, config['seconds'], config['rate'],
+                                config['seed']), config['rate'])
+    start = time.perf_counter()
+    rate, blocks = cr.wav_blocks(path, 60)
+    samples = np.concatenate(list(blocks))
+    timings['decode'] = time.perf_counter() - start
+    os.remove(path)
+
+    start = time.perf_counter()
+    spec, f, t = cr.win_spectrogram(samples, config['window_method'],
+                                    config['window_size'], config['shift'], rate)
+    timings['spectrogram'] = time.perf_counter() - start
+    start = time.perf_counter()
+    fingerprint1 = cr.fingerprints_1(spec, f)
+    fingerprint2 = cr.fingerprints_2(spec, config['m'], f)
+    timings['fingerprint'] = time.perf_counter() - start
+    start = time.perf_counter()
+    hashes = cr.peak_hashes(*cr.spectral_peaks(samples, rate))
+    timings['hashes'] = time.perf_counter() - start
+    return number, fingerprint1, fingerprint2, t, hashes, timings
+
+def cut_snippet(number, config, rng):
+    """ A snippet of song number at a random offset, with white noise at
+    config['snr'] dB when it is set
+
+    Returns:
+        + snippet (ndarray): the samples of the snippet
+        + offset (float): where the snippet starts in the song, in seconds
+    """
+    samples = synth_song(number, config['seconds'], config['rate'], config['seed'])
+    length = config['snippet_seconds']*config['rate']
+    begin = rng.randint(len(samples) - length)
+    snippet = samples[begin:begin + length]
+    if config['snr'] is not None:
+        level = np.sqrt(np.mean(snippet**2)/10**(config['snr']/10))
+        snippet = snippet + rng.normal(0, level, len(snippet))
+    return snippet, begin/config['rate']
+
+def percentiles(values):
+    """ The p50, p90 and p99 of values, in milliseconds """
+    if len(values) == 0:
+        return None
+    p50, p90, p99 = np.percentile(np.asarray(values)*1000, [50, 90, 99])
+    return {'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99}
+
+def peak_rss_mb():
+    """ The peak resident memory of this process and of its largest finished
+    child, in megabytes """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1024*1024 if sys.platform == 'darwin' else 1024
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/unit,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/unit}
+
+def _write_database(songs):
+    """ Send the catalog to the database and rebuild the index from it """
+    import dbconstruction as dbc
+    import dbmanagement as dbm
+    dbc.create_table()
+    start = time.perf_counter()
+    song_ids = {}
+    for i in range(0, len(songs), 50):
+        batch = songs[i:i + 50]
+        new_ids = dbm.add_batch([('bench-%d' % number, 'freezam-benchmark',
+                                  fingerprint1, fingerprint2, t, hashes)
+                                 for number, fingerprint1, fingerprint2, t, hashes in batch])
+        song_ids.update((new_id, song[0]) for new_id, song in zip(new_ids, batch))
+    return time.perf_counter() - start, song_ids
+
+def run_catalog(n_songs, config):
+    """ Ingest a synthetic catalog of n_songs and identify snippets of it
+
+    Return:
+        + a dict with the timings, throughputs, latencies, recall and peak
+        memory of the run
+    """
+    result = {'songs': n_songs}
+    work_dir = tempfile.mkdtemp(prefix='freezam-bench-')
+    try:
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=config['workers']) as pool:
+            songs = list(pool.map(analyze_song, range(n_songs),
+                                  [config]*n_songs, [work_dir]*n_songs,
+                                  chunksize=8))
+        result['ingest_sec'] = time.perf_counter() - start
+        result['ingest_songs_per_sec'] = n_songs/result['ingest_sec']
+        result['stages_sec_per_song'] = {stage: float(np.mean([song[5][stage]
+                                                               for song in songs]))
+                                         for stage in STAGES}
+        songs = [song[:5] for song in songs]
+
+        # the song numbers double as song ids, unless they come from the database
+        labels = {song[0]: song[0] for song in songs}
+        index_dir = os.path.join(work_dir, 'index')
+        if config['db']:
+            result['db_write_sec'], labels = _write_database(songs)
+            start = time.perf_counter()
+            artifact = ist.build(index_dir)
+            hash_index = hi.build(index_dir)
+        else:
+            start = time.perf_counter()
+            ist.write(index_dir, 1,
+                      np.repeat([song[0] for song in songs], [len(song[3]) for song in songs]),
+                      np.rint(np.concatenate([song[3] for song in songs])),
+                      np.concatenate([song[1] for song in songs]),
+                      np.concatenate([song[2] for song in songs]))
+            artifact = ist.load(index_dir)
+            hi.write(hi.hash_dir(index_dir), (1, n_songs),
+                     np.concatenate([song[4][0] for song in songs]),
+                     np.repeat([song[0] for song in songs], [len(song[4][0]) for song in songs]),
+                     np.concatenate([song[4][1] for song in songs]))
+            hash_index = hi.load(index_dir)
+        result['index_build_sec'] = time.perf_counter() - start
+        start = time.perf_counter()
+        ist.kd_tree(artifact)
+        query_obj = sm.lsh_table(artifact).construct_query_object()
+        result['search_setup_sec'] = time.perf_counter() - start
+        del songs
+
+        # the LSH tables come on top of the float32 fingerprint2
+        result['index_bytes_per_window'] = {'lsh': artifact.fingerprint2.itemsize *
+                                            artifact.fingerprint2.shape[1]}
+        result['pq_build_sec'] = {}
+        compressed = {}
+        for subvectors in config['pq']:
+            start = time.perf_counter()
+            codebooks = pqi.train(artifact.fingerprint2, subvectors)
+            pq = pqi.PQIndex(None, {'segment': artifact.meta['segment']},
+                             {'codebooks': codebooks,
+                              'codes': pqi.encode(codebooks, artifact.fingerprint2)})
+            result['pq_build_sec']['pq%d' % subvectors] = time.perf_counter() - start
+            # plus the codebooks, 8 KB whatever the size of the catalog
+            result['index_bytes_per_window']['pq%d' % subvectors] = pq.codes.shape[1]
+            compressed['pq%d' % subvectors] = pq
+
+        rng = np.random.RandomState(config['seed'])
+        latencies = {mode: [] for mode in ['rough', 'slow', 'lsh', 'hash'] +
+                     [name + suffix for name in compressed for suffix in ('', '-rerank')]}
+        hits = dict.fromkeys(latencies, 0)
+        analysis, hashing = [], []
+        numbers = rng.randint(n_songs, size=config['snippets'])
+        for number in numbers:
+            snippet, _ = cut_snippet(number, config, rng)
+            start = time.perf_counter()
+            spec, f, t = cr.win_spectrogram(snippet, config['window_method'],
+                                            config['window_size'], config['shift'],
+                                            config['rate'])
+            fingerprint1 = cr.fingerprints_1(spec, f)
+            fingerprint2 = cr.fingerprints_2(spec, config['m'], f)
+            analysis.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            matched = sm.rough_match_ids(artifact, fingerprint1)
+            latencies['rough'].append(time.perf_counter() - start)
+            hits['rough'] += number in [labels.get(sid) for sid in matched]
+
+            # the slow search takes one window, like identify --search 2
+            start = time.perf_counter()
+            predicted = sm.knn_predict(artifact, fingerprint2[0], 3)
+            latencies['slow'].append(time.perf_counter() - start)
+            hits['slow'] += labels.get(predicted) == number
+
+            start = time.perf_counter()
+            voted = sm.lsh_vote(query_obj, artifact.centroid, fingerprint2, t,
+                                artifact=artifact)
+            latencies['lsh'].append(time.perf_counter() - start)
+            hits['lsh'] += len(voted) > 0 and labels.get(voted[0][0]) == number
+
+            for name, pq in compressed.items():
+                for suffix, rerank in (('', False), ('-rerank', True)):
+                    start = time.perf_counter()
+                    voted = sm.pq_vote(artifact, pq, fingerprint2, t, rerank=rerank)
+                    latencies[name + suffix].append(time.perf_counter() - start)
+                    hits[name + suffix] += (len(voted) > 0 and
+                                            labels.get(voted[0][0]) == number)
+
+            start = time.perf_counter()
+            hashes, offsets = cr.peak_hashes(*cr.spectral_peaks(snippet, config['rate']))
+            hashing.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            voted = hi.lookup(hash_index, hashes, offsets)
+            latencies['hash'].append(time.perf_counter() - start)
+            hits['hash'] += len(voted) > 0 and labels.get(voted[0][0]) == number
+
+        result['snippet_analysis'] = percentiles(analysis)
+        result['snippet_hashing'] = percentiles(hashing)
+        result['query'] = {mode: dict(percentiles(latencies[mode]) or {},
+                                      queries_per_sec=len(latencies[mode]) /
+                                      max(sum(latencies[mode]), 1e-9),
+                                      recall=float(hits[mode])/max(len(numbers), 1))
+                           for mode in latencies}
+        result['peak_rss_mb'] = peak_rss_mb()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(current, previous):
+    """ Print how every number of the current run moved since a saved run
+    of the same catalog sizes """
+    old_runs = {run['songs']: run for run in previous['runs']}
+    for run in current['runs']:
+        old = old_runs.get(run['songs'])
+        if old is None:
+            continue
+        print("%d songs, %s -> %s" % (run['songs'], previous.get('commit'),
+                                      current.get('commit')))
+        for key in ('ingest_songs_per_sec', 'index_build_sec', 'search_setup_sec'):
+            print("  %-22s %10.3f -> %10.3f" % (key, old[key], run[key]))
+        for mode in run['query']:
+            if mode not in old['query']:
+                continue
+            new_q, old_q = run['query'][mode], old['query'][mode]
+            print("  %-6s p50 %8.2f -> %8.2f ms   recall %.3f -> %.3f" % (
+                  mode, old_q.get('p50_ms', 0), new_q.get('p50_ms', 0),
+                  old_q['recall'], new_q['recall']))
+
+def main():
+    parser = argparse.ArgumentParser(description="""benchmark ingest and
+                                     identify on synthetic catalogs""")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='the catalog sizes, in songs')
+    parser.add_argument('--seconds', type=int, default=30, help='the length of a song')
+    parser.add_argument('--rate', type=int, default=44100, help='the sampling rate of the songs')
+    parser.add_argument('--snippets', type=int, default=200,
+                        help='the number of snippets identified per catalog')
+    parser.add_argument('--snippet-seconds', type=int, default=15)
+    parser.add_argument('--snr', type=float, help="""mix white noise into the
+                        snippets at this signal to noise ratio in dB""")
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', action='store_true', help="""also time the
+                        database writes and build the index from the database""")
+    parser.add_argument('--pq', type=int, nargs='*', default=[2, 4, 8],
+                        help="""also search fingerprint2 compressed to these
+                        numbers of bytes per window""")
+    parser.add_argument('--output', '-o', help='save the results to this json file')
+    parser.add_argument('--compare', help='a json file saved by an earlier run')
+    args = parser.parse_args()
+
+    config = {'seconds': args.seconds, 'rate': args.rate, 'seed': args.seed,
+              'snippets': args.snippets, 'snippet_seconds': args.snippet_seconds,
+              'snr': args.snr, 'workers': args.workers, 'db': args.db,
+              'pq': args.pq,
+              'window_method': 'hanning', 'window_size': 10, 'shift': 1, 'm': 8}
+    report = {'commit': _commit(), 'config': config, 'runs': []}
+    for n_songs in args.sizes:
+        run = run_catalog(n_songs, config)
+        report['runs'].append(run)
+        print(json.dumps(run, indent=2))
+        sys.stdout.flush()
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as fh:
+            compare(report, json.load(fh))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import os
+import time
+import argparse
+import numpy as np
+from sklearn.neighbors import KDTree
+import conversion_and_read as cr
+import search_match as sm
+
+# Compare the downsampled analysis with the analysis at the rate of the
+# files: time spent per song and how often random snippets are identified.
+#
+#   python compare_analysis.py music_directory --rates 8000 11025
+
+
+def decode(file_path, analysis_rate):
+    """ The mono samples of a song and their sampling rate, decoded the same
+    way as single_analyzer does for the given analysis rate """
+    if analysis_rate is None and file_path.split('.')[-1] == 'wav':
+        sampling_rate, blocks = cr.wav_blocks(file_path, 60)
+    else:
+        sampling_rate, blocks = cr.decoder_blocks(file_path, 60,
+                                                  analysis_rate or cr.DECODE_RATE)
+    return np.concatenate(list(blocks)), sampling_rate
+
+def fingerprint(samples, sampling_rate, analysis_rate, params):
+    """ fingerprint2 and window centers of samples already in memory """
+    window_method, window_size, shift, m = params
+    nfft = cr.fft_size(window_size*analysis_rate) if analysis_rate else None
+    spec, f, t = cr.win_spectrogram(samples, window_method, window_size, shift,
+                                    sampling_rate, nfft)
+    return cr.fingerprints_2(spec, m, f), t
+
+def evaluate(files, analysis_rate, params, n_snippets, length, noise, seed):
+    """ Analyze every song at analysis_rate, then identify random snippets
+    against the resulting catalog with the exact nearest neighbours and the
+    offset vote of the LSH search
+
+    Return:
+        + seconds (float): the mean time to analyze one song
+        + accuracy (float): the share of snippets matched to the right song
+        + aligned (float): the share also matched at the right offset
+    """
+    window_method, window_size, shift, m = params
+    rng = np.random.RandomState(seed)
+    catalog, song_id, window_center, seconds = [], [], [], []
+    songs = []
+    for i, file_path in enumerate(files):
+        start = time.time()
+        _, fingerprint2, t = cr.analyze_audio(file_path, window_method,
+                                              window_size, shift, m, analysis_rate)
+        seconds.append(time.time() - start)
+        catalog.append(fingerprint2)
+        song_id.append(np.full(len(t), i))
+        window_center.append(np.rint(t))
+        songs.append(decode(file_path, analysis_rate))
+    tree = KDTree(np.concatenate(catalog))
+    song_id = np.concatenate(song_id)
+    window_center = np.concatenate(window_center)
+
+    hits = aligned = total = 0
+    for i, (samples, sampling_rate) in enumerate(songs):
+        span = len(samples) - length*sampling_rate
+        if span <= 0:
+            continue
+        for _ in range(n_snippets):
+            begin = rng.randint(span)
+            snippet = samples[begin:begin + length*sampling_rate]
+            if noise is not None:
+                # white noise at the given signal to noise ratio (dB)
+                level = np.sqrt(np.mean(snippet**2)/10**(noise/10))
+                snippet = snippet + rng.normal(0, level, len(snippet))
+            fingerprint2, t = fingerprint(snippet, sampling_rate, analysis_rate,
+                                          params)
+            _, nearest = tree.query(fingerprint2, k=1)
+            nearest = nearest[:, 0]
+            voted = sm.vote(song_id[nearest], window_center[nearest], t,
+                            len(t), top=1)
+            total += 1
+            if voted and voted[0][0] == i:
+                hits += 1
+                if abs(voted[0][1] - begin/sampling_rate) <= shift:
+                    aligned += 1
+    total = max(total, 1)
+    return np.mean(seconds), hits/total, aligned/total
+
+def main():
+    parser = argparse.ArgumentParser(description="""compare the accuracy and
+                                     speed of downsampled analysis rates""")
+    parser.add_argument('music_directory', help='the songs used as catalog')
+    parser.add_argument('--rates', type=int, nargs='+', default=[8000, 11025],
+                        help='the analysis rates compared with the full rate')
+    parser.add_argument('--snippets', type=int, default=5,
+                        help='the number of snippets cut from every song')
+    parser.add_argument('--length', type=int, default=15,
+                        help='the length of a snippet in seconds')
+    parser.add_argument('--noise', type=float, help="""add white noise to the
+                        snippets at this signal to noise ratio in dB""")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    params = ('hanning', 10, 1, 8)  # the analysis used by main.py
+    files = sorted(os.path.join(args.music_directory, name)
+                   for name in os.listdir(args.music_directory)
+                   if os.path.isfile(os.path.join(args.music_directory, name)))
+    print("%-10s %12s %10s %10s %9s" % ('rate', 'sec/song', 'accuracy',
+                                        'aligned', 'speedup'))
+    baseline = None
+    for rate in [None] + args.rates:
+        seconds, accuracy, aligned = evaluate(files, rate, params, args.snippets,
+                                              args.length, args.noise, args.seed)
+        baseline = baseline or seconds
+        print("%-10s %12.3f %10.3f %10.3f %8.1fx" % (rate or 'full', seconds,
+              accuracy, aligned, baseline/seconds))
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,68 @@
 import os
 import wave
+import functools
+import threading
+import subprocess
 import wavio
 import logging
 import numpy as np
 # import matplotlib
 # import matplotlib.pyplot as plt
 from scipy import signal
+from scipy import fftpack
+from scipy import ndimage
 from tinytag import TinyTag
 from pydub import AudioSegment
+import metrics
 
 cr_logger = logging.getLogger("freezam.conversion_and_read")
 
+DECODE_RATE = 44100  # the sampling rate compressed formats are decoded at
+
+# constellation hashes, see spectral_peaks and peak_hashes. The windows are
+# given in seconds, so a frequency bin is 5 Hz and a frame 50 ms whatever
+# the sampling rate is.
+PEAK_WINDOW = 0.2
+PEAK_HOP = 0.05
+PEAK_NEIGHBORHOOD = (31, 11)  # bins x frames a peak must dominate
+PEAK_MARGIN = 3.0             # log power above the median of the frame
+PEAKS_PER_SECOND = 20         # the strongest peaks kept in every second
+PEAK_MIN_BIN = 8              # below 40 Hz
+FAN_OUT = 5                   # targets paired with every anchor peak
+FREQ_BITS, DT_BITS = 10, 12   # bins up to 5115 Hz, pairs up to 204 s apart
+
+def fft_size(nperseg):
+    """ The FFT length used for windows of nperseg samples in the
+    downsampled analysis: the smallest size >= nperseg whose only prime
+    factors are 2, 3 and 5, the sizes the FFT is fastest for
+
+    Parameter:
+        + nperseg (int): the number of samples of a window
+
+    Return:
+        + nfft (int): the length of the FFT, zero padded beyond nperseg
+    """
+    return fftpack.next_fast_len(int(nperseg))
+
+def song_metadata(file):
+    """ Read the title and artist of a song from its tags
+
+    Parameter:
+        + file (str): the local path of the stored music
+
+    Returns:
+        + song_title (str): the title tag, or the file name without extension
+        + artist_name (str): the artist tag, or 'unknown'
+    """
+    tag = TinyTag.get(file)
+    song_title = tag.title
+    artist_name = tag.artist
+    if song_title is None:
+        song_title = os.path.basename(file).split(".")[0]
+    if artist_name is None:
+        artist_name = 'unknown'
+    return song_title, artist_name
+
 def SingleSong_conversion(file):
     """ Convert different formats of a single song to .wav format and store it
     in a different folder
@@ -26,12 +78,7 @@ def SingleSong_conversion(file):
         Or error message if invalid format of song is provided
     """
     try:
-        song_title = TinyTag.get(file).title   
-        artist_name = TinyTag.get(file).artist
-        if song_title is None:
-            song_title = os.path.basename(file).split(".")[0]
-        if artist_name is None:
-            artist_name = 'unknown'
+        song_title, artist_name = song_metadata(file)
         new_name = ''.join(file.split('.')[:-1])+'.wav'
         AudioSegment.from_file(file).export(new_name, format='wav')
         cr_logger.info("Successful Conversion! DONE!")
@@ -41,16 +88,21 @@ def SingleSong_conversion(file):
         cr_logger.error("Oops, invalid format found:"+ file)
         pass
 
-def win_spectrogram(wav_path, window_method, window_size, window_shift):
+def win_spectrogram(wav_path, window_method, window_size, window_shift,
+                    sampling_rate=None, nfft=None):
 
     """ Read .wav file and return the spectrogram of the whole song
     Parameters:
-        + wav_path (str): the local path of .wav file
+        + wav_path (str or ndarray): the local path of .wav file, or the
+        samples of the song already in memory (mono, or one column per channel)
         + window_method (str): the desired window method to generate
         the window data
         + window_size (int): the desired time length of window for chunking
         a song in time domain
         + window_shit (int): the fixed time gap between every two windows
+        + sampling_rate (int): the sampling rate of the samples, required
+        when wav_path is an ndarray
+        + nfft (int): the length of the FFT, by default the window length
 
     Return:
         + spectrogram (ndarray): the spectrogram of windowed data
@@ -58,29 +110,35 @@ def win_spectrogram(wav_path, window_method, window_size, window_shift):
         + t (ndarray): the window centers of windowed data
         + plot: the spectrogram plot of the song
     """
-    assert (os.path.splitext(wav_path)[1] == '.wav')  # must be a .wav file
-    file = wave.open(wav_path, 'rb')
-    # get the sampling rate of the music, usually 44100 hz
-    sampling_rate = file.getframerate()
-    # get the total number of samples in a song
-    nframes = file.getnframes()
-    # get te total number of channels
-    nchannels = file.getnchannels()
-    samplewidth = file.getsampwidth()
-    # get the byte datq of a song
-    data = file.readframes(nframes)
-    file.close()
-
-    # convert the byte data into ndarray
-    array = wavio._wav2array(nchannels, samplewidth, data)
-    # convert to mono channel
-    mono_data = array.sum(axis=1) / 2
+    if isinstance(wav_path, np.ndarray):
+        assert sampling_rate is not None  # samples need their sampling rate
+        mono_data = wav_path if wav_path.ndim == 1 else wav_path.sum(axis=1) / 2
+    else:
+        assert (os.path.splitext(wav_path)[1] == '.wav')  # must be a .wav file
+        with metrics.timer('decode'):
+            file = wave.open(wav_path, 'rb')
+            # get the sampling rate of the music, usually 44100 hz
+            sampling_rate = file.getframerate()
+            # get the total number of samples in a song
+            nframes = file.getnframes()
+            # get te total number of channels
+            nchannels = file.getnchannels()
+            samplewidth = file.getsampwidth()
+            # get the byte datq of a song
+            data = file.readframes(nframes)
+            file.close()
+
+            # convert the byte data into ndarray
+            array = wavio._wav2array(nchannels, samplewidth, data)
+            # convert to mono channel
+            mono_data = array.sum(axis=1) / 2
     # get the spectrogram of the whole song
-    f, t, spec = signal.spectrogram(mono_data, fs=sampling_rate,
-                                    window=window_method,
-                                    nperseg=window_size*sampling_rate,
-                                    noverlap=(window_size-window_shift)
-                                    *sampling_rate)
+    with metrics.timer('spectrogram'):
+        f, t, spec = signal.spectrogram(mono_data, fs=sampling_rate,
+                                        window=window_method,
+                                        nperseg=window_size*sampling_rate,
+                                        noverlap=(window_size-window_shift)
+                                        *sampling_rate, nfft=nfft)
     # plot the spectrogram
     # plt.pcolormesh(t, f, spec, norm = matplotlib.colors.Normalize(0,1))
     # plt.ylabel('Frequency [Hz]')
@@ -90,6 +148,265 @@ def win_spectrogram(wav_path, window_method, window_size, window_shift):
     cr_logger.info("Get spectrogram, frequency and time successfully!")
     return spec,f, t
 
+def wav_blocks(wav_path, block_seconds):
+
+    """ Read a .wav file block by block instead of all at once
+
+    Parameters:
+        + wav_path (str): the local path of .wav file
+        + block_seconds (int): the length of music read at a time
+
+    Returns:
+        + sampling_rate (int): the sampling rate of the music
+        + blocks: a generator of mono float ndarrays of block_seconds of
+        music (the last one may be shorter), in order
+    """
+    assert (os.path.splitext(wav_path)[1] == '.wav')  # must be a .wav file
+    file = wave.open(wav_path, 'rb')
+    sampling_rate = file.getframerate()
+    block_frames = block_seconds*sampling_rate
+
+    def blocks():
+        nchannels = file.getnchannels()
+        samplewidth = file.getsampwidth()
+        try:
+            while True:
+                with metrics.timer('decode'):
+                    data = file.readframes(block_frames)
+                    if not data:
+                        break
+                    array = wavio._wav2array(nchannels, samplewidth, data)
+                    # convert to mono channel, like win_spectrogram
+                    block = array.sum(axis=1) / 2
+                yield block
+        finally:
+            file.close()
+
+    return sampling_rate, blocks()
+
+def decoder_blocks(source, block_seconds, sampling_rate=DECODE_RATE):
+
+    """ Decode any format supported by ffmpeg straight into memory. ffmpeg
+    writes raw 16 bit PCM to a pipe, so no .wav file is ever written.
+
+    Parameters:
+        + source (str or bytes): the local path of the music, or the content
+        of a music file
+        + block_seconds (int): the length of music read at a time
+        + sampling_rate (int): the sampling rate the music is decoded at
+
+    Returns:
+        + sampling_rate (int): the sampling rate of the samples
+        + blocks: a generator of mono float ndarrays of block_seconds of
+        music (the last one may be shorter), in order. It raises ValueError
+        if ffmpeg cannot decode the source.
+    """
+    from_bytes = isinstance(source, (bytes, bytearray, memoryview))
+    command = [AudioSegment.converter, '-v', 'error',
+               '-i', 'pipe:0' if from_bytes else source,
+               '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '2',
+               '-ar', str(sampling_rate), 'pipe:1']
+    block_bytes = block_seconds*sampling_rate*4  # 2 channels of 2 bytes
+
+    def feed(process):
+        try:
+            process.stdin.write(source)
+            process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass  # ffmpeg stopped early, its error is reported below
+
+    def blocks():
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   stdin=subprocess.PIPE if from_bytes
+                                   else subprocess.DEVNULL)
+        if from_bytes:
+            # write from another thread so a full stdout pipe cannot block us
+            threading.Thread(target=feed, args=(process,), daemon=True).start()
+        finished = False
+        try:
+            while True:
+                # mostly the time ffmpeg takes to decode the block
+                with metrics.timer('decode'):
+                    data = process.stdout.read(block_bytes)
+                    if not data:
+                        break
+                    pcm = np.frombuffer(data[:len(data)//4*4], dtype='<i2').reshape(-1, 2)
+                    # convert to mono channel, like win_spectrogram
+                    block = pcm.sum(axis=1, dtype=np.float64) / 2
+                yield block
+            finished = True
+        finally:
+            if not finished:
+                process.kill()  # the reader gave up, do not wait for ffmpeg
+            process.stdout.close()
+            error = process.stderr.read()
+            process.wait()
+        if process.returncode != 0:
+            cr_logger.error("Oops, invalid format found")
+            raise ValueError("ffmpeg cannot decode the music: " +
+                             error.decode('utf-8', 'replace').strip())
+
+    return sampling_rate, blocks()
+
+def pcm_blocks(stream, block_seconds, sampling_rate, channels=1):
+
+    """ Read raw 16 bit little-endian PCM from an open binary stream, such
+    as stdin, a FIFO or a socket, as it arrives
+
+    Parameters:
+        + stream: a binary file object; the samples already available are
+        returned without waiting for a whole block when it has read1
+        + block_seconds (float): the most music returned at a time
+        + sampling_rate (int): the sampling rate of the PCM
+        + channels (int): the number of interleaved channels
+
+    Return:
+        A generator of mono float ndarrays, until the stream ends
+    """
+    frame_bytes = 2*channels
+    block_bytes = max(int(block_seconds*sampling_rate), 1)*frame_bytes
+    read = getattr(stream, 'read1', stream.read)
+    left = b''
+    while True:
+        data = read(block_bytes)
+        if not data:
+            break
+        data = left + data
+        usable = len(data)//frame_bytes*frame_bytes
+        left = data[usable:]
+        if usable == 0:
+            continue
+        pcm = np.frombuffer(data[:usable], dtype='<i2').reshape(-1, channels)
+        # convert to mono channel, like win_spectrogram
+        yield pcm.sum(axis=1, dtype=np.float64) / 2
+
+def stream_spectrogram(blocks, sampling_rate, window_method, window_size,
+                       window_shift, windows_per_block=8, nfft=None):
+
+    """ Compute the spectrogram of a song a few windows at a time. Only the
+    samples of the windows still to come are kept, so the memory used does
+    not grow with the length of the song. The columns are exactly the ones
+    win_spectrogram returns for the whole song.
+
+    Parameters:
+        + blocks: an iterable of mono sample ndarrays, e.g. from wav_blocks
+        + sampling_rate (int): the sampling rate of the samples
+        + window_method (str): the desired window method to generate
+        the window data
+        + window_size (int): the desired time length of window for chunking
+        a song in time domain
+        + window_shift (int): the fixed time gap between every two windows
+        + windows_per_block (int): the number of windows computed at a time
+        + nfft (int): the length of the FFT, by default the window length
+
+    Return:
+        A generator of (spectrogram, frequency, t) for consecutive groups of
+        windows, t being the window centers measured from the song start
+    """
+    nperseg = window_size*sampling_rate
+    step = window_shift*sampling_rate
+    buffer = np.zeros(0)
+    start = 0  # the sample number of buffer[0] in the song
+    produced = False
+
+    def spectrum(samples):
+        with metrics.timer('spectrogram'):
+            return signal.spectrogram(samples, fs=sampling_rate, window=window_method,
+                                      nperseg=nperseg, noverlap=nperseg-step,
+                                      nfft=nfft)
+
+    for block in blocks:
+        buffer = np.concatenate((buffer, block))
+        n_windows = (len(buffer) - nperseg)//step + 1 if len(buffer) >= nperseg else 0
+        if n_windows >= windows_per_block:
+            f, t, spec = spectrum(buffer[:nperseg + (n_windows-1)*step])
+            yield spec, f, t + start/sampling_rate
+            produced = True
+            # keep the overlap with the windows still to come
+            buffer = buffer[n_windows*step:]
+            start += n_windows*step
+    if len(buffer) >= nperseg or not produced:
+        n_windows = max((len(buffer) - nperseg)//step + 1, 1)
+        f, t, spec = spectrum(buffer[:nperseg + (n_windows-1)*step])
+        yield spec, f, t + start/sampling_rate
+
+def stream_fingerprints(source, window_method, window_size, window_shift, m,
+                        windows_per_block=8, analysis_rate=None, hashes=None):
+
+    """ Fingerprint a song incrementally with bounded memory, for long
+    files such as DJ sets or podcasts. .wav files are read directly, other
+    formats are decoded in memory by ffmpeg.
+
+    With analysis_rate the music is resampled by ffmpeg to that rate, e.g.
+    8000 or 11025 Hz, and the FFTs use a fast size (see fft_size). The
+    octave bands stay relative to the Nyquist frequency, so a catalog and
+    its snippets must be analyzed at the same rate.
+
+    Parameters:
+        + source (str or bytes): the local path of the music, or the content
+        of a music file
+        + window_method (str): Method of interest to window the data
+        + window_size (int): The desired time length of window
+        + window_shift (int): The fixed time gap between every two windows
+        + m (int): The pre-specified number of interval in each window
+        + windows_per_block (int): the number of windows computed at a time
+        + analysis_rate (int): the sampling rate the music is analyzed at,
+        by default its own rate
+        + hashes (list): when given, the constellation hashes are computed
+        in the same decoding pass and appended to it, see hashed_blocks
+
+    Return:
+        A generator of (fingerprint1, fingerprint2, t) for consecutive groups
+        of windows
+    """
+    block_seconds = windows_per_block*window_shift
+    nfft = None
+    if analysis_rate is not None:
+        sampling_rate, blocks = decoder_blocks(source, block_seconds, analysis_rate)
+        nfft = fft_size(window_size*analysis_rate)
+    elif isinstance(source, str) and source.split('.')[-1] == 'wav':
+        sampling_rate, blocks = wav_blocks(source, block_seconds)
+    else:
+        sampling_rate, blocks = decoder_blocks(source, block_seconds)
+    if hashes is not None:
+        blocks = hashed_blocks(blocks, sampling_rate, hashes)
+    for spec, f, t in stream_spectrogram(blocks, sampling_rate, window_method,
+                                         window_size, window_shift,
+                                         windows_per_block, nfft):
+        yield fingerprints_1(spec, f), fingerprints_2(spec, m, f), t
+
+def analyze_audio(source, window_method, window_size, window_shift, m,
+                  analysis_rate=None, with_hashes=False):
+
+    """ Fingerprint a whole song, from a file of any format or its content
+
+    Parameters:
+        + source (str or bytes): the local path of the music, or the content
+        of a music file
+        + window_method, window_size, window_shift, m: see single_analyzer
+        + analysis_rate (int): the sampling rate the music is analyzed at,
+        by default its own rate
+        + with_hashes (bool): also compute the constellation hashes, from
+        the same decoded samples
+
+    Returns:
+        + fingerprint1 (ndarray): The one-dimensional summary of the song
+        + fingerprint2 (ndarray): The m-dimensional summary of the song
+        + t (ndarray): The window center of the music
+        + (hashes, offsets): the constellation hashes, with with_hashes only
+    """
+    hashes = [] if with_hashes else None
+    blocks = list(stream_fingerprints(source, window_method, window_size,
+                                      window_shift, m,
+                                      analysis_rate=analysis_rate, hashes=hashes))
+    fingerprint1 = np.concatenate([block[0] for block in blocks])
+    fingerprint2 = np.concatenate([block[1] for block in blocks]) # an nxd numpy array
+    t = np.concatenate([block[2] for block in blocks])
+    if with_hashes:
+        return fingerprint1, fingerprint2, t, join_hashes(hashes)
+    return fingerprint1, fingerprint2, t
+
 def fingerprints_1(spec, f):
 
     """Calculating the one-dimensional summaries of the spectrogram of a song;
@@ -104,14 +421,40 @@ def fingerprints_1(spec, f):
         + fingerprints: A ndarray that contains the one-dimensional summaries
         of a song
     """
-    scale_parameter = f[np.argmax(f)]
-    fingerprints = f[np.argmax(spec, axis=0)]/scale_parameter
+    with metrics.timer('fingerprint1'):
+        scale_parameter = f[np.argmax(f)]
+        fingerprints = f[np.argmax(spec, axis=0)]/scale_parameter
     # plt.plot(t, fingerprints, color="crimson")
     cr_logger.info("Fingerprint 1 is successfully computed!")
     return fingerprints
 
+@functools.lru_cache(maxsize=32)
+def octave_bands(n_freqs, m):
+    """ The row boundaries of the m octave bands of a spectrogram, computed
+    once per spectrogram size. The bands are the successive octaves from
+    2^-(m+1)*f_Nyq up to f_Nyq/2, whatever the sampling rate is.
+
+    Parameters:
+        + n_freqs (int): the number of frequencies (rows) of the spectrogram
+        + m (int): the number of bands
+
+    Returns:
+        + starts (ndarray): the first row of every band
+        + ends (ndarray): the row after the last row of every band
+    """
+    # the last frequency is f_Nyq, so the index of a frequency x is
+    # x/f_Nyq*(n_freqs-1)
+    start_pt = (n_freqs - 1)//(2**(m+1))
+    starts = np.array([(2**i)*start_pt for i in range(m)])
+    ends = np.array([min((2**(i+1))*start_pt, n_freqs) for i in range(m)])
+    starts.setflags(write=False)
+    ends.setflags(write=False)
+    return starts, ends
+
 def fingerprints_2 (spec, m, f):
-    """ Calculating the m-dimensional summaries of the spectrogram of a song
+    """ Calculating the m-dimensional summaries of the spectrogram of a song.
+    Every band is a single argmax over all the windows at once; the band
+    boundaries come from the cached octave_bands.
     
     Parameter:
         + spec: A ndarray that contains the spectrogram of windowed data
@@ -122,19 +465,257 @@ def fingerprints_2 (spec, m, f):
         + fingerprints: A ndarray that contains the m-dimensional summaries
         of a song
     """
-    f_nyq = 44100//2  # 44100 is the sampling frequency of a song
-    start_pt = int((f_nyq/(2**(m+1)))*10) # frequency is the ten times of the index
-    pecks_full = []
-    for i in range(m):
-        start = (2**i)*start_pt
-        end = min((2**(i+1))*start_pt,len(spec))
-        local_fingerprints = fingerprints_1(spec[start:end], f[start:end])
-        pecks_full.append(local_fingerprints)
-    
+    with metrics.timer('fingerprint2'):
+        starts, ends = octave_bands(len(f), m)
+        fingerprints = np.empty((spec.shape[1], m))
+        for i in range(m):
+            # the first peak of the band in every window, scaled by the highest
+            # frequency of the band
+            peak = np.argmax(spec[starts[i]:ends[i]], axis=0)
+            fingerprints[:, i] = f[starts[i] + peak] / f[ends[i] - 1]
+    metrics.inc('freezam_windows_fingerprinted_total', spec.shape[1])
+
     cr_logger.info("Fingerprint 2 is successfully computed!")
-    return np.array(pecks_full).T
+    return fingerprints
+
+def spectral_peaks(samples, sampling_rate):
+    """ The constellation of a song: the points of a short window
+    spectrogram that are the loudest of their neighbourhood, thinned to the
+    strongest PEAKS_PER_SECOND of every second.
+
+    Parameters:
+        + samples (ndarray): the mono samples of the song
+        + sampling_rate (int): the sampling rate of the samples
+
+    Returns:
+        + freq_bin (ndarray): the frequency of every peak, in bins of
+        1/PEAK_WINDOW Hz
+        + frame (ndarray): the time of every peak, in frames of PEAK_HOP
+        seconds; the peaks are sorted by frame, then frequency
+    """
+    nperseg = int(round(PEAK_WINDOW*sampling_rate))
+    empty = np.zeros(0, dtype=np.int64)
+    if len(samples) < nperseg:
+        return empty, empty
+    power = _peak_power(samples, sampling_rate)
+    return _pick_peaks(power, 0, 0, power.shape[1])
+
+def _peak_power(samples, sampling_rate):
+    """ The log power of the short window spectrogram of the samples, one
+    column per frame, over the frequencies a hash can hold """
+    nperseg = int(round(PEAK_WINDOW*sampling_rate))
+    step = int(round(PEAK_HOP*sampling_rate))
+    with metrics.timer('spectrogram'):
+        _, _, spec = signal.spectrogram(samples, fs=sampling_rate, window='hann',
+                                        nperseg=nperseg, noverlap=nperseg-step)
+    return np.log(spec[:2**FREQ_BITS] + 1e-10)
+
+def _pick_peaks(power, first, begin, end):
+    """ The peaks of the frames begin..end-1 of power, whose first column
+    is the frame first of the song. Frames outside power count as silence,
+    so the frames within half a neighbourhood of the edges of power are only
+    exact at the true start and end of the song. begin and end are whole
+    seconds, every second being thinned on its own. """
+    with metrics.timer('peaks'):
+        local_max = ndimage.maximum_filter(power, size=PEAK_NEIGHBORHOOD,
+                                           mode='constant', cval=-np.inf) == power
+        loud = power > np.median(power, axis=0) + PEAK_MARGIN
+        local_max[:PEAK_MIN_BIN] = False
+        local_max[:, :begin - first] = False
+        local_max[:, end - first:] = False
+        freq_bin, frame = np.nonzero(local_max & loud)
+        strength = power[freq_bin, frame]
+        frame = frame + first
+        # rank the peaks of every second by strength, keep the first ones
+        second = frame//int(round(1/PEAK_HOP))
+        order = np.lexsort((-strength, second))
+        starts = np.searchsorted(second[order], second[order], 'left')
+        keep = order[np.arange(len(order)) - starts < PEAKS_PER_SECOND]
+        keep = keep[np.lexsort((freq_bin[keep], frame[keep]))]
+    return freq_bin[keep], frame[keep]
+
+def stream_peaks(blocks, sampling_rate):
+
+    """ spectral_peaks of a stream, computed as the samples arrive. Only
+    the new frames are transformed, the samples they share with the frames
+    already computed are kept from the previous block. The peaks of a second
+    are given once the frames they are compared with are known, half a
+    neighbourhood later; together they are exactly spectral_peaks of the
+    whole stream.
+
+    Parameters:
+        + blocks: an iterable of mono sample ndarrays, of any length
+        + sampling_rate (int): the sampling rate of the samples
+
+    Return:
+        A generator of (freq_bin, frame), frames counted from the start of
+        the stream: one per block, with the peaks of the whole seconds it
+        completes (often none), then one with the peaks of the end
+    """
+    nperseg = int(round(PEAK_WINDOW*sampling_rate))
+    step = int(round(PEAK_HOP*sampling_rate))
+    per_second = int(round(1/PEAK_HOP))
+    context = PEAK_NEIGHBORHOOD[1]//2
+    buffer = np.zeros(0)
+    power = None
+    first = 0  # the frame of power[:, 0]
+    done = 0  # the peaks of the frames before this one were given
+    empty = np.zeros(0, dtype=np.int64)
+    for block in blocks:
+        buffer = np.concatenate((buffer, block))
+        if len(buffer) < nperseg:
+            yield empty, empty
+            continue
+        n_frames = (len(buffer) - nperseg)//step + 1
+        columns = _peak_power(buffer[:nperseg + (n_frames-1)*step], sampling_rate)
+        buffer = buffer[n_frames*step:]
+        power = columns if power is None else np.concatenate((power, columns), axis=1)
+        ready = (first + power.shape[1] - context)//per_second*per_second
+        if ready > done:
+            yield _pick_peaks(power, first, done, ready)
+            done = ready
+            # keep the frames the next seconds are compared with
+            power = power[:, max(done - context - first, 0):]
+            first = max(done - context, first)
+        else:
+            yield empty, empty
+    if power is not None and first + power.shape[1] > done:
+        yield _pick_peaks(power, first, done, first + power.shape[1])
+
+def stream_hashes(blocks, sampling_rate):
 
-def single_analyzer (file_path, window_method, window_size, window_shift, m):
+    """ peak_hashes of a stream: a peak is hashed as an anchor once the
+    FAN_OUT peaks that follow it are known, so the hashes are exactly the
+    ones of the whole stream
+
+    Parameters:
+        + blocks: an iterable of mono sample ndarrays, of any length
+        + sampling_rate (int): the sampling rate of the samples
+
+    Return:
+        A generator of (hashes, offsets) as given by peak_hashes: one per
+        block (often empty), then the hashes of the end of the stream
+    """
+    freq_bin = np.zeros(0, dtype=np.int64)
+    frame = np.zeros(0, dtype=np.int64)
+    for new_bins, new_frames in stream_peaks(blocks, sampling_rate):
+        freq_bin = np.concatenate((freq_bin, new_bins))
+        frame = np.concatenate((frame, new_frames))
+        anchors = max(len(frame) - FAN_OUT, 0)
+        yield peak_hashes(freq_bin, frame, anchors)
+        freq_bin, frame = freq_bin[anchors:], frame[anchors:]
+    yield peak_hashes(freq_bin, frame)
+
+def hashed_blocks(blocks, sampling_rate, found):
+
+    """ Pass the blocks of a song on while computing its constellation
+    hashes from the same samples, so a song is decoded once for its
+    fingerprints and its hashes. stream_hashes is given one block at a time
+    and answers every block, so neither side holds more than the samples
+    of the frames still to come.
+
+    Parameters:
+        + blocks: an iterable of mono sample ndarrays
+        + sampling_rate (int): the sampling rate of the samples
+        + found (list): the (hashes, offsets) of every block are appended to
+        it as the blocks go by, the ones of the end when blocks is exhausted
+
+    Return:
+        A generator of the blocks, unchanged
+    """
+    mailbox = []
+
+    def delivered():
+        while True:
+            block = mailbox.pop()
+            if block is None:
+                return
+            yield block
+
+    hashes = stream_hashes(delivered(), sampling_rate)
+    for block in blocks:
+        mailbox.append(block)
+        found.append(next(hashes))
+        yield block
+    mailbox.append(None)  # ends the blocks of stream_hashes
+    found.extend(hashes)
+
+def peak_hashes(freq_bin, frame, anchors=None):
+    """ Pair every peak (the anchor) with the next FAN_OUT peaks and pack
+    the two frequencies and their time difference into a 32 bit hash. The
+    hash does not depend on where the song starts, the anchor frame gives
+    the offset.
+
+    Parameters:
+        + freq_bin, frame: the peaks given by spectral_peaks
+        + anchors (int): only hash the first anchors peaks as anchors, the
+        others are only targets; all of them by default
+
+    Returns:
+        + hashes (ndarray): uint32 hashes, freq_bin of the anchor in the
+        high FREQ_BITS bits, then freq_bin of the target, then the frames
+        between them
+        + offsets (ndarray): the frame of the anchor of every hash
+    """
+    hashes, offsets = [], []
+    anchors = len(frame) if anchors is None else anchors
+    for shift in range(1, FAN_OUT + 1):
+        anchor = np.arange(min(len(frame) - shift, anchors))
+        target = anchor + shift
+        dt = frame[target] - frame[anchor]
+        paired = (dt > 0) & (dt < 2**DT_BITS)
+        anchor, target, dt = anchor[paired], target[paired], dt[paired]
+        hashes.append((freq_bin[anchor].astype(np.uint32) << (FREQ_BITS + DT_BITS)) |
+                      (freq_bin[target].astype(np.uint32) << DT_BITS) |
+                      dt.astype(np.uint32))
+        offsets.append(frame[anchor])
+    if not hashes:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.int32)
+    return (np.concatenate(hashes).astype(np.uint32),
+            np.concatenate(offsets).astype(np.int32))
+
+def constellation(source, analysis_rate=None):
+
+    """ The constellation hashes of a song, the third kind of fingerprint.
+    Unlike fingerprint1 and fingerprint2 they do not depend on the 1 s window
+    grid: a snippet cut anywhere gives the same hashes as the song, at
+    offsets shifted by the start of the snippet.
+
+    Parameters:
+        + source (str or bytes): the local path of the music, or the content
+        of a music file
+        + analysis_rate (int): the sampling rate the music is analyzed at,
+        by default its own rate; the frequency bins stay the same
+
+    Returns:
+        + hashes (ndarray): the uint32 hashes of the song, see peak_hashes
+        + offsets (ndarray): the frame of every hash, in PEAK_HOP seconds
+    """
+    if analysis_rate is None and isinstance(source, str) and source.split('.')[-1] == 'wav':
+        sampling_rate, blocks = wav_blocks(source, 60)
+    else:
+        sampling_rate, blocks = decoder_blocks(source, 60, analysis_rate or DECODE_RATE)
+    hashes, offsets = join_hashes(stream_hashes(blocks, sampling_rate))
+    cr_logger.info("Constellation hashes are successfully computed!")
+    return hashes, offsets
+
+def join_hashes(parts):
+    """ Concatenate the (hashes, offsets) of the parts of a song """
+    parts = list(parts)
+    if not parts:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.int32)
+    return (np.concatenate([part[0] for part in parts]),
+            np.concatenate([part[1] for part in parts]))
+
+def song_name(file_path):
+    """ The title and artist of a song: the file name for .wav files, which
+    have no tags, and the tags otherwise (see song_metadata) """
+    if file_path.split('.')[-1] == 'wav':
+        return file_path.split('/')[-1].split('.')[0], 'unknown'
+    return song_metadata(file_path)
+
+def single_analyzer (file_path, window_method, window_size, window_shift, m,
+                     stream=True, analysis_rate=None, with_hashes=False):
     
     """The aggregate function to analyze a song. It calculates two different
     dimensional summarise of a single song. Fingerprint2 is more accurate than
@@ -151,6 +732,13 @@ def single_analyzer (file_path, window_method, window_size, window_shift, m):
         + window_shift (int): The fixed time gap between every two windows
         + m (int): The pre-specified number of interval in each window
                  The required parameter for calculating fingerprint2
+        + stream (bool): Compute the spectrogram a few windows at a time so
+        memory stays bounded for long files; the fingerprints are the same
+        + analysis_rate (int): resample the song to this rate before the
+        analysis, e.g. 8000 or 11025 Hz, which makes it an order of magnitude
+        faster. None keeps the rate of the file
+        + with_hashes (bool): also compute the constellation hashes, in the
+        same decoding pass when stream is True
     
     Returns:
         + song_title (str): The metadata extracted from song itself
@@ -158,19 +746,34 @@ def single_analyzer (file_path, window_method, window_size, window_shift, m):
         + fingerprint1 (ndarray): The one-dimensional summary of the entire song
         + fingerprint2 (ndarray): The m-dimensional summary of the entire song
         + t (ndarray): The window center of the music file
+        + (hashes, offsets): the constellation hashes, with with_hashes only
     """
-    if file_path.split('.')[-1] == 'wav':
-        song_title = file_path.split('/')[-1].split('.')[0]
-        artist_name = 'unknown'
-        spec,f, t = win_spectrogram(file_path, window_method, window_size, window_shift)
-    else:
-        file, song_title, artist_name = SingleSong_conversion(file_path)
-        spec,f, t = win_spectrogram(file, window_method, window_size, window_shift)
-        os.remove(file) # remove the converted file from user's current file
-        cr_logger.info("The converted wav file has been removed")
+    song_title, artist_name = song_name(file_path)
 
-    fingerprint1 = fingerprints_1(spec,f)
-    fingerprint2 = fingerprints_2(spec, m, f) # an nxd numpy array
+    if stream:
+        # other formats are decoded in memory, no .wav file is written
+        analysis = analyze_audio(file_path, window_method, window_size,
+                                 window_shift, m, analysis_rate, with_hashes)
+        fingerprint1, fingerprint2, t = analysis[:3]
+        hashes = analysis[3] if with_hashes else None
+    else:
+        nfft = None
+        if analysis_rate is not None:
+            sampling_rate, blocks = decoder_blocks(file_path, 60, analysis_rate)
+            samples = np.concatenate(list(blocks))
+            nfft = fft_size(window_size*analysis_rate)
+        elif file_path.split('.')[-1] == 'wav':
+            samples, sampling_rate = file_path, None
+        else:
+            sampling_rate, blocks = decoder_blocks(file_path, 60)
+            samples = np.concatenate(list(blocks))
+        spec,f, t = win_spectrogram(samples, window_method, window_size,
+                                    window_shift, sampling_rate, nfft)
+        fingerprint1 = fingerprints_1(spec,f)
+        fingerprint2 = fingerprints_2(spec, m, f) # an nxd numpy array
+        hashes = constellation(file_path, analysis_rate) if with_hashes else None
     
     cr_logger.info('Analyze done!')
+    if with_hashes:
+        return song_title, artist_name, fingerprint1, fingerprint2, t, hashes
     return song_title, artist_name, fingerprint1, fingerprint2, t
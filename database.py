@@ -0,0 +1,155 @@
+import os
+import hashlib
+import logging
+import threading
+import contextlib
+import psycopg2
+from psycopg2 import pool as pg_pool
+import metrics
+# numpy is imported by the functions that pack arrays, so that delete and
+# rm_duplicate start quickly
+
+db_logger = logging.getLogger('freezam.database')
+
+DEFAULT_HOST = "sculptor.stat.cmu.edu"
+BLOB_DTYPE = '<f4'  # fingerprints are stored as little-endian float32
+
+_settings = {'dsn': None, 'minconn': 1,
+             'maxconn': int(os.environ.get('FREEZAM_DB_POOL_SIZE', 8))}
+_pool = None
+_pool_pid = None
+_inherited = []  # pools copied by fork, kept so they are never closed here
+_lock = threading.Lock()
+
+def configure(dsn=None, minconn=1, maxconn=None):
+    """ Point Freezam to a database. Without it the connection string is
+    taken from the environment, see get_dsn.
+
+    Parameters:
+        + dsn (str): a libpq connection string, e.g.
+        "host=localhost dbname=freezam user=freezam"
+        + minconn (int): the number of connections opened up front
+        + maxconn (int): the largest number of connections kept by the pool
+    """
+    global _pool
+    with _lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        elif _pool is not None:
+            _inherited.append(_pool)
+        _pool = None
+        _settings['dsn'] = dsn
+        _settings['minconn'] = minconn
+        if maxconn is not None:
+            _settings['maxconn'] = maxconn
+    return
+
+def get_dsn():
+    """ The connection string of the database, in order of preference:
+        + the dsn given to configure()
+        + the FREEZAM_DSN environment variable
+        + the credentials module, on FREEZAM_DB_HOST (sculptor by default)
+    """
+    if _settings['dsn']:
+        return _settings['dsn']
+    if os.environ.get('FREEZAM_DSN'):
+        return os.environ['FREEZAM_DSN']
+    import credentials as c # database username and password
+    return psycopg2.extensions.make_dsn(
+        host=os.environ.get('FREEZAM_DB_HOST', DEFAULT_HOST),
+        dbname=c.DB_USER, user=c.DB_USER, password=c.DB_PASSWORD)
+
+def get_pool():
+    """ The connection pool shared by every module, created on first use.
+    A process forked from the owner gets a pool of its own, sockets are never
+    shared across processes.
+    """
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            if _pool is not None:
+                # closing the parent's sockets would end its sessions
+                _inherited.append(_pool)
+            _pool = pg_pool.ThreadedConnectionPool(_settings['minconn'],
+                                                   _settings['maxconn'],
+                                                   get_dsn())
+            _pool_pid = os.getpid()
+            db_logger.info("Connection pool created")
+        return _pool
+
+@contextlib.contextmanager
+def connection():
+    """ Borrow a connection from the pool for one transaction. It is
+    committed when the block ends, rolled back if it raises, and handed back
+    to the pool in both cases.
+
+        with database.connection() as conn:
+            cur = conn.cursor()
+            ...
+    """
+    db_pool = get_pool()
+    metrics.inc('freezam_db_transactions_total')
+    with metrics.timer('db_transaction'):
+        conn = db_pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            db_pool.putconn(conn, close=bool(conn.closed))
+
+@contextlib.contextmanager
+def cursor():
+    """ Same as connection() but yields a cursor directly """
+    with connection() as conn:
+        with conn.cursor() as cur:
+            yield cur
+
+def pack_array(array, dtype=BLOB_DTYPE):
+    """ Pack an array of numbers into a bytea value
+
+    Parameters:
+        + array: the numbers to store, any shape
+        + dtype: the type stored, float32 by default; hashes are stored as
+        '<u4' so no bit is lost
+
+    Return:
+        + the bytes of the array, ready to be sent as a parameter
+    """
+    import numpy as np
+    return psycopg2.Binary(np.ascontiguousarray(array, dtype=dtype).tobytes())
+
+def array_digest(array):
+    """ The sha256 of the bytes pack_array stores for array, in hex. Two
+    songs with the same fingerprints, i.e. the same audio, have the same
+    digest whatever their tags or container.
+
+    Parameter:
+        + array: the numbers to hash, any shape
+
+    Return:
+        + the hex digest (str)
+    """
+    import numpy as np
+    data = np.ascontiguousarray(array, dtype=BLOB_DTYPE).tobytes()
+    return hashlib.sha256(data).hexdigest()
+
+def unpack_array(blob, columns=None, dtype=BLOB_DTYPE):
+    """ Read a bytea value written by pack_array without copying it
+
+    Parameters:
+        + blob: the bytea value returned by psycopg2 (a memoryview)
+        + columns (int): the number of columns when the array is 2-D
+        + dtype: the type given to pack_array
+
+    Return:
+        + a read-only ndarray over the bytes of blob
+    """
+    import numpy as np
+    array = np.frombuffer(blob, dtype=dtype)
+    if columns is not None:
+        array = array.reshape(-1, columns)
+    return array
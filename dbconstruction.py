@@ -1,6 +1,6 @@
-import psycopg2
+import hashlib
 import logging
-import credentials as c
+import database as db
 
 dbc_logger = logging.getLogger('freezam.dbconstruction')
 
@@ -13,32 +13,178 @@ def create_table():
         + song_title
         + artist_name
 
-    The second table FINGERPRINTS will contain:
-        + fingerprint_id PRIMARY KEY
-        + song_id
-        + window center
+    The second table SONG_FINGERPRINTS holds one row per song, with the
+    windows of the song packed as float32 bytes:
+        + song_id PRIMARY KEY
+        + window_count
+        + dimension (m, the number of columns of fingerprint2)
+        + window_centers
         + fingerprint1
         + fingerprint2
+        + audio_digest (the sha256 of the packed fingerprint2, equal for two
+        copies of the same audio, see database.array_digest)
+
+    The third table CATALOG_STATE holds a single generation counter that is
+    increased every time the catalog changes, so an index saved on disk can
+    tell whether it is stale.
+
+    The fourth table CATALOG_CHANGES logs the songs added and deleted at
+    every generation, so a stale index can be brought up to date with the
+    changed songs only:
+        + generation
+        + song_id
+        + added (TRUE for an added song, FALSE for a deleted one)
+
+    The fifth table SONG_HASHES holds the constellation hashes of every song
+    (see conversion_and_read.constellation), packed like the fingerprints:
+        + song_id PRIMARY KEY
+        + hash_count
+        + hashes (uint32)
+        + offsets (int32 frames of the anchor peaks)
 
     """
-    conn = psycopg2.connect(host="sculptor.stat.cmu.edu", database=c.DB_USER,
-                        user=c.DB_USER, password=c.DB_PASSWORD)
-    cur = conn.cursor()
-    cur.execute(""" CREATE TABLE IF NOT EXISTS songs(song_id SERIAL PRIMARY KEY,
-                                                 song_title TEXT,
-                                                 artist_name TEXT)""")
-    conn.commit()
-    dbc_logger.info("Successfully create Table songs/Table songs is already there!")
-    cur.execute("""CREATE TABLE IF NOT EXISTS
-               fingerprints(fingerprint_id SERIAL PRIMARY KEY,
-                           song_id INTEGER REFERENCES songs(song_id) 
-                           ON DELETE CASCADE,
-                           window_center INTEGER,
-                           fingerprint1 NUMERIC,
-                           fingerprint2 NUMERIC ARRAY)""")
-    dbc_logger.info("""Successfully create Table fingerprints/
-                   Table fingerprints is already there!""")
-    conn.commit()
-    conn.close()
+    with db.cursor() as cur:
+        cur.execute(""" CREATE TABLE IF NOT EXISTS songs(song_id SERIAL PRIMARY KEY,
+                                                     song_title TEXT,
+                                                     artist_name TEXT)""")
+        dbc_logger.info("Successfully create Table songs/Table songs is already there!")
+        cur.execute("""CREATE TABLE IF NOT EXISTS
+                   song_fingerprints(song_id INTEGER PRIMARY KEY
+                                     REFERENCES songs(song_id) ON DELETE CASCADE,
+                                     window_count INTEGER NOT NULL,
+                                     dimension INTEGER NOT NULL,
+                                     window_centers BYTEA NOT NULL,
+                                     fingerprint1 BYTEA NOT NULL,
+                                     fingerprint2 BYTEA NOT NULL,
+                                     audio_digest TEXT)""")
+        dbc_logger.info("""Successfully create Table song_fingerprints/
+                       Table song_fingerprints is already there!""")
+        # tables created before audio_digest existed get it here
+        cur.execute("""ALTER TABLE song_fingerprints
+                       ADD COLUMN IF NOT EXISTS audio_digest TEXT""")
+        cur.execute("""CREATE INDEX IF NOT EXISTS song_fingerprints_audio_digest
+                       ON song_fingerprints (audio_digest)""")
+        cur.execute("""SELECT song_id, fingerprint2 FROM song_fingerprints
+                       WHERE audio_digest IS NULL""")
+        # the blob holds exactly the bytes array_digest hashes
+        missing = [(hashlib.sha256(bytes(row[1])).hexdigest(), row[0])
+                   for row in cur.fetchall()]
+        cur.executemany("""UPDATE song_fingerprints SET audio_digest = %s
+                           WHERE song_id = %s""", missing)
+        cur.execute("""CREATE TABLE IF NOT EXISTS
+                   catalog_state(id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                                 generation BIGINT NOT NULL DEFAULT 0)""")
+        cur.execute("""INSERT INTO catalog_state (id) VALUES (TRUE)
+                       ON CONFLICT (id) DO NOTHING""")
+        cur.execute("""CREATE TABLE IF NOT EXISTS
+                   catalog_changes(generation BIGINT NOT NULL,
+                                   song_id INTEGER NOT NULL,
+                                   added BOOLEAN NOT NULL)""")
+        cur.execute("""CREATE INDEX IF NOT EXISTS catalog_changes_generation
+                       ON catalog_changes (generation)""")
+        cur.execute("""CREATE TABLE IF NOT EXISTS
+                   song_hashes(song_id INTEGER PRIMARY KEY
+                               REFERENCES songs(song_id) ON DELETE CASCADE,
+                               hash_count INTEGER NOT NULL,
+                               hashes BYTEA NOT NULL,
+                               offsets BYTEA NOT NULL)""")
     dbc_logger.info("Done with initialization of database!")
     return
+
+def current_generation(cur):
+    """ Read the generation of the catalog
+
+    Parameter:
+        + cur: an open cursor of the database
+
+    Return:
+        + generation (int): the number of changes made to the catalog so far
+    """
+    cur.execute("SELECT generation FROM catalog_state")
+    return cur.fetchone()[0]
+
+def bump_generation(cur):
+    """ Mark the catalog as changed. Call it inside the transaction that
+    changes songs or fingerprints so both are committed together.
+
+    Parameter:
+        + cur: an open cursor of the database
+
+    Return:
+        + generation (int): the new generation of the catalog
+    """
+    cur.execute("""UPDATE catalog_state SET generation = generation + 1
+                   RETURNING generation""")
+    return cur.fetchone()[0]
+
+def log_changes(cur, generation, added=(), deleted=()):
+    """ Record the songs changed at a generation, in the same transaction
+    as bump_generation. A generation with nothing logged makes the next
+    index update fall back to a full rebuild.
+
+    Parameters:
+        + cur: an open cursor of the database
+        + generation (int): the generation returned by bump_generation
+        + added: the song_ids added at this generation
+        + deleted: the song_ids deleted at this generation
+    """
+    for song_ids, is_added in ((added, True), (deleted, False)):
+        song_ids = [int(i) for i in song_ids]
+        if len(song_ids) > 0:
+            cur.execute("""INSERT INTO catalog_changes (generation, song_id, added)
+                           SELECT %s, unnest(%s::INTEGER[]), %s""",
+                        (generation, song_ids, is_added))
+    return
+
+def migrate_fingerprints(drop=False):
+    """ Convert the fingerprints stored one row per window as NUMERIC and
+    NUMERIC ARRAY (table FINGERPRINTS) into the packed one row per song
+    format of SONG_FINGERPRINTS. Songs that are already converted are left
+    untouched, so the migration can be run again after an interruption.
+
+    Parameter:
+        + drop (bool): drop table FINGERPRINTS once everything is converted
+
+    Return:
+        + migrated (int): the number of songs converted
+    """
+    import numpy as np
+    create_table()
+    with db.cursor() as cur:
+        cur.execute("SELECT to_regclass('fingerprints')")
+        if cur.fetchone()[0] is None:
+            dbc_logger.info("No fingerprints in the old format, nothing to migrate")
+            return 0
+        cur.execute("""SELECT song_id FROM songs WHERE song_id NOT IN
+                       (SELECT song_id FROM song_fingerprints) ORDER BY song_id""")
+        song_ids = [row[0] for row in cur.fetchall()]
+
+    migrated = 0
+    for song_id in song_ids:
+        # one transaction per song keeps memory and locks small
+        with db.cursor() as cur:
+            cur.execute("""SELECT window_center, fingerprint1, fingerprint2
+                           FROM fingerprints WHERE song_id = %s
+                           ORDER BY window_center""", [song_id])
+            rows = cur.fetchall()
+            if len(rows) == 0:
+                continue
+            fingerprint2 = np.array([row[2] for row in rows], dtype=np.float32)
+            cur.execute("""INSERT INTO song_fingerprints (song_id, window_count,
+                           dimension, window_centers, fingerprint1, fingerprint2,
+                           audio_digest)
+                           VALUES (%s, %s, %s, %s, %s, %s, %s)
+                           ON CONFLICT (song_id) DO NOTHING""",
+                        (song_id, len(rows), fingerprint2.shape[1],
+                         db.pack_array([row[0] for row in rows]),
+                         db.pack_array([row[1] for row in rows]),
+                         db.pack_array(fingerprint2),
+                         db.array_digest(fingerprint2)))
+        migrated += 1
+    with db.cursor() as cur:
+        if migrated > 0:
+            bump_generation(cur)
+        if drop:
+            cur.execute("DROP TABLE fingerprints")
+    dbc_logger.info("Migrated the fingerprints of %d song(s)", migrated)
+    return migrated
@@ -1,12 +1,118 @@
 import os
-import psycopg2
+import time
+import queue
+import threading
 import logging
-import credentials as c
-import conversion_and_read as cr 
+import database as db
+import dbconstruction as dbc
+import metrics
+# numpy, psycopg2.extras and the process pool are imported by the functions
+# that write or analyze songs, and conversion_and_read and fingerprint_cache
+# (scipy, pydub) by the ones that analyze audio, so that delete and
+# rm_duplicate start quickly
 
 dbm_logger = logging.getLogger("freezam.dbmanagement")
 
-def add(song_title, artist_name, fingerprint1, fingerprint2, t):
+def _fingerprint_row(song_id, fingerprint1, fingerprint2, t, digest):
+    """ The SONG_FINGERPRINTS row of one song, every window packed in blobs """
+    import numpy as np
+    fingerprint2 = np.asarray(fingerprint2).reshape(len(t), -1)
+    return (song_id, len(t), fingerprint2.shape[1], db.pack_array(t),
+            db.pack_array(fingerprint1), db.pack_array(fingerprint2), digest)
+
+def _hash_row(song_id, hashes):
+    """ The SONG_HASHES row of one song, from (hashes, offsets) """
+    hashes, offsets = hashes
+    return (song_id, len(hashes), db.pack_array(hashes, '<u4'),
+            db.pack_array(offsets, '<i4'))
+
+def add_batch(songs):
+
+    """ A function to add many songs into the current database within a
+        single transaction: the songs are inserted with one multi-row
+        INSERT (execute_values), then one row per song holding all its
+        windows in bytea blobs, and their hashes, each in one statement too
+
+    Parameter:
+        + songs: A list of (song_title, artist_name, fingerprint1,
+        fingerprint2, t) tuples, one per song, in the same format as the
+        parameters of add; a sixth item (hashes, offsets) adds the
+        constellation hashes of the song, and a seventh, the
+        database.array_digest of fingerprint2 when it is already known,
+        saves hashing the fingerprints again
+
+    Returns:
+        + new_ids (list): the song_id given to every song, in order, or None
+        for a song whose audio is already in the database (or earlier in
+        songs); those are not added again, but get the hashes given here if
+        they have none yet
+    """
+    import numpy as np
+    from psycopg2.extras import execute_values
+    songs = list(songs)
+    if len(songs) == 0:
+        return []
+    digests = [song[6] if len(song) > 6 and song[6] is not None
+               else db.array_digest(np.asarray(song[3]).reshape(len(song[4]), -1))
+               for song in songs]
+    new_ids = []
+    with metrics.timer('db_write'):
+        with db.cursor() as cur:
+            cur.execute("""SELECT audio_digest, song_id FROM song_fingerprints
+                           WHERE audio_digest = ANY(%s)""", [digests])
+            stored = dict(cur.fetchall())
+            known = set(stored)
+            keep = []
+            for i, digest in enumerate(digests):
+                if digest not in known:
+                    keep.append(i)
+                    known.add(digest)
+            if len(keep) < len(songs):
+                dbm_logger.info('Skipped %d song(s) whose audio is already stored',
+                                len(songs) - len(keep))
+            if len(keep) > 0:
+                added = [songs[i] for i in keep]
+
+                # RETURNING gives the ids of our own rows, even with concurrent ingest
+                sql_command = """INSERT INTO songs (song_title, artist_name) VALUES %s
+                                 RETURNING song_id"""
+                new_ids = execute_values(cur, sql_command,
+                                         [(song[0], song[1]) for song in added],
+                                         page_size=len(added), fetch=True)
+                new_ids = [row[0] for row in new_ids]
+
+                # one row per song, all its windows packed in bytea blobs
+                sql_command = """INSERT INTO song_fingerprints (song_id, window_count,
+                                 dimension, window_centers, fingerprint1, fingerprint2,
+                                 audio_digest)
+                                 VALUES %s"""
+                execute_values(cur, sql_command,
+                               [_fingerprint_row(new_id, songs[i][2], songs[i][3],
+                                                 songs[i][4], digests[i])
+                                for new_id, i in zip(new_ids, keep)],
+                               page_size=len(added))
+                dbc.log_changes(cur, dbc.bump_generation(cur), added=new_ids)
+
+            # the hashes of the new songs, and of stored songs pushed again
+            # since they were added without hashes
+            stored.update((digests[i], new_id) for new_id, i in zip(new_ids, keep))
+            hash_rows = {}
+            for digest, song in zip(digests, songs):
+                if len(song) > 5 and song[5] is not None:
+                    hash_rows.setdefault(stored[digest], _hash_row(stored[digest], song[5]))
+            if hash_rows:
+                execute_values(cur, """INSERT INTO song_hashes (song_id, hash_count,
+                                       hashes, offsets) VALUES %s
+                                       ON CONFLICT (song_id) DO NOTHING""",
+                               list(hash_rows.values()), page_size=len(hash_rows))
+    metrics.inc('freezam_db_songs_written_total', len(new_ids))
+    dbm_logger.info('Sent %d song(s) to the database as requested!', len(new_ids))
+    ids = [None]*len(songs)
+    for i, new_id in zip(keep, new_ids):
+        ids[i] = new_id
+    return ids
+
+def add(song_title, artist_name, fingerprint1, fingerprint2, t, hashes=None):
 
     """ A function to add a new song with user-defined name into the
         current database
@@ -14,39 +120,79 @@ def add(song_title, artist_name, fingerprint1, fingerprint2, t):
     Parameters:
         + song_title (str): user-defined song title
         + artist_name (str): user-defined artist name
-        + window_size (int): the time length of the window
-        + shift (int): the fixed time gap between every two windows
         + fingerprint1 (ndarray): A ndarray that contains one-dimensional summaries
         of a song
         + fingerprint2 (ndarray): A ndarray that contains m-dimensional summaries
         of a song
         + t (ndarray): A ndarray that contains the window centers of a song
+        + hashes (tuple): the (hashes, offsets) given by
+        conversion_and_read.constellation, if any
 
     Returns:
+        + new_id (int): the song_id of the new song, or None if its audio is
+        already in the database
         Add a song and its following information into database
     """
-    conn = psycopg2.connect(host="sculptor.stat.cmu.edu", database=c.DB_USER,
-                            user=c.DB_USER, password=c.DB_PASSWORD)
-    cur = conn.cursor()
-    sql_command = " INSERT INTO songs (song_title, artist_name) VALUES (%s,%s) "
-
-    cur.execute(sql_command, (song_title, artist_name))
-    cur.execute("SELECT MAX(song_id) FROM songs")
-    new_id = cur.fetchone()[0]
-    
-    for i in range(len(t)):
-        sql_command = """INSERT INTO fingerprints (window_center, fingerprint1, 
-                         fingerprint2, song_id) VALUES (%s,%s,%s,%s)"""
-        cur.execute(sql_command, (t[i], fingerprint1[i],
-                                  fingerprint2[i].tolist(), new_id))
-    conn.commit()
-    conn.close()
-    dbm_logger.info('Sent the song to the database as requested!')
-    return
+    return add_batch([(song_title, artist_name, fingerprint1, fingerprint2, t,
+                       hashes)])[0]
+
+def _analyze_file(file_path, window_method, window_size, shift, m,
+                  analysis_rate=None, use_cache=True):
+    """ Fingerprint one file inside a worker process of push_all. With
+    use_cache, files whose content was already analyzed are read from the
+    fingerprint cache instead.
 
-def push_all(directory, window_size, shift, window_method, m):
+    Return:
+        + (song_title, artist_name, fingerprint1, fingerprint2, t, hashes,
+        audio_digest), or None if the file cannot be analyzed; the digest is
+        computed here, in parallel, instead of by the single writer
+    """
+    import numpy as np
+    import conversion_and_read as cr
+    import fingerprint_cache as fc
+    try:
+        analyzer = fc.cached_analyzer if use_cache else cr.single_analyzer
+        # the fingerprints and the hashes come from one decoding of the file
+        song_title, artist_name, fingerprint1, fingerprint2, t, hashes = analyzer(
+                                        file_path, window_method, window_size, shift, m,
+                                        analysis_rate=analysis_rate, with_hashes=True)
+    except Exception:
+        dbm_logger.error("Cannot analyze " + file_path)
+        return None
+    if song_title is None:
+        song_title = os.path.basename(file_path).split('.')[0]
+    if artist_name is None:
+        artist_name = 'unknown'
+    digest = db.array_digest(np.asarray(fingerprint2).reshape(len(t), -1))
+    return song_title, artist_name, fingerprint1, fingerprint2, t, hashes, digest
 
-    """ A function to push all music inventory into database
+def _writer(songs, batch_size, stats):
+    """ The single writer stage of push_all: take analyzed songs from the
+    queue and send them to the database in batches until None arrives """
+    batch = []
+    while True:
+        song = songs.get()
+        if song is not None:
+            batch.append(song)
+        if len(batch) >= batch_size or (song is None and batch):
+            if stats['error'] is None:
+                try:
+                    new_ids = add_batch(batch)
+                    stats['written'] += sum(new_id is not None for new_id in new_ids)
+                    stats['skipped'] += sum(new_id is None for new_id in new_ids)
+                except Exception as error:
+                    # keep draining the queue so the workers never block
+                    stats['error'] = error
+            batch = []
+        if song is None:
+            return
+
+def push_all(directory, window_size, shift, window_method, m, workers=None,
+             batch_size=50, analysis_rate=None, use_cache=True):
+
+    """ A function to push all music inventory into database. Files are
+    fingerprinted by a pool of worker processes while a single writer
+    thread sends the results to the database in batches.
 
     Parameters:
         + directory: the directory of music files
@@ -55,25 +201,92 @@ def push_all(directory, window_size, shift, window_method, m):
         + shift: the fixed time gap between every two windows
         + window_method (str): the desired window method to generate window data
         + m (int): the prespecified m for calculating fingerprint2
+        + workers (int): the number of worker processes, by default the
+        number of cores
+        + batch_size (int): the number of songs written per transaction
+        + analysis_rate (int): the sampling rate songs are analyzed at, by
+        default their own rate
+        + use_cache (bool): reuse the fingerprints of files already analyzed
+        with the same parameters (see fingerprint_cache), so that pushing a
+        library again only analyzes new or changed files
 
     Return:
         Push all music in the inventory into database with necessary
         information
 
     """
-    os.chdir(directory)
-    for file in os.listdir(directory):
-        try:
-            song_title, artist_name, fingerprint1, fingerprint2, t = cr.single_analyzer(file, 
-                                            window_method, window_size, shift, m)
-            if song_title is None:
-                song_title = file.split('.')[0]
-                
-            if artist_name is None:
-                artist_name = 'unknown'
-            add(song_title, artist_name, fingerprint1, fingerprint2, t)    
-        except:
-            pass
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    from concurrent.futures.process import BrokenProcessPool
+    workers = workers or os.cpu_count()
+    files = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                   if os.path.isfile(os.path.join(directory, name)))
+    # bounded, so fast workers cannot pile up fingerprints in memory
+    songs = queue.Queue(maxsize=2*batch_size)
+    stats = {'written': 0, 'skipped': 0, 'failed': 0, 'error': None}
+    writer = threading.Thread(target=_writer, args=(songs, batch_size, stats),
+                              name='freezam-writer')
+    writer.start()
+
+    start = time.time()
+    last_report = start
+    done_files = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = {}  # future -> file_path
+            files_left = iter(files)
+            while True:
+                # keep a couple of files per worker in flight
+                for file_path in files_left:
+                    # the metrics of the worker come back with the song
+                    pending[pool.submit(metrics.run_collected, _analyze_file,
+                                        file_path, window_method, window_size,
+                                        shift, m, analysis_rate, use_cache)] = file_path
+                    if len(pending) >= 2*workers:
+                        break
+                if not pending:
+                    break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    file_path = pending.pop(future)
+                    done_files += 1
+                    try:
+                        song, recorded = future.result()
+                    except BrokenProcessPool:
+                        # a worker died (killed, out of memory): the pool is
+                        # gone, the files left cannot be analyzed
+                        dbm_logger.error("A worker died while analyzing " + file_path)
+                        raise
+                    except Exception:
+                        dbm_logger.exception("Cannot analyze " + file_path)
+                        stats['failed'] += 1
+                        continue
+                    metrics.merge(recorded)
+                    if song is None:
+                        stats['failed'] += 1
+                    else:
+                        songs.put(song)
+                if time.time() - last_report >= 5:
+                    last_report = time.time()
+                    print("Analyzed %d/%d files (%.1f files/sec)" % (done_files,
+                          len(files), done_files/(last_report - start)))
+    finally:
+        # the writer waits for None, whatever happened to the workers
+        songs.put(None)
+        writer.join()
+    if use_cache:
+        import fingerprint_cache as fc
+        fc.evict()
+    if stats['error'] is not None:
+        raise stats['error']
+
+    elapsed = max(time.time() - start, 1e-9)
+    print("Pushed %d songs from %d files in %.1f sec (%.1f files/sec)" % (
+          stats['written'], len(files), elapsed, len(files)/elapsed))
+    if stats['skipped'] > 0:
+        print("Skipped %d song(s) whose audio is already in the database" %
+              stats['skipped'])
+    if stats['failed'] > 0:
+        print("Could not analyze %d file(s), see the log" % stats['failed'])
     dbm_logger.info("""All songs within this directory have been successfully pushed
                 to database!""")
     return
@@ -81,18 +294,28 @@ def push_all(directory, window_size, shift, window_method, m):
 def remove_duplicates():
     """ This function is used to clean the duplicates from the database """
 
-    conn = psycopg2.connect(host="sculptor.stat.cmu.edu", database=c.DB_USER,
-                            user=c.DB_USER, password=c.DB_PASSWORD)
-    cur = conn.cursor()
-    cur.execute("""DELETE
-                   FROM
-                       songs a
-                         USING songs b
-                    WHERE a.song_id < b.song_id AND
-                          a.song_title = b.song_title AND
-                          a.artist_name = b.artist_name""")
-    conn.commit()
-    conn.close()
+    with db.cursor() as cur:
+        cur.execute("""DELETE
+                       FROM
+                           songs a
+                             USING songs b
+                        WHERE a.song_id < b.song_id AND
+                              a.song_title = b.song_title AND
+                              a.artist_name = b.artist_name
+                    RETURNING a.song_id""")
+        removed = [row[0] for row in cur.fetchall()]
+        # the same audio under different tags
+        cur.execute("""DELETE
+                       FROM
+                           songs a
+                             USING song_fingerprints fa, song_fingerprints fb
+                        WHERE fa.song_id = a.song_id AND
+                              a.song_id < fb.song_id AND
+                              fa.audio_digest = fb.audio_digest
+                    RETURNING a.song_id""")
+        removed += [row[0] for row in cur.fetchall()]
+        if len(removed) > 0:
+            dbc.log_changes(cur, dbc.bump_generation(cur), deleted=removed)
     dbm_logger.info('Duplicate(s) has/have been removed successfully!')
     return
 
@@ -107,13 +330,12 @@ def delete(stitle, artname):
     Return:
         Remove a song in the current database
     """
-    conn = psycopg2.connect(host="sculptor.stat.cmu.edu", database=c.DB_USER,
-                            user=c.DB_USER, password=c.DB_PASSWORD)
-    cur = conn.cursor()
-    sql_command = """ DELETE FROM songs WHERE song_title = %s AND
-                    artist_name = %s """
-    cur.execute(sql_command, (stitle, artname))
-    conn.commit()
-    conn.close()
+    with db.cursor() as cur:
+        sql_command = """ DELETE FROM songs WHERE song_title = %s AND
+                        artist_name = %s RETURNING song_id"""
+        cur.execute(sql_command, (stitle, artname))
+        removed = [row[0] for row in cur.fetchall()]
+        if len(removed) > 0:
+            dbc.log_changes(cur, dbc.bump_generation(cur), deleted=removed)
     dbm_logger.info('Delete Successfully!')
     return
@@ -0,0 +1,207 @@
+import os
+import hashlib
+import logging
+import numpy as np
+import conversion_and_read as cr
+
+fc_logger = logging.getLogger('freezam.fingerprint_cache')
+
+DEFAULT_CACHE_DIR = os.environ.get('FREEZAM_CACHE_DIR', 'freezam_cache')
+# the cache is trimmed to this many bytes, least recently used entries first
+DEFAULT_CACHE_SIZE = int(os.environ.get('FREEZAM_CACHE_SIZE', 2*1024**3))
+
+
+def file_digest(file_path, block_size=1024*1024):
+    """ The sha256 of the content of a file, read block by block
+
+    Parameter:
+        + file_path (str): the local path of the file
+
+    Return:
+        + the hex digest (str)
+    """
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def cache_key(digest, window_method, window_size, shift, m, analysis_rate=None):
+    """ The name of the cache entry of a file analyzed with the given
+    parameters; any change of parameters gives another entry """
+    params = '%s-%s-%s-%s-%s' % (window_method, window_size, shift, m,
+                                 analysis_rate or 'native')
+    return hashlib.sha256((digest + ':' + params).encode('utf-8')).hexdigest()
+
+def _entry_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key + '.npz')
+
+def _read(key, cache_dir):
+    """ The arrays of a cache entry, or None if it is not in the cache """
+    path = _entry_path(cache_dir or DEFAULT_CACHE_DIR, key)
+    try:
+        with np.load(path) as entry:
+            arrays = {name: entry[name] for name in entry.files}
+    except (OSError, ValueError):
+        return None
+    try:
+        os.utime(path)  # the modification time is the last use, for eviction
+    except OSError:
+        pass
+    return arrays
+
+def _write(key, cache_dir, **arrays):
+    """ Store arrays as a cache entry. The entry is written to a temporary
+    file and renamed, so concurrent workers never read half an entry. """
+    path = _entry_path(cache_dir or DEFAULT_CACHE_DIR, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as fh:
+            np.savez(fh, **arrays)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return
+
+def get(key, cache_dir=None):
+    """ Read a cache entry
+
+    Parameters:
+        + key (str): the key given by cache_key
+        + cache_dir (str): the folder holding the cache
+
+    Return:
+        + (fingerprint1, fingerprint2, t), or None if the entry is not in the
+        cache
+    """
+    entry = _read(key, cache_dir)
+    try:
+        return entry['fingerprint1'], entry['fingerprint2'], entry['t']
+    except (TypeError, KeyError):
+        return None
+
+def put(key, arrays, cache_dir=None):
+    """ Store the analysis of a file. Only the arrays are kept: the title
+    and artist are read from the file that is analyzed, so a renamed or
+    retagged copy of the same content gets its own.
+
+    Parameters:
+        + key (str): the key given by cache_key
+        + arrays: (fingerprint1, fingerprint2, t)
+        + cache_dir (str): the folder holding the cache
+    """
+    fingerprint1, fingerprint2, t = arrays
+    _write(key, cache_dir, fingerprint1=fingerprint1, fingerprint2=fingerprint2, t=t)
+    return
+
+def evict(max_bytes=None, cache_dir=None):
+    """ Trim the cache to max_bytes, removing the least recently used
+    entries first
+
+    Parameters:
+        + max_bytes (int): the largest size of the cache, FREEZAM_CACHE_SIZE
+        by default
+        + cache_dir (str): the folder holding the cache
+
+    Return:
+        + removed (int): the number of entries removed
+    """
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    max_bytes = DEFAULT_CACHE_SIZE if max_bytes is None else max_bytes
+    entries = []
+    for root, _, names in os.walk(cache_dir):
+        for name in names:
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+    total = sum(entry[1] for entry in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    if removed > 0:
+        fc_logger.info("Evicted %d cache entries", removed)
+    return removed
+
+def _hashes_key(digest, analysis_rate=None):
+    """ The name of the cache entry of the constellation hashes of a file """
+    # every setting of the peaks and the pairs changes the hashes
+    method = 'constellation%r' % ((cr.PEAK_NEIGHBORHOOD, cr.PEAK_MARGIN,
+                                   cr.PEAKS_PER_SECOND, cr.PEAK_MIN_BIN,
+                                   cr.FREQ_BITS, cr.DT_BITS),)
+    return cache_key(digest, method, cr.PEAK_WINDOW, cr.PEAK_HOP, cr.FAN_OUT,
+                     analysis_rate)
+
+def _get_hashes(key, cache_dir):
+    """ The (hashes, offsets) of a cache entry, or None """
+    entry = _read(key, cache_dir)
+    if entry is None or 'hashes' not in entry:
+        return None
+    return entry['hashes'], entry['offsets']
+
+def _put_hashes(key, hashes, cache_dir, file_path):
+    """ Store the (hashes, offsets) of a file, if the cache can be written """
+    try:
+        _write(key, cache_dir, hashes=hashes[0], offsets=hashes[1])
+    except OSError:
+        fc_logger.warning("Cannot cache the hashes of " + file_path)
+
+def cached_analyzer(file_path, window_method, window_size, shift, m,
+                    analysis_rate=None, cache_dir=None, with_hashes=False):
+    """ single_analyzer, skipped when the same file content was already
+    analyzed with the same parameters. When neither the fingerprints nor
+    the hashes are cached, both come from one decoding of the file.
+
+    Parameters:
+        + file_path (str): the local path of the song
+        + window_method, window_size, shift, m, analysis_rate: see
+        conversion_and_read.single_analyzer
+        + cache_dir (str): the folder holding the cache
+        + with_hashes (bool): also return the constellation hashes
+
+    Returns:
+        + song_title, artist_name, fingerprint1, fingerprint2, t as returned
+        by single_analyzer, and (hashes, offsets) with with_hashes; the
+        title and artist always come from file_path
+    """
+    # one read of the file names both entries
+    digest = file_digest(file_path)
+    key = cache_key(digest, window_method, window_size, shift, m, analysis_rate)
+    hashes_key = _hashes_key(digest, analysis_rate)
+    arrays = get(key, cache_dir)
+    hashes = _get_hashes(hashes_key, cache_dir) if with_hashes else None
+    if arrays is not None:
+        fc_logger.info("Cached fingerprints used for " + file_path)
+        song = cr.song_name(file_path) + tuple(arrays)
+        if not with_hashes:
+            return song
+        if hashes is None:
+            hashes = cr.constellation(file_path, analysis_rate)
+            _put_hashes(hashes_key, hashes, cache_dir, file_path)
+        return song + (hashes,)
+    analysis = cr.single_analyzer(file_path, window_method, window_size, shift, m,
+                                  analysis_rate=analysis_rate,
+                                  with_hashes=with_hashes and hashes is None)
+    song = analysis[:5]
+    try:
+        put(key, song[2:], cache_dir)
+    except OSError:
+        fc_logger.warning("Cannot cache the fingerprints of " + file_path)
+    if not with_hashes:
+        return song
+    if hashes is None:
+        hashes = analysis[5]
+        _put_hashes(hashes_key, hashes, cache_dir, file_path)
+    return song + (hashes,)
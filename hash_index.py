@@ -0,0 +1,203 @@
+import os
+import json
+import shutil
+import logging
+import numpy as np
+import database as db
+import dbconstruction as dbc
+import index_store as ist
+import metrics
+
+hi_logger = logging.getLogger('freezam.hash_index')
+
+HASH_FORMAT = 1  # bump when the on-disk layout changes
+# hashes found in more songs windows than this (silence, hum) say little
+# about the song and would make a lookup scan most of the index; skip them
+MAX_POSTINGS = 5000
+
+
+class HashIndex:
+    """ The inverted index of the constellation hashes: every hash of the
+    catalog with the song and the frame of its anchor peak, sorted by hash
+    so a lookup is a binary search. The arrays are memory-mapped.
+
+    Attributes:
+        + meta (dict): the content of meta.json (format, generation, number
+        of hashed songs ...)
+        + hashes (ndarray): the uint32 hashes, ascending
+        + song_id (ndarray): the song of every hash
+        + offset (ndarray): the frame of the anchor of every hash
+    """
+
+    def __init__(self, directory, meta, arrays):
+        self.directory = directory
+        self.meta = meta
+        self.generation = meta['generation']
+        self.hashes = arrays['hashes']
+        self.song_id = arrays['song_id']
+        self.offset = arrays['offset']
+
+
+def hash_dir(index_dir=None):
+    """ The folder of the hash index, inside the folder of the index """
+    return os.path.join(index_dir or ist.DEFAULT_INDEX_DIR, 'hashes')
+
+def _catalog_version(cur):
+    """ The catalog generation and the number of hashed songs; songs stored
+    before they had hashes get them without a new generation """
+    cur.execute("SELECT count(*) FROM song_hashes")
+    return dbc.current_generation(cur), cur.fetchone()[0]
+
+def write(directory, version, hashes, song_id, offset):
+    """ Sort the hashes and write them to disk, then replace meta.json
+    atomically and drop the older segments
+
+    Parameters:
+        + directory (str): the folder of the hash index
+        + version (tuple): (generation, hashed songs) the data was read at
+        + hashes, song_id, offset (ndarray): one entry per hash, any order
+
+    Return:
+        + meta (dict): the meta data written to meta.json
+    """
+    generation, n_songs = version
+    order = np.argsort(hashes, kind='stable')
+    segment = 'gen-%d-%d' % (generation, n_songs)
+    segment_dir = os.path.join(directory, segment)
+    os.makedirs(segment_dir, exist_ok=True)
+    np.save(os.path.join(segment_dir, 'hashes.npy'),
+            np.asarray(hashes, dtype=np.uint32)[order])
+    np.save(os.path.join(segment_dir, 'song_id.npy'),
+            np.asarray(song_id, dtype=np.int32)[order])
+    np.save(os.path.join(segment_dir, 'offset.npy'),
+            np.asarray(offset, dtype=np.int32)[order])
+    meta = {'format': HASH_FORMAT,
+            'generation': generation,
+            'songs': n_songs,
+            'segment': segment,
+            'num_hashes': int(len(order))}
+    tmp_path = os.path.join(directory, 'meta.json.tmp')
+    with open(tmp_path, 'w') as fh:
+        json.dump(meta, fh, indent=2)
+    os.replace(tmp_path, os.path.join(directory, 'meta.json'))
+    for name in os.listdir(directory):
+        if name.startswith('gen-') and name != segment:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    hi_logger.info("Hash index of generation %d written to %s", generation, directory)
+    return meta
+
+def build(index_dir=None):
+    """ Read the hashes of every song from the database and write the hash
+    index of the current catalog
+
+    Parameter:
+        + index_dir (str): the folder holding the index
+
+    Return:
+        + HashIndex
+    """
+    directory = hash_dir(index_dir)
+    with ist._locked(directory):
+        with db.cursor() as cur:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            version = _catalog_version(cur)
+            cur.execute("SELECT song_id, hash_count, hashes, offsets FROM song_hashes")
+            rows = cur.fetchall()
+        metrics.inc('freezam_db_rows_fetched_total', len(rows))
+        with metrics.timer('index_build'):
+            write(directory, version,
+                  np.concatenate([db.unpack_array(row[2], dtype='<u4') for row in rows]
+                                 or [np.zeros(0, dtype=np.uint32)]),
+                  np.repeat([row[0] for row in rows], [row[1] for row in rows]),
+                  np.concatenate([db.unpack_array(row[3], dtype='<i4') for row in rows]
+                                 or [np.zeros(0, dtype=np.int32)]))
+    return load(index_dir)
+
+def load(index_dir=None):
+    """ Memory-map the hash index saved in index_dir
+
+    Parameter:
+        + index_dir (str): the folder holding the index
+
+    Return:
+        + HashIndex, or None if there is no usable hash index
+    """
+    directory = hash_dir(index_dir)
+    try:
+        with open(os.path.join(directory, 'meta.json')) as fh:
+            meta = json.load(fh)
+        if meta.get('format') != HASH_FORMAT:
+            return None
+        arrays = {name: np.load(os.path.join(directory, meta['segment'], name + '.npy'),
+                                mmap_mode='r')
+                  for name in ('hashes', 'song_id', 'offset')}
+    except (OSError, ValueError, KeyError):
+        return None
+    if len(arrays['hashes']) != meta['num_hashes']:
+        return None
+    return HashIndex(directory, meta, arrays)
+
+def ensure(index_dir=None):
+    """ Load the hash index and rebuild it if it is missing or older than
+    the catalog. Sorting the hashes is fast, so there are no delta segments:
+    any change of the catalog rebuilds it.
+
+    Parameter:
+        + index_dir (str): the folder holding the index
+
+    Return:
+        + A HashIndex that matches the current catalog
+    """
+    index = load(index_dir)
+    with db.cursor() as cur:
+        generation, n_songs = _catalog_version(cur)
+    if (index is not None and index.generation == generation and
+            index.meta['songs'] == n_songs):
+        return index
+    hi_logger.info("Hash index is missing or stale, rebuilding it")
+    return build(index_dir)
+
+def lookup(index, hashes, offsets, top=10):
+    """ Match the hashes of a snippet: every hash found in a song votes for
+    the song starting at its offset in the song minus its offset in the
+    snippet. A true match piles its votes on one offset; the votes of the
+    next frame are added, as a snippet rarely starts on a frame.
+
+    Parameters:
+        + index (HashIndex): the loaded hash index
+        + hashes, offsets (ndarray): the hashes of the snippet, as given by
+        conversion_and_read.constellation
+        + top (int): the number of songs to return
+
+    Return:
+        + A list of (song_id, offset, votes, confidence) sorted by votes,
+        like search_match.vote; offset is the frame of the song where the
+        snippet starts and confidence the share of snippet hashes that agree
+    """
+    with metrics.timer('hash_lookup'):
+        hashes = np.asarray(hashes, dtype=np.uint32)
+        lo = np.searchsorted(index.hashes, hashes, 'left')
+        hi = np.searchsorted(index.hashes, hashes, 'right')
+        counts = hi - lo
+        counts[counts > MAX_POSTINGS] = 0
+        total = int(counts.sum())
+        metrics.inc('freezam_hash_candidates_total', total)
+        if total == 0:
+            return []
+        # the rows lo[i]..hi[i] of every snippet hash, without a python loop
+        first = np.cumsum(counts) - counts
+        rows = np.repeat(lo, counts) + np.arange(total) - np.repeat(first, counts)
+        song_ids = np.asarray(index.song_id[rows], dtype=np.int64)
+        starts = index.offset[rows] - np.repeat(np.asarray(offsets, dtype=np.int64), counts)
+
+        pairs, votes = np.unique(np.stack([song_ids, starts], axis=1), axis=0,
+                                 return_counts=True)
+        # pairs are sorted by song then start: add the votes of start + 1
+        following = ((pairs[1:, 0] == pairs[:-1, 0]) &
+                     (pairs[1:, 1] == pairs[:-1, 1] + 1))
+        votes[:-1] += np.where(following, votes[1:], 0)
+        order = np.lexsort((pairs[:, 0], -votes))
+        _, best = np.unique(pairs[order, 0], return_index=True)
+        best = order[np.sort(best)][:top]
+    return [(int(pairs[i, 0]), int(pairs[i, 1]), int(votes[i]),
+             min(float(votes[i])/len(hashes), 1.0)) for i in best]
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import conversion_and_read as cr
+import search_match as sm
+import shards
+import metrics
+
+ib_logger = logging.getLogger('freezam.identify_batch')
+
+
+def snippet_paths(source):
+    """ The snippets of a batch
+
+    Parameter:
+        + source (str): a folder of snippets, or a manifest file listing one
+        snippet path per line; relative paths are taken from the folder of
+        the manifest, blank lines and lines starting with # are skipped
+
+    Return:
+        + the list of snippet paths, in order
+    """
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name) for name in os.listdir(source)
+                      if os.path.isfile(os.path.join(source, name)))
+    base = os.path.dirname(source)
+    with open(source) as fh:
+        lines = [line.strip() for line in fh]
+    return [os.path.join(base, line) for line in lines
+            if line and not line.startswith('#')]
+
+def _analyze(path, window_method, window_size, shift, m, analysis_rate):
+    """ Fingerprint one snippet inside a worker process, and time it """
+    start = time.time()
+    fingerprint1, fingerprint2, t = cr.analyze_audio(path, window_method,
+                                                     window_size, shift, m,
+                                                     analysis_rate)
+    return fingerprint1, fingerprint2, t, time.time() - start
+
+def _searcher(search, coordinator):
+    """ The lookup of the snippets ready at the same time, for the search
+    mode of identify: a function of a list of (fingerprint1, fingerprint2, t)
+    returning the matches of every snippet as (song_id, window_center,
+    score), window_center and score being None for the searches that do
+    not give them. The snippets are searched together: their windows are
+    stacked into one LSH probe, one KD-tree query or one range lookup, and
+    the hits are split back per snippet. """
+    if search == 3:
+        if coordinator is not None:
+            lsh_vote_batch = coordinator.lsh_vote_batch
+        else:
+            centroid, query_obj = sm.setup()
+            lsh_vote_batch = lambda fingerprint2s, ts: sm.lsh_vote_batch(
+                query_obj, centroid, fingerprint2s, ts)
+
+        def lookup(snippets):
+            voted = lsh_vote_batch([fingerprint2 for _, fingerprint2, _ in snippets],
+                                   [t for _, _, t in snippets])
+            return [[(sid, offset + int(round(t[0])), confidence)
+                     for sid, offset, _, confidence in songs]
+                    for songs, (_, _, t) in zip(voted, snippets)]
+    elif search == 2:
+        knn_predict_batch = (coordinator.knn_predict_batch if coordinator is not None
+                             else lambda fingerprint2s, k: sm.knn_predict_batch(
+                                 sm.load_index(), fingerprint2s, k))
+
+        def lookup(snippets):
+            predicted = knn_predict_batch([fingerprint2 for _, fingerprint2, _ in snippets], 3)
+            return [[(sid, None, None)] if sid is not None else [] for sid in predicted]
+    else:
+        rough_match_ids_batch = (coordinator.rough_match_ids_batch if coordinator is not None
+                                 else lambda fingerprint1s: sm.rough_match_ids_batch(
+                                     sm.load_index(), fingerprint1s))
+
+        def lookup(snippets):
+            matched = rough_match_ids_batch([fingerprint1 for fingerprint1, _, _ in snippets])
+            return [[(sid, None, None) for sid in song_ids] for song_ids in matched]
+    return lookup
+
+def _search(lookup, records, snippets):
+    """ Fill the matches of the records of the snippets with one lookup;
+    if it fails, search the snippets one by one so only the snippets that
+    cannot be searched get an error """
+    start = time.time()
+    try:
+        found = lookup(snippets)
+    except Exception as error:
+        if len(snippets) > 1:
+            for record, snippet in zip(records, snippets):
+                _search(lookup, [record], [snippet])
+        else:
+            ib_logger.error("Cannot identify " + records[0]['snippet'])
+            records[0]['error'] = str(error)
+        return
+    search_ms = round((time.time() - start)*1000, 1)
+    for record, matches in zip(records, found):
+        record['matches'] = matches
+        record['search_ms'] = search_ms
+        record['batch'] = len(snippets)
+    return
+
+def _write_records(records, output):
+    """ Give titles to the matches of the records with a single query and
+    write them as json lines """
+    song_ids = [sid for record in records for sid, _, _ in record.get('matches', [])]
+    titles = sm.retriv_titles(song_ids) if song_ids else {}
+    for record in records:
+        if 'matches' in record:
+            # songs deleted since the index was loaded have no title
+            record['matches'] = [{'song_id': int(sid), 'title': titles[sid],
+                                  'window_center': center, 'score': score}
+                                 for sid, center, score in record['matches']
+                                 if sid in titles]
+        output.write(json.dumps(record) + '\n')
+    output.flush()
+
+def identify_batch(source, window_size, shift, window_method, m, search=3,
+                   workers=None, output=None, analysis_rate=None, n_shards=None):
+
+    """ Identify many snippets with one process: the index is loaded once,
+    snippets are fingerprinted by a pool of worker processes and the results
+    are written as json lines as soon as they are known, in the order the
+    snippets finish. Every line holds the snippet path, its matches
+    (song_id, title, window_center, score) or an error, and the time spent
+    analyzing, searching and in total since the snippet was submitted.
+    The snippets whose analysis finished while the previous ones were
+    searched are searched together (see _searcher); batch is their number
+    and search_ms the time of their common search.
+
+    Parameters:
+        + source (str): a folder of snippets or a manifest, see snippet_paths
+        + window_size, shift, window_method, m: the analysis parameters used
+        for the catalog
+        + search (int): the search of identify, 1 rough, 2 slow or 3 LSH
+        + workers (int): the number of analysis processes, by default the
+        number of cores
+        + output: the file the json lines are written to, stdout by default
+        + analysis_rate (int): the sampling rate the catalog was analyzed at
+        + n_shards (int): search an index split in this many shards
+
+    Return:
+        + the number of snippets processed
+    """
+    paths = snippet_paths(source)
+    output = output or sys.stdout
+    workers = workers or os.cpu_count()
+    coordinator = shards.ShardCoordinator(n_shards) if n_shards else None
+    start = time.time()
+    done = 0
+    try:
+        lookup = _searcher(search, coordinator)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = {}
+            paths_left = iter(paths)
+            while True:
+                # keep a couple of snippets per worker in flight
+                for path in paths_left:
+                    future = pool.submit(metrics.run_collected, _analyze, path,
+                                         window_method, window_size, shift, m,
+                                         analysis_rate)
+                    pending[future] = (path, time.time())
+                    if len(pending) >= 2*workers:
+                        break
+                if not pending:
+                    break
+                finished, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                records, submitted, ready, snippets = [], [], [], []
+                for future in finished:
+                    path, submit_time = pending.pop(future)
+                    record = {'snippet': path}
+                    try:
+                        analyzed, recorded = future.result()
+                        metrics.merge(recorded)
+                        fingerprint1, fingerprint2, t, analysis = analyzed
+                        record['analysis_ms'] = round(analysis*1000, 1)
+                        ready.append(record)
+                        snippets.append((fingerprint1, fingerprint2, t))
+                    except Exception as error:
+                        ib_logger.error("Cannot identify " + path)
+                        record['error'] = str(error)
+                    records.append(record)
+                    submitted.append(submit_time)
+                if snippets:
+                    _search(lookup, ready, snippets)
+                for record, submit_time in zip(records, submitted):
+                    record['latency_ms'] = round((time.time() - submit_time)*1000, 1)
+                _write_records(records, output)
+                done += len(records)
+    finally:
+        if coordinator is not None:
+            coordinator.close()
+
+    elapsed = max(time.time() - start, 1e-9)
+    sys.stderr.write("Identified %d snippets in %.1f sec (%.0f per minute)\n" % (
+                     done, elapsed, done*60/elapsed))
+    ib_logger.info("Batch of %d snippets identified", done)
+    return done
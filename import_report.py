@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# How long every subcommand of main.py takes to start, measured with
+# python -X importtime in a fresh interpreter.
+#
+#   python import_report.py --repeat 5
+#
+# The first row runs main.py --help itself. The other rows import the
+# modules a subcommand imports when it runs (see main.py), the last one
+# imports all of them, as main.py did before the imports were made lazy.
+# The commands that never touch audio or the index must start within
+# BUDGET_MS; the report exits with status 1 when one of them does not.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+COMMANDS = [
+    ('delete, rm_duplicate', ['dbmanagement']),
+    ('migrate', ['dbconstruction']),
+    ('compact', ['index_store']),
+    ('add, push_all', ['dbmanagement', 'dbconstruction', 'fingerprint_cache',
+                       'conversion_and_read']),
+    ('identify', ['conversion_and_read', 'search_match']),
+    ('identify --shards', ['conversion_and_read', 'search_match', 'shards']),
+    ('identify-batch', ['identify_batch']),
+    ('listen', ['live']),
+    ('serve', ['server']),
+    ('serve --asyncio', ['async_server']),
+]
+BUDGET_MS = 200
+BUDGETED = ('main.py --help', 'delete, rm_duplicate')
+EAGER = sorted(set(module for _, modules in COMMANDS for module in modules))
+
+
+def measure(command):
+    """ Run command with -X importtime in a fresh interpreter
+
+    Returns:
+        + wall (float): the seconds until the interpreter exits
+        + imports (dict): the cumulative import time of every top level
+        module, in seconds
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + command,
+                            cwd=HERE, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+    wall = time.perf_counter() - start
+    imports = {}
+    for line in result.stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):  # imported by the command itself
+            imports[name.strip()] = int(cumulative)/1e6
+    return wall, imports
+
+def report(name, command, repeat):
+    """ The fastest of repeat runs of command
+
+    Returns:
+        + line (str): one line of the report
+        + wall (float): the milliseconds of the fastest run
+    """
+    wall, imports = min((measure(command) for _ in range(repeat)),
+                        key=lambda run: run[0])
+    heaviest = sorted(imports.items(), key=lambda item: -item[1])[:3]
+    line = '%-30s %9.0f %11.0f   %s' % (name, wall*1000, sum(imports.values())*1000,
+                                        ', '.join('%s %.0f' % (module, seconds*1000)
+                                                  for module, seconds in heaviest))
+    return line, wall*1000
+
+def main():
+    parser = argparse.ArgumentParser(description="""report the startup time
+                                     of the subcommands of main.py""")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='keep the fastest of this many runs of every row')
+    args = parser.parse_args()
+
+    print('%-30s %9s %11s   %s' % ('command', 'wall (ms)', 'import (ms)',
+                                   'heaviest imports (ms)'))
+    rows = [('main.py --help', ['main.py', '--help'])]
+    for name, modules in COMMANDS + [('all modules (eager main.py)', EAGER)]:
+        statement = 'import argparse, logging, metrics; import ' + ', '.join(modules)
+        rows.append((name, ['-c', statement]))
+    over = []
+    for name, command in rows:
+        line, wall = report(name, command, args.repeat)
+        print(line)
+        if name in BUDGETED and wall > BUDGET_MS:
+            over.append('%s takes %.0f ms' % (name, wall))
+    if over:
+        print('Over the %d ms budget: %s' % (BUDGET_MS, '; '.join(over)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
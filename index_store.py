@@ -0,0 +1,598 @@
+import os
+import json
+import fcntl
+import pickle
+import shutil
+import logging
+import threading
+import contextlib
+import falconn # hash table parameters are stored with the index
+import numpy as np
+import database as db
+import dbconstruction as dbc
+import metrics
+
+is_logger = logging.getLogger('freezam.index_store')
+
+INDEX_FORMAT = 3  # bump when the on-disk layout changes
+DEFAULT_INDEX_DIR = os.environ.get('FREEZAM_INDEX_DIR', 'freezam_index')
+# seconds a catalog generation read from the database is trusted by the
+# long-lived readers before they read it again
+GENERATION_TTL = float(os.environ.get('FREEZAM_GENERATION_TTL', 1))
+# compact once the delta segments hold this share of the rows of the base,
+# or the tombstones this share of its songs
+COMPACT_FRACTION = 0.1
+MAX_DELTAS = 16
+# the tables built in memory over the base segment, valid until a new base
+# is written by build or compact
+BASE_TABLES = ('lsh_tbl', 'kdtree')
+
+
+class IndexArtifact:
+    """ The fingerprint index loaded from disk. All arrays are memory-mapped,
+    so loading costs a few milliseconds regardless of the catalog size.
+
+    Attributes:
+        + meta (dict): the content of meta.json (format, generation,
+        lsh parameters ...)
+        + fingerprint2 (ndarray): nxd float32 matrix of fingerprint2, already
+        centred by the centroid
+        + centroid (ndarray): the mean of each column of fingerprint2
+        + song_id (ndarray): the song_id of every row of fingerprint2
+        + window_center (ndarray): the window center of every row
+        + fingerprint1 (ndarray): the fingerprint1 of every row
+        + fingerprint1_sorted (ndarray): fingerprint1 sorted ascending
+        + fingerprint1_order (ndarray): the row of every sorted fingerprint1
+        + delta (dict): the song_id, window_center, fingerprint1 and
+        fingerprint2 (centred by the same centroid) of the songs added since
+        the base was written, small enough to be searched exhaustively
+        + tombstones (ndarray): the song_ids deleted since the base was
+        written, sorted; their rows are still in the arrays and are skipped
+        by the searches
+
+    Rows are ordered by song_id and window center, so the windows of a song
+    are contiguous and start at song_offsets.
+    """
+
+    def __init__(self, index_dir, meta, arrays, delta=None, tombstones=None):
+        self.index_dir = index_dir
+        self.meta = meta
+        self.generation = meta['generation']
+        self.fingerprint2 = arrays['fingerprint2']
+        self.centroid = arrays['centroid']
+        self.song_id = arrays['song_id']
+        self.window_center = arrays['window_center']
+        self.fingerprint1 = arrays['fingerprint1']
+        self.fingerprint1_sorted = arrays['fingerprint1_sorted']
+        self.fingerprint1_order = arrays['fingerprint1_order']
+        self.delta = delta if delta is not None else _empty_delta(meta['dimension'])
+        self.tombstones = (tombstones if tombstones is not None
+                           else np.zeros(0, dtype=np.int64))
+        self._song_offsets = None
+
+    @property
+    def song_offsets(self):
+        """ The first row of every song, plus the number of rows at the end """
+        if self._song_offsets is None:
+            starts = np.flatnonzero(np.diff(self.song_id)) + 1
+            # an empty base has no song to start, only the end
+            first = [0] if len(self.song_id) > 0 else []
+            self._song_offsets = np.concatenate((first, starts, [len(self.song_id)])
+                                                ).astype(np.int64)
+        return self._song_offsets
+
+    @property
+    def song_ids(self):
+        """ The distinct song_ids of the base, ascending, followed by the
+        ones of the delta segments """
+        base = np.asarray(self.song_id[self.song_offsets[:-1]])
+        return np.concatenate((base, np.unique(self.delta['song_id'])))
+
+    def alive(self, song_ids):
+        """ A boolean mask of the song_ids that are not deleted """
+        return ~np.isin(song_ids, self.tombstones)
+
+
+def _empty_delta(dimension):
+    return {'song_id': np.zeros(0, dtype=np.int64),
+            'window_center': np.zeros(0, dtype=np.int64),
+            'fingerprint1': np.zeros(0, dtype=np.float32),
+            'fingerprint2': np.zeros((0, dimension), dtype=np.float32)}
+
+@contextlib.contextmanager
+def _locked(index_dir):
+    """ Hold the lock of the index folder, taken by every writer (build,
+    update, compact) so they never interleave """
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, '.lock'), 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def shard_dir(index_dir, shard):
+    """ The folder of one shard of the index
+
+    Parameters:
+        + index_dir (str): the folder holding the index
+        + shard (tuple): (i, n), the shard holding the songs with
+        song_id % n == i
+
+    Return:
+        + the folder of the shard, inside index_dir
+    """
+    return os.path.join(index_dir or DEFAULT_INDEX_DIR, 'shard-%d-of-%d' % tuple(shard))
+
+def _in_shard(song_id, shard):
+    return shard is None or song_id % shard[1] == shard[0]
+
+def _meta_path(index_dir):
+    return os.path.join(index_dir, 'meta.json')
+
+def _write_meta(index_dir, meta):
+    """ Replace meta.json atomically, then drop the segments it no longer
+    refers to """
+    tmp_path = _meta_path(index_dir) + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(meta, fh, indent=2)
+    os.replace(tmp_path, _meta_path(index_dir))
+    used = set([meta['segment'], meta['tombstones']] + meta['deltas'])
+    for name in os.listdir(index_dir):
+        if name.startswith(('gen-', 'delta-', 'tombstones-')) and name not in used:
+            path = os.path.join(index_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+    return
+
+def _serialize_parameters(params):
+    """ Turn falconn.LSHConstructionParameters into a json friendly dict """
+    return {'dimension': params.dimension,
+            'lsh_family': str(params.lsh_family).split('.')[-1],
+            'distance_function': str(params.distance_function).split('.')[-1],
+            'storage_hash_table': str(params.storage_hash_table).split('.')[-1],
+            'k': params.k,
+            'l': params.l,
+            'num_rotations': params.num_rotations,
+            'last_cp_dimension': params.last_cp_dimension,
+            'feature_hashing_dimension': params.feature_hashing_dimension,
+            'num_setup_threads': params.num_setup_threads,
+            'seed': params.seed}
+
+def lsh_parameters(meta):
+    """ Rebuild the falconn construction parameters saved with the index
+
+    Parameter:
+        + meta (dict): the meta data of the index
+
+    Return:
+        + params: falconn.LSHConstructionParameters identical to the ones
+        used when the index was built
+    """
+    saved = meta['lsh']
+    params = falconn.LSHConstructionParameters()
+    params.dimension = saved['dimension']
+    params.lsh_family = getattr(falconn.LSHFamily, saved['lsh_family'])
+    params.distance_function = getattr(falconn.DistanceFunction,
+                                       saved['distance_function'])
+    params.storage_hash_table = getattr(falconn.StorageHashTable,
+                                        saved['storage_hash_table'])
+    params.k = saved['k']
+    params.l = saved['l']
+    params.num_rotations = saved['num_rotations']
+    params.last_cp_dimension = saved['last_cp_dimension']
+    params.feature_hashing_dimension = saved['feature_hashing_dimension']
+    params.num_setup_threads = saved['num_setup_threads']
+    params.seed = saved['seed']
+    return params
+
+def write(index_dir, generation, song_id, window_center, fingerprint1,
+          fingerprint2, shard=None):
+    """ Write the fingerprint index to disk
+
+    The arrays go to a sub folder named after the catalog generation and
+    meta.json is replaced atomically at the end, so readers never see a half
+    written index and processes still mapping an old generation keep working.
+
+    Parameters:
+        + index_dir (str): the folder holding the index
+        + generation (int): the catalog generation the data was read at
+        + song_id (ndarray): the song_id of every fingerprint row, ascending
+        + window_center (ndarray): the window center of every fingerprint row
+        + fingerprint1 (ndarray): the fingerprint1 of every row
+        + fingerprint2 (ndarray): nxd matrix of fingerprint2
+        + shard (tuple): (i, n) when the index holds only one shard of the
+        catalog
+
+    Return:
+        + meta (dict): the meta data written to meta.json
+    """
+    data = np.array(fingerprint2, dtype=np.float32)  # a copy, centred below
+    if len(data) > 0:
+        centroid = np.mean(data, axis=0) # learned from the author of falconn
+    else:
+        centroid = np.zeros(data.shape[1], dtype=np.float32)  # an empty shard
+    data -= centroid  # each column represents an octave band; trick provided
+                      # by the author of falconn
+    parameters = falconn.get_default_parameters(num_points=max(data.shape[0], 1),
+                                                dimension=data.shape[1])
+
+    segment = 'gen-%d' % generation
+    segment_dir = os.path.join(index_dir, segment)
+    os.makedirs(segment_dir, exist_ok=True)
+    np.save(os.path.join(segment_dir, 'fingerprint2.npy'), data)
+    np.save(os.path.join(segment_dir, 'centroid.npy'), centroid)
+    np.save(os.path.join(segment_dir, 'song_id.npy'),
+            np.asarray(song_id, dtype=np.int64))
+    np.save(os.path.join(segment_dir, 'window_center.npy'),
+            np.asarray(window_center, dtype=np.int64))
+    fingerprint1 = np.asarray(fingerprint1, dtype=np.float32)
+    order = np.argsort(fingerprint1, kind='stable')
+    np.save(os.path.join(segment_dir, 'fingerprint1.npy'), fingerprint1)
+    np.save(os.path.join(segment_dir, 'fingerprint1_sorted.npy'), fingerprint1[order])
+    np.save(os.path.join(segment_dir, 'fingerprint1_order.npy'), order)
+
+    meta = {'format': INDEX_FORMAT,
+            'generation': generation,
+            'segment': segment,
+            'num_points': int(data.shape[0]),
+            'dimension': int(data.shape[1]),
+            'lsh': _serialize_parameters(parameters),
+            'deltas': [],
+            'tombstones': None,
+            'shard': list(shard) if shard is not None else None}
+    # also drops the segments of older generations
+    _write_meta(index_dir, meta)
+    is_logger.info("Index of generation %d written to %s", generation, index_dir)
+    return meta
+
+def build(index_dir=None, shard=None):
+    """ Read every fingerprint2 from the database in one pass and save the
+    index to disk
+
+    Parameters:
+        + index_dir (str): the folder holding the index
+        + shard (tuple): (i, n) to index only the songs with
+        song_id % n == i
+
+    Return:
+        + The freshly built IndexArtifact
+    """
+    index_dir = index_dir or DEFAULT_INDEX_DIR
+    with _locked(index_dir):
+        with db.cursor() as cur:
+            # one consistent snapshot for the generation and the fingerprints
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            generation = dbc.current_generation(cur)
+            # one row per song: a single sequential read of packed blobs
+            i, n = shard if shard is not None else (0, 1)
+            cur.execute("""SELECT song_id, window_count, dimension, window_centers,
+                           fingerprint1, fingerprint2
+                           FROM song_fingerprints WHERE song_id %% %s = %s
+                           ORDER BY song_id""", (n, i))
+            rows = cur.fetchall()
+            metrics.inc('freezam_db_rows_fetched_total', len(rows))
+            dimension = None
+            if len(rows) == 0:
+                cur.execute("SELECT max(dimension) FROM song_fingerprints")
+                dimension = cur.fetchone()[0]
+                if dimension is None:
+                    raise ValueError("There is no song in the database to index")
+        with metrics.timer('index_build'):
+            write(index_dir, generation, *_unpack_rows(rows, dimension), shard=shard)
+    return load(index_dir)
+
+def _unpack_rows(rows, dimension=None):
+    """ The song_id, window_center, fingerprint1 and fingerprint2 of every
+    window of the song_fingerprints rows, in order """
+    if len(rows) == 0:
+        return (_empty_delta(dimension)[name] for name in
+                ('song_id', 'window_center', 'fingerprint1', 'fingerprint2'))
+    song_id = np.repeat([row[0] for row in rows],
+                        [row[1] for row in rows]).astype(np.int64)
+    window_center = np.rint(np.concatenate(
+        [db.unpack_array(row[3]) for row in rows])).astype(np.int64)
+    fingerprint1 = np.concatenate([db.unpack_array(row[4]) for row in rows])
+    fingerprint2 = np.concatenate([db.unpack_array(row[5], row[2]) for row in rows])
+    return song_id, window_center, fingerprint1, fingerprint2
+
+def load(index_dir=None):
+    """ Memory-map the index saved in index_dir
+
+    Parameter:
+        + index_dir (str): the folder holding the index
+
+    Return:
+        + IndexArtifact, or None if there is no usable index in index_dir
+    """
+    index_dir = index_dir or DEFAULT_INDEX_DIR
+    try:
+        with open(_meta_path(index_dir)) as fh:
+            meta = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if meta.get('format') != INDEX_FORMAT:
+        is_logger.info("Index format changed, the index will be rebuilt")
+        return None
+
+    segment_dir = os.path.join(index_dir, meta['segment'])
+    arrays = {}
+    try:
+        for name in ('fingerprint2', 'centroid', 'song_id', 'window_center',
+                     'fingerprint1', 'fingerprint1_sorted', 'fingerprint1_order'):
+            # copy-on-write mapping: falconn wants a writable buffer but
+            # nothing is ever written back to the file
+            arrays[name] = np.load(os.path.join(segment_dir, name + '.npy'),
+                                   mmap_mode='c')
+    except OSError:
+        return None
+    if arrays['fingerprint2'].shape[0] != meta['num_points']:
+        return None
+
+    delta = _empty_delta(meta['dimension'])
+    tombstones = None
+    try:
+        # the delta segments are small, read them into memory in one piece
+        parts = [{name: np.load(os.path.join(index_dir, segment, name + '.npy'))
+                  for name in delta} for segment in meta['deltas']]
+        if meta['tombstones'] is not None:
+            tombstones = np.load(os.path.join(index_dir, meta['tombstones']))
+    except OSError:
+        return None
+    if len(parts) > 0:
+        delta = {name: np.concatenate([part[name] for part in parts])
+                 for name in delta}
+    return IndexArtifact(index_dir, meta, arrays, delta, tombstones)
+
+def _reuse_base(previous, artifact):
+    """ Give artifact the tables built over the base of previous (the LSH
+    table, the KD-tree) when both still share the same base segment, so
+    that adding delta segments or tombstones does not build them again """
+    if (previous is None or artifact is None
+            or previous.index_dir != artifact.index_dir
+            or previous.meta['segment'] != artifact.meta['segment']):
+        return artifact
+    for name in BASE_TABLES:
+        if getattr(artifact, name, None) is None and getattr(previous, name, None) is not None:
+            setattr(artifact, name, getattr(previous, name))
+    return artifact
+
+def catalog_generation():
+    """ The current generation of the catalog in the database """
+    with db.cursor() as cur:
+        return dbc.current_generation(cur)
+
+def ensure(index_dir=None, generation=None, shard=None, previous=None):
+    """ Load the index and rebuild it if it is missing or older than the
+    current catalog generation in the database
+
+    Parameters:
+        + index_dir (str): the folder holding the index
+        + generation (int): the current catalog generation, read from the
+        database when not given
+        + shard (tuple): (i, n) when index_dir holds one shard of the
+        catalog, see shard_dir
+        + previous (IndexArtifact): the index loaded so far, whose LSH
+        table and KD-tree are kept while the base segment is the same
+
+    Return:
+        + An IndexArtifact that matches the current catalog
+    """
+    artifact = load(index_dir)
+    if generation is None:
+        generation = catalog_generation()
+    if artifact is not None and artifact.generation == generation:
+        is_logger.info("Loaded index of generation %d", generation)
+        return _reuse_base(previous, artifact)
+    if artifact is not None:
+        artifact = update(index_dir, shard, previous)
+        if artifact is not None:
+            if needs_compaction(artifact):
+                compact_in_background(index_dir)
+            return artifact
+    is_logger.info("Index is missing or stale, rebuilding it")
+    return build(index_dir, shard)
+
+def write_delta(artifact, generation, song_id, window_center, fingerprint1,
+                fingerprint2, deleted):
+    """ Append the changes of the catalog to the index as a delta segment
+    and tombstones, without touching the base segment. The caller holds the
+    lock of the index folder.
+
+    Parameters:
+        + artifact (IndexArtifact): the index the changes apply to
+        + generation (int): the catalog generation after the changes
+        + song_id, window_center, fingerprint1, fingerprint2 (ndarray): the
+        windows of the added songs, as for write
+        + deleted: the song_ids deleted since artifact.generation
+
+    Return:
+        + meta (dict): the meta data written to meta.json
+    """
+    meta = dict(artifact.meta, generation=generation)
+    if len(song_id) > 0:
+        segment = 'delta-%d' % generation
+        segment_dir = os.path.join(artifact.index_dir, segment)
+        os.makedirs(segment_dir, exist_ok=True)
+        data = np.asarray(fingerprint2, dtype=np.float32) - artifact.centroid
+        np.save(os.path.join(segment_dir, 'fingerprint2.npy'), data.astype(np.float32))
+        np.save(os.path.join(segment_dir, 'song_id.npy'),
+                np.asarray(song_id, dtype=np.int64))
+        np.save(os.path.join(segment_dir, 'window_center.npy'),
+                np.asarray(window_center, dtype=np.int64))
+        np.save(os.path.join(segment_dir, 'fingerprint1.npy'),
+                np.asarray(fingerprint1, dtype=np.float32))
+        meta['deltas'] = meta['deltas'] + [segment]
+    tombstones = np.union1d(artifact.tombstones,
+                            np.asarray(deleted, dtype=np.int64)).astype(np.int64)
+    if len(tombstones) > len(artifact.tombstones):
+        meta['tombstones'] = 'tombstones-%d.npy' % generation
+        np.save(os.path.join(artifact.index_dir, meta['tombstones']), tombstones)
+    _write_meta(artifact.index_dir, meta)
+    is_logger.info("Index updated to generation %d: %d window(s) added, %d song(s) deleted",
+                   generation, len(song_id), len(deleted))
+    return meta
+
+def changes_since(cur, since, generation, shard=None):
+    """ The songs added and deleted since a generation, as logged in
+    catalog_changes
+
+    Parameters:
+        + cur: an open cursor of the database
+        + since (int): the generation the reader is at
+        + generation (int): the current generation
+        + shard (tuple): (i, n) to keep only the songs of one shard
+
+    Returns:
+        + added (list): the song_ids added and still in the catalog, sorted
+        + deleted (list): the song_ids deleted, sorted
+        or None when some of the changes were not logged
+    """
+    cur.execute("""SELECT generation, song_id, added FROM catalog_changes
+                   WHERE generation > %s""", [since])
+    changes = cur.fetchall()
+    metrics.inc('freezam_db_rows_fetched_total', len(changes))
+    logged = set(row[0] for row in changes)
+    if logged != set(range(since + 1, generation + 1)):
+        is_logger.info("Changes since generation %d are not all logged", since)
+        return None
+    changes = [row for row in changes if _in_shard(row[1], shard)]
+    deleted = sorted(set(row[1] for row in changes if not row[2]))
+    added = sorted(set(row[1] for row in changes if row[2]) - set(deleted))
+    return added, deleted
+
+def update(index_dir=None, shard=None, previous=None):
+    """ Bring the index up to the current catalog generation by reading
+    only the songs changed since it was written (see
+    dbconstruction.log_changes), so adding or deleting a song costs
+    O(song) instead of O(catalog)
+
+    Parameters:
+        + index_dir (str): the folder holding the index
+        + shard (tuple): (i, n) when index_dir holds one shard of the catalog
+        + previous (IndexArtifact): the index loaded so far; its LSH table
+        and KD-tree cover the unchanged base and are given to the result
+
+    Return:
+        + The updated IndexArtifact, or None when there is no index or the
+        changes are not all logged and the index has to be rebuilt
+    """
+    index_dir = index_dir or DEFAULT_INDEX_DIR
+    with _locked(index_dir):
+        artifact = load(index_dir)
+        if artifact is None:
+            return None
+        with db.cursor() as cur:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            generation = dbc.current_generation(cur)
+            if generation == artifact.generation:
+                return _reuse_base(previous, artifact)
+            changes = changes_since(cur, artifact.generation, generation, shard)
+            if changes is None:
+                return None
+            added, deleted = changes
+            cur.execute("""SELECT song_id, window_count, dimension, window_centers,
+                           fingerprint1, fingerprint2 FROM song_fingerprints
+                           WHERE song_id = ANY(%s) ORDER BY song_id""", [added])
+            rows = cur.fetchall()
+            metrics.inc('freezam_db_rows_fetched_total', len(rows))
+        write_delta(artifact, generation,
+                    *_unpack_rows(rows, artifact.meta['dimension']), deleted)
+    return _reuse_base(previous, load(index_dir))
+
+def needs_compaction(artifact):
+    """ Whether the delta segments or tombstones have grown large enough to
+    be merged into the base """
+    base_songs = len(artifact.song_offsets) - 1
+    return (len(artifact.delta['song_id']) > COMPACT_FRACTION*len(artifact.song_id)
+            or len(artifact.meta['deltas']) > MAX_DELTAS
+            or len(artifact.tombstones) > COMPACT_FRACTION*max(base_songs, 1))
+
+def compact(index_dir=None):
+    """ Merge the delta segments into a new base segment and drop the rows
+    of deleted songs. Everything is read from the index itself, the
+    database is not queried.
+
+    Parameter:
+        + index_dir (str): the folder holding the index
+
+    Return:
+        + The compacted IndexArtifact, or None if there is no index
+    """
+    index_dir = index_dir or DEFAULT_INDEX_DIR
+    with _locked(index_dir):
+        artifact = load(index_dir)
+        if artifact is None:
+            return None
+        if len(artifact.meta['deltas']) == 0 and len(artifact.tombstones) == 0:
+            return artifact
+        keep = artifact.alive(artifact.song_id)
+        keep_delta = artifact.alive(artifact.delta['song_id'])
+        song_id = np.concatenate((artifact.song_id[keep],
+                                  artifact.delta['song_id'][keep_delta]))
+        window_center = np.concatenate((artifact.window_center[keep],
+                                        artifact.delta['window_center'][keep_delta]))
+        fingerprint1 = np.concatenate((artifact.fingerprint1[keep],
+                                       artifact.delta['fingerprint1'][keep_delta]))
+        # write() centres the matrix again with the new centroid
+        fingerprint2 = np.concatenate((artifact.fingerprint2[keep],
+                                       artifact.delta['fingerprint2'][keep_delta]))
+        fingerprint2 += artifact.centroid
+        order = np.lexsort((window_center, song_id))
+        write(index_dir, artifact.generation, song_id[order], window_center[order],
+              fingerprint1[order], fingerprint2[order], artifact.meta.get('shard'))
+    is_logger.info("Index of generation %d compacted", artifact.generation)
+    return load(index_dir)
+
+_compacting = threading.Lock()  # at most one background compaction
+
+def compact_in_background(index_dir=None):
+    """ Run compact() in a background thread, unless one is already running
+
+    Return:
+        + the thread, or None if a compaction is already running
+    """
+    if not _compacting.acquire(blocking=False):
+        return None
+
+    def run():
+        try:
+            compact(index_dir)
+        except Exception:
+            is_logger.exception("Compaction of the index failed")
+        finally:
+            _compacting.release()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def kd_tree(artifact):
+    """ The KD-tree over the fingerprint2 of the index, used by the exact
+    (slow) search. It is built the first time it is needed and saved next to
+    the index, so later queries only pay for loading it.
+
+    Parameter:
+        + artifact (IndexArtifact): the loaded index
+
+    Return:
+        + sklearn.neighbors.KDTree over the centred fingerprint2 matrix
+    """
+    if getattr(artifact, 'kdtree', None) is not None:
+        return artifact.kdtree
+    path = os.path.join(artifact.index_dir, artifact.meta['segment'], 'kdtree.pkl')
+    try:
+        with open(path, 'rb') as fh:
+            tree = pickle.load(fh)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        from sklearn.neighbors import KDTree  # slow to import, rarely needed
+        tree = KDTree(artifact.fingerprint2, metric='euclidean')
+        with open(path + '.tmp', 'wb') as fh:
+            pickle.dump(tree, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        is_logger.info("KD-tree of generation %d saved", artifact.generation)
+    artifact.kdtree = tree
+    return tree
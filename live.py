@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import stat
+import time
+import socket
+import logging
+import numpy as np
+import conversion_and_read as cr
+import hash_index as hi
+import search_match as sm
+import metrics
+
+lv_logger = logging.getLogger('freezam.live')
+
+BLOCK_SECONDS = 0.1  # the most audio read from the stream at a time
+HORIZON = 30  # seconds of the stream the running scores are made of
+MIN_VOTES = {3: 3, 4: 8}  # votes a song needs before it is announced
+
+
+def open_stream(source):
+    """ Open the PCM stream to listen to
+
+    Parameter:
+        + source (str): '-' for stdin, the path of a Unix socket to connect
+        to, or the path of a FIFO or a file
+
+    Return:
+        + a binary file object
+    """
+    if source == '-':
+        return sys.stdin.buffer
+    if stat.S_ISSOCK(os.stat(source).st_mode):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(source)
+        return sock.makefile('rb')
+    return open(source, 'rb')
+
+def hash_scores(blocks, sampling_rate, index, horizon=HORIZON):
+    """ The running constellation search of a stream: the hashes of every
+    new second are looked up together with the ones of the last horizon
+    seconds
+
+    Parameters:
+        + blocks: an iterable of mono sample ndarrays
+        + sampling_rate (int): the sampling rate of the samples
+        + index (HashIndex): the loaded hash index
+        + horizon (int): the seconds of the stream kept in the scores
+
+    Return:
+        A generator of the list of (song_id, offset, votes, confidence)
+        given by hash_index.lookup, after every new batch of hashes; offset
+        is the frame of the song the stream started at
+    """
+    hashes = np.zeros(0, dtype=np.uint32)
+    offsets = np.zeros(0, dtype=np.int32)
+    for new_hashes, new_offsets in cr.stream_hashes(blocks, sampling_rate):
+        if len(new_hashes) == 0:
+            continue
+        hashes = np.concatenate((hashes, new_hashes))
+        offsets = np.concatenate((offsets, new_offsets))
+        recent = offsets > offsets.max() - horizon/cr.PEAK_HOP
+        hashes, offsets = hashes[recent], offsets[recent]
+        yield hi.lookup(index, hashes, offsets)
+
+def window_scores(blocks, sampling_rate, window_method, window_size, window_shift,
+                  m, centroid, query_obj, horizon=HORIZON, nfft=None):
+    """ The running LSH search of a stream: every window is fingerprinted
+    once the shift that completes it arrives, and its hits are voted with
+    the hits of the windows of the last horizon seconds
+
+    Parameters:
+        + blocks: an iterable of mono sample ndarrays
+        + sampling_rate (int): the sampling rate of the samples
+        + window_method, window_size, window_shift, m: the analysis
+        parameters used for the catalog
+        + centroid, query_obj: as given by search_match.setup
+        + horizon (int): the seconds of the stream kept in the scores
+        + nfft (int): the length of the FFT, see stream_spectrogram
+
+    Return:
+        A generator of the list of (song_id, offset, votes, confidence)
+        given by search_match.vote, after every new window; offset is the
+        window of the song aligned with the start of the stream
+    """
+    song_ids = np.zeros(0, dtype=np.int64)
+    window_centers = np.zeros(0, dtype=np.int64)
+    snip_centers = np.zeros(0)
+    seen = np.zeros(0)  # the centers of the windows of the stream
+    for spec, f, t in cr.stream_spectrogram(blocks, sampling_rate, window_method,
+                                            window_size, window_shift, 1, nfft):
+        fingerprint2 = cr.fingerprints_2(spec, m, f)
+        with metrics.timer('lsh_probe'):
+            hit_ids, hit_centers, windows = sm.lsh_hits(query_obj, centroid,
+                                                        fingerprint2)
+        song_ids = np.concatenate((song_ids, hit_ids))
+        window_centers = np.concatenate((window_centers, hit_centers))
+        snip_centers = np.concatenate((snip_centers, t[windows]))
+        seen = np.concatenate((seen, t))
+        recent = snip_centers > t[-1] - horizon
+        song_ids, window_centers = song_ids[recent], window_centers[recent]
+        snip_centers = snip_centers[recent]
+        seen = seen[seen > t[-1] - horizon]
+        with metrics.timer('vote'):
+            yield sm.vote(song_ids, window_centers, snip_centers, len(seen))
+
+def listen(source, window_size, shift, window_method, m, search=4,
+           analysis_rate=None, sampling_rate=None, channels=1, threshold=0.05,
+           min_votes=None, horizon=HORIZON, once=False, output=None):
+
+    """ Identify what a live PCM stream (a microphone, a radio...) plays.
+    The stream is fingerprinted as it arrives and the running scores are
+    updated every time new fingerprints are known; a song is announced as
+    soon as it has min_votes votes and its confidence reaches threshold,
+    without waiting for a whole snippet. Every song is announced once, the
+    next one when the stream moves to another song.
+
+    Parameters:
+        + source (str): '-' for stdin, a Unix socket or a FIFO, see open_stream
+        + window_size, shift, window_method, m: the analysis parameters used
+        for the catalog
+        + search (int): 4 for the constellation hashes, which answer within
+        a few seconds, or 3 for the LSH search, which needs window_size
+        seconds for the first window
+        + analysis_rate (int): the sampling rate the catalog was analyzed at
+        + sampling_rate (int): the sampling rate of the PCM, by default
+        analysis_rate or DECODE_RATE. The hashes do not depend on it; for
+        the LSH search it must be the rate of the catalog.
+        + channels (int): the number of interleaved channels of the PCM
+        + threshold (float): the confidence needed, the share of the hashes
+        (or windows) of the last horizon seconds that agree on the song
+        + min_votes (int): the votes needed, by default MIN_VOTES[search]
+        + horizon (int): the seconds of the stream kept in the scores, so an
+        old song fades out of them
+        + once (bool): stop after the first song
+        + output: the file the json lines are written to, stdout by default
+
+    Return:
+        + the number of songs announced
+    """
+    output = output or sys.stdout
+    min_votes = min_votes or MIN_VOTES[search]
+    sampling_rate = sampling_rate or analysis_rate or cr.DECODE_RATE
+    if search == 3 and sampling_rate != (analysis_rate or cr.DECODE_RATE):
+        raise ValueError("The LSH search needs the PCM at the rate of the catalog, %d Hz"
+                         % (analysis_rate or cr.DECODE_RATE))
+    if search == 4:
+        index = hi.ensure()
+        sm.load_songs(None, index.generation)
+    else:
+        centroid, query_obj = sm.setup()
+    stream = open_stream(source)
+    lv_logger.info("Listening to %s", source)
+
+    received = [0]  # samples read from the stream
+    started = time.time()
+
+    def counted(blocks):
+        for block in blocks:
+            received[0] += len(block)
+            yield block
+
+    blocks = counted(cr.pcm_blocks(stream, BLOCK_SECONDS, sampling_rate, channels))
+    if search == 4:
+        scores = hash_scores(blocks, sampling_rate, index, horizon)
+        seconds = cr.PEAK_HOP
+    else:
+        nfft = cr.fft_size(window_size*analysis_rate) if analysis_rate else None
+        scores = window_scores(blocks, sampling_rate, window_method, window_size,
+                               shift, m, centroid, query_obj, horizon, nfft)
+        seconds = 1
+    announced = None
+    count = 0
+    try:
+        for voted in scores:
+            if not voted:
+                continue
+            song_id, offset, votes, confidence = voted[0]
+            lv_logger.debug("Leading song %d with %d votes (%.3f)", song_id,
+                            votes, confidence)
+            if song_id == announced or votes < min_votes or confidence < threshold:
+                continue
+            titles = sm.retriv_titles([song_id])
+            if song_id not in titles:
+                continue  # deleted since the index was loaded
+            heard = received[0]/float(sampling_rate)
+            output.write(json.dumps({'song_id': song_id,
+                                     'title': titles[song_id],
+                                     'start': round(offset*seconds + heard, 2),
+                                     'votes': votes,
+                                     'score': round(confidence, 4),
+                                     'heard_sec': round(heard, 2),
+                                     'wall_sec': round(time.time() - started, 2)}) + '\n')
+            output.flush()
+            announced = song_id
+            count += 1
+            if once:
+                break
+    finally:
+        stream.close()
+    lv_logger.info("Stopped listening to %s after %d song(s)", source, count)
+    return count
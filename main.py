@@ -1,10 +1,11 @@
 import argparse  # used for designing user-friendly interface
 import logging   # used for setting up logging file
+import os
 import sys
-import dbmanagement as dbm
-import dbconstruction as dbc
-import conversion_and_read as cr
-import search_match as sm
+import metrics
+# Every subcommand imports its own modules when it runs: scipy, sklearn,
+# falconn and pydub take about a second to load, which --help, delete or
+# rm_duplicate do not need. See import_report.py.
 
 
 # Here will be the user interface design
@@ -44,6 +45,15 @@ logger.addHandler(ch)
 parser = argparse.ArgumentParser(description='Welcome to FreeZam !',
                                  epilog='Enjoy Freezam :-)')
 parser.add_argument("-vb","--verbose", action = "store_true", help = "change the log levels")
+parser.add_argument("--rate", type=int,
+                    default=int(os.environ.get('FREEZAM_ANALYSIS_RATE', 0)) or None,
+                    help="""resample the music to this rate before the analysis,
+                    e.g. 8000 or 11025; the catalog and the snippets must use
+                    the same rate (default: FREEZAM_ANALYSIS_RATE, or the rate
+                    of each file)""")
+parser.add_argument("--profile", action="store_true", help="""print the time
+                    spent in every stage and the counters of the command when
+                    it ends""")
 
 """ Several functions will be provided
 + Push music inventory into database
@@ -51,6 +61,8 @@ parser.add_argument("-vb","--verbose", action = "store_true", help = "change the
 + Remove a song from the current database
 + Identify a snippet with the current databse
 + Clean the duplicates in database
++ Serve identify requests with a warm index
++ Identify a live stream
 
 """
 subparsers = parser.add_subparsers(dest='subcommands')
@@ -60,6 +72,10 @@ push_parser = subparsers.add_parser('push_all', help="""push music inventory
                                     with fingerprints into database""")
 push_parser.add_argument('music_directory', type = str, help="""the physical location
                           of music inventory""")
+push_parser.add_argument('--workers', '-w', type=int, help="""the number of
+                         processes fingerprinting songs, default: number of cores""")
+push_parser.add_argument('--no-cache', action='store_true', help="""analyze
+                         every file again instead of reusing cached fingerprints""")
 
 # create the parser for the "add" command
 add_parser = subparsers.add_parser('add', help="""add a song to
@@ -74,11 +90,57 @@ add_parser.add_argument('--artist', "-a", help="""the artist of the song
 identify_parser = subparsers.add_parser('identify', help="""identify the
                                          snippet with the current database""")
 identify_parser.add_argument('snippet', type = str, help="the snippet you want to match")
-identify_parser.add_argument('--search', "-s", default=3, choices = [1,2,3], type = int,
+identify_parser.add_argument('--search', "-s", default=3, choices = [1,2,3,4], type = int,
                               help="""two searching options:
                               1 - rough search with one-dimensional signatures; 
                               2 - slow search with multi-dimensional signatures
-                              3 - LSH search with multi-dimensional signatures""" )
+                              3 - LSH search with multi-dimensional signatures
+                              4 - constellation hash search, the snippet may
+                              start anywhere in the song (not sharded)""" )
+identify_parser.add_argument('--shards', type=int, default=int(os.environ.get('FREEZAM_SHARDS', 0)),
+                             help="""search an index split by song_id across this
+                             many processes (default: FREEZAM_SHARDS, or a single index)""")
+identify_parser.add_argument('--compressed', type=int, nargs='?', const=4, metavar='BYTES',
+                             help="""with search 3, scan the fingerprints compressed
+                             to BYTES (1, 2, 4 or 8, default 4) per window instead of
+                             the LSH tables, for catalogs too large for memory (not sharded)""")
+identify_parser.add_argument('--no-rerank', action='store_true', help="""with
+                             --compressed, trust the approximate distances instead
+                             of checking the candidates with the exact fingerprints""")
+
+# create the parser for the "identify-batch" command
+batch_parser = subparsers.add_parser('identify-batch', help="""identify every
+                                     snippet of a folder or manifest, one json line each""")
+batch_parser.add_argument('source', type=str, help="""a folder of snippets, or a
+                          file listing one snippet path per line""")
+batch_parser.add_argument('--search', "-s", default=3, choices=[1,2,3], type=int,
+                          help='the search used, as for identify')
+batch_parser.add_argument('--workers', '-w', type=int, help="""the number of
+                          processes fingerprinting snippets, default: number of cores""")
+batch_parser.add_argument('--output', '-o', help='write the json lines to this file instead of stdout')
+batch_parser.add_argument('--shards', type=int, default=int(os.environ.get('FREEZAM_SHARDS', 0)),
+                          help="""search an index split by song_id across this
+                          many processes (default: FREEZAM_SHARDS, or a single index)""")
+# create the parser for the "listen" command
+listen_parser = subparsers.add_parser('listen', help="""identify what a live
+                                      PCM stream plays, as soon as possible""")
+listen_parser.add_argument('source', nargs='?', default='-', help="""raw 16 bit
+                           little-endian PCM: '-' for stdin (default), a FIFO or
+                           a Unix socket to connect to""")
+listen_parser.add_argument('--search', "-s", default=4, choices=[3, 4], type=int,
+                           help="""4 - constellation hashes, answer within seconds
+                           (default); 3 - LSH search, needs 10 s for the first window""")
+listen_parser.add_argument('--sample-rate', type=int, help="""the sampling rate of
+                           the PCM (default: --rate, or 44100)""")
+listen_parser.add_argument('--channels', type=int, default=1, help='the channels of the PCM')
+listen_parser.add_argument('--threshold', type=float, default=0.05, help="""the
+                           share of the recent hashes (or windows) that must agree
+                           on a song before it is announced""")
+listen_parser.add_argument('--min-votes', type=int, help="""the votes a song needs
+                           before it is announced (default: 8 hashes, or 3 windows)""")
+listen_parser.add_argument('--horizon', type=int, default=30, help="""the seconds
+                           of the stream the running scores are made of""")
+listen_parser.add_argument('--once', action='store_true', help='stop after the first song')
 # should be str b/c user input is recognized as str
 # create the parser for the "delete" command
 delete_parser = subparsers.add_parser('delete', help="""remove a song
@@ -91,6 +153,35 @@ delete_parser.add_argument('--artist', "-a", help="""the artist of the song
 rm_duplicate_parser = subparsers.add_parser('rm_duplicate', help="""clean the 
                                             duplicate of songs in the database""")
 
+# create the parser for the "migrate" command
+migrate_parser = subparsers.add_parser('migrate', help="""convert fingerprints
+                                       stored as NUMERIC rows to packed blobs""")
+migrate_parser.add_argument('--drop', action='store_true', help="""drop the old
+                            fingerprints table after the conversion""")
+
+# create the parser for the "compact" command
+compact_parser = subparsers.add_parser('compact', help="""merge the songs added
+                                       or deleted since the index was built into it""")
+
+# create the parser for the "serve" command
+serve_parser = subparsers.add_parser('serve', help="""keep the index in memory
+                                     and answer identify requests""")
+serve_parser.add_argument('--host', default='127.0.0.1', help='the local address to listen on')
+serve_parser.add_argument('--port', '-p', default=8765, type=int, help='the port to listen on')
+serve_parser.add_argument('--socket', help='listen on this Unix socket instead of host:port')
+serve_parser.add_argument('--shards', type=int, default=int(os.environ.get('FREEZAM_SHARDS', 0)),
+                          help="""split the index by song_id across this many
+                          processes (default: FREEZAM_SHARDS, or a single index)""")
+serve_parser.add_argument('--workers', '-w', type=int, help="""the number of
+                          processes fingerprinting snippets, default: number of cores""")
+serve_parser.add_argument('--compressed', type=int, nargs='?', const=4, metavar='BYTES',
+                          help="""keep the fingerprints compressed to BYTES (1, 2,
+                          4 or 8, default 4) per window instead of the LSH tables (not sharded)""")
+serve_parser.add_argument('--asyncio', action='store_true', help="""serve every
+                          request from one asyncio event loop instead of a thread
+                          per request, and read the titles of concurrent requests
+                          with one query""")
+
 args = parser.parse_args()
 
 if args.verbose:
@@ -100,60 +191,170 @@ else:
     ch.setLevel(logging.WARNING)
 
 if args.subcommands == 'push_all':
-    
+    import dbmanagement as dbm
+    import dbconstruction as dbc
+
     window_size = 10
     shift = 1
     window_method = 'hanning'
     m = 8
     
     dbc.create_table()
-    dbm.push_all(args.music_directory, window_size, shift, window_method, m)
+    dbm.push_all(args.music_directory, window_size, shift, window_method, m,
+                 workers=args.workers, analysis_rate=args.rate,
+                 use_cache=not args.no_cache)
     
 if args.subcommands == 'add':
-    
+    import dbmanagement as dbm
+    import fingerprint_cache as fc
+
     window_size = 10
     shift = 1
     window_method = 'hanning'
     m = 8
     
-    song_title, artist_name, fingerprint1, fingerprint2, t = cr.single_analyzer(args.file_path, 
-                                                        window_method, window_size, shift, m)
+    song_title, artist_name, fingerprint1, fingerprint2, t, hashes = fc.cached_analyzer(
+                                                        args.file_path, window_method,
+                                                        window_size, shift, m,
+                                                        analysis_rate=args.rate,
+                                                        with_hashes=True)
+    fc.evict()
     # show all arguments into a dict called vars
     var = vars(parser.parse_args())
     if var["title"] is None and var["artist"] is None:
-        dbm.add(song_title, artist_name, fingerprint1, fingerprint2, t)
+        new_id = dbm.add(song_title, artist_name, fingerprint1, fingerprint2, t,
+                         hashes=hashes)
     if var["title"] is not None and var["artist"] is not None:
-        dbm.add(args.song_title, args.artist_name, fingerprint1, fingerprint2, t)
+        new_id = dbm.add(args.song_title, args.artist_name, fingerprint1, fingerprint2, t,
+                         hashes=hashes)
     if var["title"] is not None and var["artist"] is None:
-        dbm.add(args.song_title, artist_name, fingerprint1, fingerprint2, t)
+        new_id = dbm.add(args.song_title, artist_name, fingerprint1, fingerprint2, t,
+                         hashes=hashes)
     if var["title"] is None and var["artist"] is not None:
-        dbm.add(song_title, args.artist_name, fingerprint1, fingerprint2, t)
-    print("Sent the song to database successfully!")
+        new_id = dbm.add(song_title, args.artist_name, fingerprint1, fingerprint2, t,
+                         hashes=hashes)
+    if new_id is None:
+        print("The audio of this song is already in the database")
+    else:
+        print("Sent the song to database successfully!")
 
 if args.subcommands == 'rm_duplicate':
+    import dbmanagement as dbm
     dbm.remove_duplicates()
     print("Database is very neat now!")
     
 if args.subcommands == 'identify':
+    import conversion_and_read as cr
+    import search_match as sm
+
     window_size = 10
     shift = 1
     window_method = 'hanning'
     m = 8
     
-    song_title, artist_name, fingerprint1, fingerprint2, t = cr.single_analyzer(args.snippet, 
-                                                        window_method, window_size, shift, m)
-    var = vars(parser.parse_args())
-    if var["search"] == 2:
-        print(sm.search_match2(fingerprint2,3))
-    elif var["search"] == 1:
-        print(sm.search_match_1(fingerprint1))
+    if args.search == 4:
+        hashes, offsets = cr.constellation(args.snippet, analysis_rate=args.rate)
+        print(sm.hash_rank(hashes, offsets) or
+              "We tried hard but found nothing in current inventory")
+    else:
+        song_title, artist_name, fingerprint1, fingerprint2, t = cr.single_analyzer(args.snippet, 
+                                                            window_method, window_size, shift, m,
+                                                            analysis_rate=args.rate)
+        var = vars(parser.parse_args())
+        if args.compressed and var["search"] == 3:
+            artifact, pq = sm.setup_pq(subvectors=args.compressed)
+            print(sm.pq_rank(artifact, pq, fingerprint2, t, rerank=not args.no_rerank) or
+                  "We tried hard but found nothing in current inventory")
+        elif args.shards:
+            import shards
+            with shards.ShardCoordinator(args.shards) as coordinator:
+                if var["search"] == 2:
+                    predict = coordinator.knn_predict(fingerprint2, 3)
+                    print(sm.retriv_name(int(predict)) if predict is not None else None)
+                elif var["search"] == 1:
+                    matched_sid = coordinator.rough_match_ids(fingerprint1)
+                    titles = sm.retriv_titles(matched_sid) if len(matched_sid) else {}
+                    print([titles[sid] for sid in matched_sid if sid in titles] or None)
+                else:
+                    print(coordinator.lsh_rank(fingerprint2, t) or
+                          "We tried hard but found nothing in current inventory")
+        elif var["search"] == 2:
+            print(sm.search_match2(fingerprint2,3))
+        elif var["search"] == 1:
+            print(sm.search_match_1(fingerprint1))
+        else:
+            centroid, query_obj = sm.setup()
+            sm.lsh_search(query_obj,centroid,fingerprint2,t)
+
+if args.subcommands == 'identify-batch':
+    import identify_batch as ib
+
+    window_size = 10
+    shift = 1
+    window_method = 'hanning'
+    m = 8
+
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            ib.identify_batch(args.source, window_size, shift, window_method, m,
+                              search=args.search, workers=args.workers,
+                              output=output, analysis_rate=args.rate,
+                              n_shards=args.shards)
     else:
-        centroid, query_obj = sm.setup()
-        sm.lsh_search(query_obj,centroid,fingerprint2)
+        ib.identify_batch(args.source, window_size, shift, window_method, m,
+                          search=args.search, workers=args.workers,
+                          analysis_rate=args.rate, n_shards=args.shards)
+
+if args.subcommands == 'listen':
+    import live
+
+    window_size = 10
+    shift = 1
+    window_method = 'hanning'
+    m = 8
+
+    live.listen(args.source, window_size, shift, window_method, m,
+                search=args.search, analysis_rate=args.rate,
+                sampling_rate=args.sample_rate, channels=args.channels,
+                threshold=args.threshold, min_votes=args.min_votes,
+                horizon=args.horizon, once=args.once)
 
 if args.subcommands == 'delete':
+    import dbmanagement as dbm
     try:
         dbm.delete(args.title, args.artist)
         print("Delete the song successfully!")
     except:
         print("Oops, something went wrong...")
+
+if args.subcommands == 'migrate':
+    import dbconstruction as dbc
+    migrated = dbc.migrate_fingerprints(drop=args.drop)
+    print("Converted the fingerprints of %d song(s)" % migrated)
+
+if args.subcommands == 'compact':
+    import index_store as ist
+    artifact = ist.compact()
+    if artifact is None:
+        print("There is no index to compact yet")
+    else:
+        print("Index of generation %d compacted" % artifact.generation)
+
+if args.subcommands == 'serve':
+    if args.asyncio:
+        import async_server as server
+    else:
+        import server
+
+    window_size = 10
+    shift = 1
+    window_method = 'hanning'
+    m = 8
+
+    server.serve(window_size, shift, window_method, m, host=args.host,
+                 port=args.port, socket_path=args.socket, workers=args.workers,
+                 analysis_rate=args.rate, n_shards=args.shards,
+                 subvectors=args.compressed)
+
+if args.profile:
+    sys.stderr.write(metrics.summary())
@@ -0,0 +1,201 @@
+import os
+import time
+import bisect
+import threading
+import contextlib
+
+# Timers, counters and histograms shared by the modules of Freezam.
+# Every operation takes the lock of the module, so threads of the server
+# can record concurrently. Worker processes record into their own copy and
+# ship it to the parent with run_collected / merge.
+
+# the upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    'freezam_stage_seconds': 'Time spent in every stage of the analysis and the search',
+    'freezam_db_transactions_total': 'Transactions run on the database, one round-trip or more each',
+    'freezam_db_rows_fetched_total': 'Rows read from the database',
+    'freezam_db_songs_written_total': 'Songs written to the database',
+    'freezam_windows_fingerprinted_total': 'Windows turned into fingerprints',
+    'freezam_rough_candidates_total': 'Index windows within the tolerance of the rough search',
+    'freezam_knn_candidates_total': 'Index windows returned by the KD-tree of the slow search',
+    'freezam_lsh_candidates_total': 'Index windows probed by the LSH search',
+    'freezam_pq_candidates_total': 'Index windows scored closest by the compressed search',
+    'freezam_hash_candidates_total': 'Index hashes matched by the constellation search',
+    'freezam_identify_requests_total': 'Identify requests answered by the server',
+}
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., +Inf count], sum, max
+_pid = os.getpid()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def _check_pid():
+    """ A forked process starts with empty metrics, what it inherited was
+    recorded (and is reported) by its parent. Called with the lock held. """
+    global _pid
+    if _pid != os.getpid():
+        _counters.clear()
+        _histograms.clear()
+        _pid = os.getpid()
+
+def inc(name, value=1, **labels):
+    """ Add value to a counter
+
+    Parameters:
+        + name (str): the name of the counter, ending in _total
+        + value (number): the increment
+        + labels: the labels of the counter, e.g. status='ok'
+    """
+    with _lock:
+        _check_pid()
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, value, **labels):
+    """ Record one observation in a histogram
+
+    Parameters:
+        + name (str): the name of the histogram
+        + value (float): the observed value, in seconds for timers
+        + labels: the labels of the histogram, e.g. stage='decode'
+    """
+    with _lock:
+        _check_pid()
+        key = _key(name, labels)
+        if key not in _histograms:
+            _histograms[key] = [[0]*(len(BUCKETS) + 1), 0.0, 0.0]
+        histogram = _histograms[key]
+        histogram[0][bisect.bisect_left(BUCKETS, value)] += 1
+        histogram[1] += value
+        histogram[2] = max(histogram[2], value)
+
+@contextlib.contextmanager
+def timer(stage):
+    """ Time the block as one observation of freezam_stage_seconds
+
+        with metrics.timer('spectrogram'):
+            ...
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('freezam_stage_seconds', time.perf_counter() - start, stage=stage)
+
+def _copy():
+    return {'counters': dict(_counters),
+            'histograms': {key: [list(h[0]), h[1], h[2]]
+                           for key, h in _histograms.items()}}
+
+def snapshot():
+    """ A copy of every metric, that can be pickled and merged elsewhere """
+    with _lock:
+        _check_pid()
+        return _copy()
+
+def reset():
+    """ Forget every metric """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+def drain():
+    """ snapshot() and reset() at once, so nothing is counted twice """
+    with _lock:
+        _check_pid()
+        drained = _copy()
+        _counters.clear()
+        _histograms.clear()
+    return drained
+
+def merge(other):
+    """ Add the metrics of another process, as given by drain() """
+    if not other:
+        return
+    with _lock:
+        _check_pid()
+        for key, value in other['counters'].items():
+            _counters[key] = _counters.get(key, 0) + value
+        for key, (buckets, total, largest) in other['histograms'].items():
+            if key not in _histograms:
+                _histograms[key] = [[0]*(len(BUCKETS) + 1), 0.0, 0.0]
+            histogram = _histograms[key]
+            histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+            histogram[1] += total
+            histogram[2] = max(histogram[2], largest)
+
+def run_collected(function, *args):
+    """ Call function(*args) in a worker process and return its result
+    together with the metrics it recorded, for the parent to merge
+
+        result, recorded = pool.submit(metrics.run_collected, f, x).result()
+        metrics.merge(recorded)
+    """
+    drain()  # whatever an earlier task of the worker left behind
+    result = function(*args)
+    return result, drain()
+
+def _labels_text(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, value) for name, value in labels) + '}'
+
+def prometheus_text():
+    """ Every metric in the Prometheus text exposition format
+
+    Return:
+        + the text (str) served on /metrics
+    """
+    current = snapshot()
+    lines = []
+    for name in sorted(set(key[0] for key in current['counters'])):
+        lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+        lines.append('# TYPE %s counter' % name)
+        for (metric, labels), value in sorted(current['counters'].items()):
+            if metric == name:
+                lines.append('%s%s %s' % (name, _labels_text(labels), value))
+    for name in sorted(set(key[0] for key in current['histograms'])):
+        lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+        lines.append('# TYPE %s histogram' % name)
+        for (metric, labels), (buckets, total, _) in sorted(current['histograms'].items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), buckets):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _labels_text(labels, [('le', bound)]),
+                                                 cumulative))
+            lines.append('%s_sum%s %r' % (name, _labels_text(labels), total))
+            lines.append('%s_count%s %d' % (name, _labels_text(labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+def summary():
+    """ A table of the stage timers and the counters, for --profile
+
+    Return:
+        + the table (str)
+    """
+    current = snapshot()
+    lines = ['%-28s %8s %11s %10s %10s' % ('stage', 'calls', 'total (s)',
+                                            'mean (ms)', 'max (ms)')]
+    stages = sorted(((dict(labels).get('stage', name), h)
+                     for (name, labels), h in current['histograms'].items()),
+                    key=lambda item: -item[1][1])
+    for stage, (buckets, total, largest) in stages:
+        calls = sum(buckets)
+        lines.append('%-28s %8d %11.3f %10.2f %10.2f' % (stage, calls, total,
+                     total*1000/max(calls, 1), largest*1000))
+    if current['counters']:
+        lines.append('')
+        lines.append('%-45s %12s' % ('counter', 'value'))
+    for (name, labels), value in sorted(current['counters'].items()):
+        lines.append('%-45s %12d' % (name + _labels_text(labels), value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,241 @@
+import os
+import json
+import shutil
+import logging
+import warnings
+import numpy as np
+from scipy.cluster.vq import kmeans2, vq
+import index_store as ist
+import metrics
+
+pq_logger = logging.getLogger('freezam.pq_index')
+
+PQ_FORMAT = 1  # bump when the on-disk layout changes
+SUBVECTORS = 4  # bytes per window; 8 dimensions in pairs
+CENTROIDS = 256  # per sub-vector, so every code fits in a byte
+TRAIN_ROWS = 100000  # the codebooks are learned on a sample of the windows
+CANDIDATES = 64  # rows kept per snippet window by the approximate distance
+CHUNK = 1 << 18  # rows scored at once, bounds the temporary memory
+
+
+class PQIndex:
+    """ The fingerprint2 of the base of an index compressed by product
+    quantization: every row is split into sub-vectors and each of them is
+    replaced by the byte naming the nearest of CENTROIDS centroids. With
+    as many sub-vectors as dimensions it is a (learned) scalar quantization.
+
+    Attributes:
+        + meta (dict): the content of meta.json (format, segment of the base
+        it encodes, number of sub-vectors ...)
+        + codebooks (ndarray): subvectors x centroids x (dimension/subvectors)
+        float32 centroids
+        + codes (ndarray): n x subvectors uint8 codes, memory-mapped, in the
+        row order of the base
+    """
+
+    def __init__(self, directory, meta, arrays):
+        self.directory = directory
+        self.meta = meta
+        self.segment = meta['segment']
+        self.codebooks = arrays['codebooks']
+        self.codes = arrays['codes']
+
+    @property
+    def nbytes(self):
+        """ The size of the codes and the codebooks """
+        return int(self.codes.nbytes + self.codebooks.nbytes)
+
+
+def pq_dir(index_dir=None):
+    """ The folder of the compressed index, inside the folder of the index """
+    return os.path.join(index_dir or ist.DEFAULT_INDEX_DIR, 'pq')
+
+def _split(data, subvectors):
+    """ View n x d rows as n x subvectors x (d/subvectors) """
+    data = np.asarray(data, dtype=np.float32)
+    if data.shape[1] % subvectors != 0:
+        raise ValueError("The dimension %d is not a multiple of %d sub-vectors"
+                         % (data.shape[1], subvectors))
+    return data.reshape(len(data), subvectors, -1)
+
+def train(data, subvectors=SUBVECTORS, seed=0):
+    """ Learn the centroids of every sub-vector with k-means
+
+    Parameters:
+        + data (ndarray): nxd matrix of centred fingerprint2
+        + subvectors (int): the number of sub-vectors, a divisor of d
+        + seed (int): the seed of the sample and of k-means
+
+    Return:
+        + codebooks (ndarray): subvectors x k x (d/subvectors), k is
+        CENTROIDS or the number of training rows if there are fewer
+    """
+    rng = np.random.RandomState(seed)
+    if len(data) > TRAIN_ROWS:
+        data = np.asarray(data)[np.sort(rng.choice(len(data), TRAIN_ROWS, replace=False))]
+    parts = _split(data, subvectors)
+    k = max(min(CENTROIDS, len(parts)), 1)
+    codebooks = np.zeros((subvectors, k, parts.shape[2]), dtype=np.float32)
+    if len(parts) == 0:  # an empty shard
+        return codebooks
+    with warnings.catch_warnings():
+        # repeated windows (silence) leave some clusters empty, harmless
+        warnings.simplefilter('ignore', UserWarning)
+        for j in range(subvectors):
+            codebooks[j], _ = kmeans2(parts[:, j], k, iter=20, minit='++', seed=rng)
+    return codebooks
+
+def encode(codebooks, data):
+    """ The code of every row: the nearest centroid of every sub-vector
+
+    Parameters:
+        + codebooks (ndarray): as given by train
+        + data (ndarray): nxd matrix of centred fingerprint2
+
+    Return:
+        + codes (ndarray): n x subvectors uint8
+    """
+    subvectors = len(codebooks)
+    codes = np.zeros((len(data), subvectors), dtype=np.uint8)
+    for start in range(0, len(data), CHUNK):
+        parts = _split(data[start:start + CHUNK], subvectors)
+        for j in range(subvectors):
+            codes[start:start + len(parts), j], _ = vq(parts[:, j], codebooks[j])
+    return codes
+
+def build(artifact, subvectors=SUBVECTORS):
+    """ Compress the fingerprint2 of the base of an index and save the codes
+    next to it. The deltas are not compressed, they are searched exactly.
+
+    Parameters:
+        + artifact (IndexArtifact): the loaded index
+        + subvectors (int): the number of sub-vectors (bytes) of every row
+
+    Return:
+        + PQIndex
+    """
+    directory = pq_dir(artifact.index_dir)
+    with ist._locked(directory):
+        with metrics.timer('pq_build'):
+            codebooks = train(artifact.fingerprint2, subvectors)
+            codes = encode(codebooks, artifact.fingerprint2)
+        name = '%s-pq%d' % (artifact.meta['segment'], subvectors)
+        segment_dir = os.path.join(directory, name)
+        os.makedirs(segment_dir, exist_ok=True)
+        np.save(os.path.join(segment_dir, 'codebooks.npy'), codebooks)
+        np.save(os.path.join(segment_dir, 'codes.npy'), codes)
+        meta = {'format': PQ_FORMAT,
+                'segment': artifact.meta['segment'],
+                'pq_segment': name,
+                'subvectors': subvectors,
+                'centroids': int(codebooks.shape[1]),
+                'num_points': int(len(codes))}
+        tmp_path = os.path.join(directory, 'meta.json.tmp')
+        with open(tmp_path, 'w') as fh:
+            json.dump(meta, fh, indent=2)
+        os.replace(tmp_path, os.path.join(directory, 'meta.json'))
+        for other in os.listdir(directory):
+            if other.startswith('gen-') and other != name:
+                shutil.rmtree(os.path.join(directory, other), ignore_errors=True)
+    pq_logger.info("Compressed %d rows of %s into %d bytes each", len(codes),
+                   artifact.meta['segment'], subvectors)
+    return load(artifact.index_dir)
+
+def load(index_dir=None):
+    """ Memory-map the compressed index saved in index_dir
+
+    Parameter:
+        + index_dir (str): the folder holding the index
+
+    Return:
+        + PQIndex, or None if there is no usable compressed index
+    """
+    directory = pq_dir(index_dir)
+    try:
+        with open(os.path.join(directory, 'meta.json')) as fh:
+            meta = json.load(fh)
+        if meta.get('format') != PQ_FORMAT:
+            return None
+        segment_dir = os.path.join(directory, meta['pq_segment'])
+        arrays = {'codebooks': np.load(os.path.join(segment_dir, 'codebooks.npy')),
+                  'codes': np.load(os.path.join(segment_dir, 'codes.npy'), mmap_mode='r')}
+    except (OSError, ValueError, KeyError):
+        return None
+    if len(arrays['codes']) != meta['num_points']:
+        return None
+    return PQIndex(directory, meta, arrays)
+
+def ensure(artifact, subvectors=SUBVECTORS):
+    """ Load the compressed index of the base of artifact, compressing it
+    again if it is missing, encodes another base (after a build or a
+    compaction) or uses another number of sub-vectors
+
+    Parameters:
+        + artifact (IndexArtifact): the loaded index
+        + subvectors (int): the number of sub-vectors of every row
+
+    Return:
+        + A PQIndex that matches the base of artifact
+    """
+    index = load(artifact.index_dir)
+    if (index is not None and index.segment == artifact.meta['segment'] and
+            index.meta['subvectors'] == subvectors):
+        return index
+    pq_logger.info("Compressed index is missing or stale, rebuilding it")
+    return build(artifact, subvectors)
+
+def distance_tables(codebooks, queries, inner_product=False):
+    """ The distance of every query sub-vector to every centroid, so the
+    distance to a code is the sum of subvectors table entries
+
+    Parameters:
+        + codebooks (ndarray): as given by train
+        + queries (ndarray): qxd matrix of centred snippet fingerprint2
+        + inner_product (bool): use the negative inner product instead of the
+        squared euclidean distance, like the LSH table of the index
+
+    Return:
+        + tables (ndarray): q x subvectors x centroids float32
+    """
+    parts = _split(queries, len(codebooks))[:, :, None, :]
+    if inner_product:
+        return -np.sum(parts*codebooks[None], axis=3)
+    return np.sum((parts - codebooks[None])**2, axis=3)
+
+def search(index, queries, candidates=CANDIDATES, inner_product=False):
+    """ Asymmetric distance search: the queries stay exact, the rows are
+    their codes. Every row is scored with table lookups only.
+
+    Parameters:
+        + index (PQIndex): the compressed index
+        + queries (ndarray): qxd matrix of centred snippet fingerprint2
+        + candidates (int): the number of nearest rows kept per query
+        + inner_product (bool): see distance_tables
+
+    Returns:
+        + windows (ndarray): the query of every candidate
+        + rows (ndarray): the base row of every candidate
+        + distance (ndarray): the approximate distance of every candidate
+    """
+    tables = distance_tables(index.codebooks, queries, inner_product)
+    subvectors = len(index.codebooks)
+    found_rows, found_distance = [], []
+    for start in range(0, len(index.codes), CHUNK):
+        block = np.asarray(index.codes[start:start + CHUNK])
+        distance = tables[:, 0, block[:, 0]]
+        for j in range(1, subvectors):
+            distance += tables[:, j, block[:, j]]
+        keep = min(candidates, distance.shape[1])
+        best = np.argpartition(distance, keep - 1, axis=1)[:, :keep]
+        found_rows.append(best + start)
+        found_distance.append(np.take_along_axis(distance, best, axis=1))
+    if not found_rows:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=np.float32)
+    rows = np.concatenate(found_rows, axis=1)
+    distance = np.concatenate(found_distance, axis=1)
+    keep = min(candidates, distance.shape[1])
+    best = np.argpartition(distance, keep - 1, axis=1)[:, :keep]
+    windows = np.repeat(np.arange(len(queries)), keep)
+    return (windows, np.take_along_axis(rows, best, axis=1).ravel(),
+            np.take_along_axis(distance, best, axis=1).ravel())
@@ -1,42 +1,21 @@
 import falconn # set up locality-sensitive hashing
+import time
 import logging
-import psycopg2 # database connection
 import numpy as np 
-import credentials as c # database username and password
-from functools import reduce
-from sklearn.neighbors import KNeighborsClassifier
+import database as db # shared connection pool
+import index_store as ist # on-disk fingerprint index
+import hash_index as hi # inverted index of the constellation hashes
+import pq_index as pqi # product-quantized fingerprint2
+import song_table as st # titles of the catalog, kept with the index
+import conversion_and_read as cr
+import metrics # stage timers and counters
 
 sm_logger = logging.getLogger('freezam.search_match')
 
-def retriv_fgp1(i, snip_fgp1):
-    """Retrive the fingerprint1 from database, clean the database output
-    properly and then calculate the distance between snippet fingerprint1 and
-    the whole song fingerprint1
-    
-    Parameters:
-        + i (int): The index of the song in database
-        + snip_fgp1 (numeric): The fingerprint1 of the snippet
-    
-    Returns:
-        A list that contain the absolute distance between snip_fgp1 and fgp1
-        of the song with song_id i in the database
-    """
-    
-    conn = psycopg2.connect(host="sculptor.stat.cmu.edu", database=c.DB_USER,
-                            user=c.DB_USER, password=c.DB_PASSWORD)
-    cur = conn.cursor()
-    sql_command = "SELECT fingerprint1 FROM fingerprints WHERE song_id = %s"
-    cur.execute(sql_command, [i])
-    fgp1 = cur.fetchall()
-    conn.close()
-    
-    fgp1 = reduce(np.append, fgp1)
-    for i in range(len(fgp1)):
-        fgp1[i] = float(fgp1[i])
-    distance1 = abs(snip_fgp1-fgp1)
-    sm_logger.info("Distance has been calculated")
-    return distance1   
-    
+# the squared distance within which a window of the index matches a
+# snippet window, for the LSH and the compressed searches
+NEAR_TOLERANCE = 10**(-2)
+
 def retriv_name(i):
     
     """ Rretrive the name of the matched song
@@ -47,17 +26,158 @@ def retriv_name(i):
     Return:
         The matched song name in the database
     """
-    conn = psycopg2.connect(host="sculptor.stat.cmu.edu", database=c.DB_USER,
-                            user=c.DB_USER, password=c.DB_PASSWORD)
-    cur = conn.cursor()
-    sql_command = "SELECT song_title FROM songs WHERE song_id = %s"
-    cur.execute(sql_command, [i])
-    name = cur.fetchall()
-    conn.close()
-    name = reduce(np.append, name[0])
+    name = retriv_titles([i])[i]
     sm_logger.info("Retrived name successfully")
     return name
     
+_index = None  # the index used by the rough and slow searches
+_checked = 0.0  # when the catalog generation of _index was last read
+_songs = None  # the song table of the catalog, see load_songs
+
+def load_index(index_dir=None, recheck=False):
+    """ The on-disk index of the current catalog, loaded once per process
+    and reloaded (or rebuilt) only when the catalog generation changes. The
+    generation is read from the database at most every
+    index_store.GENERATION_TTL seconds, not on every query.
+
+    Parameters:
+        + index_dir (str): the folder holding the index
+        + recheck (bool): read the generation now, e.g. after a lookup
+        found nothing in an index that may have just gone stale
+
+    Return:
+        + An IndexArtifact that matches the current catalog
+    """
+    global _index, _checked
+    with metrics.timer('index_load'):
+        loaded = _index is not None and index_dir in (None, _index.index_dir)
+        if loaded and not recheck and time.monotonic() - _checked < ist.GENERATION_TTL:
+            return _index
+        generation = ist.catalog_generation()
+        _checked = time.monotonic()
+        if loaded and _index.generation == generation:
+            return _index
+        _index = ist.ensure(index_dir, generation, previous=_index if loaded else None)
+        load_songs(index_dir, generation)
+    return _index
+
+def load_songs(index_dir=None, generation=None):
+    """ The song table of the current catalog, loaded with the index and
+    refreshed when the catalog generation changes, so the titles of the
+    results are read from memory instead of the database
+
+    Parameters:
+        + index_dir (str): the folder holding the index
+        + generation (int): the current catalog generation, read from the
+        database when not given
+
+    Return:
+        + A SongTable that matches the current catalog
+    """
+    global _songs
+    if generation is None:
+        generation = ist.catalog_generation()
+    if _songs is None or _songs.generation != generation:
+        _songs = st.ensure(index_dir, generation)
+    return _songs
+
+def rough_counts(artifact, snip_fgp1, tolerance):
+    """ Count, for every song of the index, the windows whose fingerprint1 is
+    within tolerance of the snippet fingerprint1, using range lookups on the
+    sorted fingerprint1 array instead of a scan of every song. The small
+    delta segments are scanned directly and deleted songs count no match.
+
+    Parameters:
+        + artifact (IndexArtifact): the loaded index
+        + snip_fgp1: the fingerprint1 of the snippet, a number or an array
+        with one value per snippet window
+        + tolerance (float): the largest absolute distance counted as a match
+
+    Returns:
+        + matching_cnt (ndarray): the number of matches of every song, in the
+        order of artifact.song_ids
+        + window_num (ndarray): the number of windows of every song
+    """
+    matching_cnt, window_num = rough_counts_batch(artifact, [snip_fgp1], tolerance)
+    return matching_cnt[0], window_num[0]
+
+def rough_counts_batch(artifact, snip_fgp1s, tolerance):
+    """ rough_counts of several snippets at once: the windows of all the
+    snippets are looked up together and the matches counted per snippet
+
+    Parameters:
+        + artifact (IndexArtifact): the loaded index
+        + snip_fgp1s: a list of snippet fingerprint1
+        + tolerance (float): the largest absolute distance counted as a match
+
+    Returns:
+        + matching_cnt (ndarray): snippets x songs, the number of matches
+        + window_num (ndarray): snippets x songs, the number of windows of
+        every song times the number of windows of the snippet
+    """
+    parts = [np.atleast_1d(np.asarray(fgp1, dtype=np.float64)) for fgp1 in snip_fgp1s]
+    sizes = np.array([len(part) for part in parts])
+    queries = np.concatenate(parts)
+    snippet = np.repeat(np.arange(len(parts)), sizes)
+    # bounds in the dtype of the index, or numpy would copy the whole array
+    lower = (queries - tolerance).astype(artifact.fingerprint1_sorted.dtype)
+    upper = (queries + tolerance).astype(artifact.fingerprint1_sorted.dtype)
+    lo = np.searchsorted(artifact.fingerprint1_sorted, lower, 'left')
+    hi = np.searchsorted(artifact.fingerprint1_sorted, upper, 'right')
+    hit_rows = np.concatenate([artifact.fingerprint1_order[l:h]
+                               for l, h in zip(lo, hi)] or [np.zeros(0, dtype=np.int64)])
+    hit_snippet = np.repeat(snippet, hi - lo)
+    metrics.inc('freezam_rough_candidates_total', len(hit_rows))
+    offsets = artifact.song_offsets
+    n_songs = len(offsets) - 1
+    # rows of a song are contiguous, so the song of a row is a range lookup
+    hit_song = np.searchsorted(offsets, hit_rows, 'right') - 1
+    matching_cnt = np.bincount(hit_snippet*n_songs + hit_song,
+                               minlength=len(parts)*n_songs).reshape(len(parts), n_songs)
+    window_num = np.diff(offsets)
+
+    delta_ids, delta_song = np.unique(artifact.delta['song_id'], return_inverse=True)
+    if len(delta_ids) > 0:
+        near = np.abs(artifact.delta['fingerprint1'][None, :] -
+                      queries[:, None]) <= tolerance
+        # the matches of every delta row, per snippet
+        matching_cnt = np.concatenate((matching_cnt, np.stack([np.bincount(
+            delta_song, weights=part.sum(axis=0), minlength=len(delta_ids)).astype(np.int64)
+            for part in np.split(near, np.cumsum(sizes)[:-1])])), axis=1)
+        window_num = np.concatenate((window_num, np.bincount(delta_song)))
+    if len(artifact.tombstones) > 0:
+        matching_cnt[:, ~artifact.alive(artifact.song_ids)] = 0
+    return matching_cnt, window_num[None, :] * sizes[:, None]
+
+def rough_match_ids(artifact, snip_fgp1):
+    """ The song_ids of the index matched by the rough search
+
+    Parameters:
+        + artifact (IndexArtifact): the loaded index
+        + snip_fgp1: the fingerprint1 of the snippet
+
+    Return:
+        + the song_ids with more than 10% of their windows within the
+        tolerance of the snippet
+    """
+    return rough_match_ids_batch(artifact, [snip_fgp1])[0]
+
+def rough_match_ids_batch(artifact, snip_fgp1s):
+    """ rough_match_ids of several snippets, counted with one lookup of all
+    their windows (see rough_counts_batch)
+
+    Return:
+        + a list with the matched song_ids of every snippet
+    """
+    tolerance = 10**(-3)  # this is the default tolerance level, tuned
+    with metrics.timer('rough_search'):
+        matching_cnt, window_num = rough_counts_batch(artifact, snip_fgp1s, tolerance)
+
+        # This is the new criterion: must have more than 10% similarity of a song
+        # in the database - considered different lengths of songs
+        return [artifact.song_ids[counts/windows > 0.1]
+                for counts, windows in zip(matching_cnt, window_num)]
+
 # slow search of using one-dimensional fingerprints
 def search_match_1(snip_fgp1):
 
@@ -72,44 +192,130 @@ def search_match_1(snip_fgp1):
         The best possible matches of song titles of the snippet provided by the 
         user within the prespecified tolerance level
     """
-    conn = psycopg2.connect(host="sculptor.stat.cmu.edu", database=c.DB_USER,
-                            user=c.DB_USER, password=c.DB_PASSWORD)
-    cur = conn.cursor()
-    cur.execute("SELECT song_id FROM songs")
-    uniq_id = cur.fetchall()
-    uniq_id = reduce(np.append, uniq_id)
-    
-    tolerance = 10**(-3)  # this is the default tolerance level, tuned
+    artifact = load_index()
+    matched_sid = rough_match_ids(artifact, snip_fgp1)
+    if len(matched_sid) == 0 and load_index(recheck=True) is not artifact:
+        # the catalog changed since the generation was last read
+        matched_sid = rough_match_ids(load_index(), snip_fgp1)
     
-    matching_cnt = []
-    window_num = []
-    
-    for song_id in uniq_id:
-        distance = retriv_fgp1(int(song_id), snip_fgp1)
-        matching_cnt.append(np.sum(distance<=tolerance))
-        window_num.append(len(distance))
-    
-    # This is the new criterion: must have more than 10% similarity of a song
-    # in the database - considered different lengths of songs
-    similarity_lst = list(map(lambda i,j: i/j > 0.1, matching_cnt, window_num))
-    matched_idx = [i for i,val in enumerate(similarity_lst) if val==True]
-    matched_sid = [uniq_id[i] for i in matched_idx]
-    
-    if matched_sid == []:
+    if len(matched_sid) == 0:
         sm_logger.info('Oops, we try hard but find nothing...')
         return None
     else:
-        possible_lst = []
-        for i in matched_sid:
-            possible_lst.append(retriv_name(int(i)))
+        titles = retriv_titles(matched_sid)
+        possible_lst = [titles[sid] for sid in matched_sid if sid in titles]
         sm_logger.info('Found some songs matched the snippet!')
         return possible_lst
 
+def knn_neighbors(artifact, snip_fgp2, k):
+    """ The k nearest windows of the index
+
+    Parameters:
+        + artifact (IndexArtifact): the loaded index
+        + snip_fgp2: the multi-dimensional signature of the snippet
+        + k (int): the number of neighbours
+
+    Returns:
+        + distance (ndarray): the distance of every neighbour, ascending
+        + nearest (ndarray): the song_id of every neighbour
+    """
+    with metrics.timer('knn_search'):
+        distance, nearest = _knn_neighbors(artifact, snip_fgp2, k)
+    metrics.inc('freezam_knn_candidates_total', len(nearest))
+    return distance, nearest
+
+def knn_neighbors_batch(artifact, snip_fgp2s, k):
+    """ knn_neighbors of several snippets, with one query of the KD-tree
+
+    Parameters:
+        + artifact (IndexArtifact): the loaded index
+        + snip_fgp2s: a list of snippet signatures of the same size
+        + k (int): the number of neighbours
+
+    Return:
+        + a list with the (distance, nearest) of every snippet
+    """
+    with metrics.timer('knn_search'):
+        found = _knn_neighbors_batch(artifact, snip_fgp2s, k)
+    metrics.inc('freezam_knn_candidates_total', sum(len(nearest) for _, nearest in found))
+    return found
+
+def _knn_neighbors(artifact, snip_fgp2, k):
+    """ knn_neighbors, without the metrics """
+    return _knn_neighbors_batch(artifact, [snip_fgp2], k)[0]
+
+def _knn_neighbors_batch(artifact, snip_fgp2s, k):
+    """ knn_neighbors_batch, without the metrics """
+    queries = np.stack([np.asarray(snip_fgp2, dtype=np.float32).reshape(-1)
+                        for snip_fgp2 in snip_fgp2s]) - artifact.centroid
+    if len(artifact.delta['song_id']) == 0 and len(artifact.tombstones) == 0:
+        n_base = min(k, len(artifact.song_id))
+    else:
+        # ask the tree for enough neighbours to still have k after the rows
+        # of deleted songs are dropped, then merge with the delta segments
+        offsets = artifact.song_offsets
+        dead = ~artifact.alive(artifact.song_id[offsets[:-1]])
+        n_base = min(k + int(np.diff(offsets)[dead].sum()), len(artifact.song_id))
+    if n_base > 0:
+        tree = ist.kd_tree(artifact)  # prebuilt once per catalog generation
+        distance, neighbors = tree.query(queries, k=n_base)
+    else:
+        # an empty base (or k=0) has no tree to ask
+        distance = np.zeros((len(queries), 0))
+        neighbors = np.zeros((len(queries), 0), dtype=np.int64)
+    if len(artifact.delta['song_id']) == 0 and len(artifact.tombstones) == 0:
+        return [(distance[i], artifact.song_id[neighbors[i]])
+                for i in range(len(queries))]
+    delta_distance = np.sqrt(np.sum((artifact.delta['fingerprint2'][None, :, :] -
+                                     queries[:, None, :])**2, axis=2))
+    found = []
+    for i in range(len(queries)):
+        song_ids = np.concatenate((artifact.song_id[neighbors[i]],
+                                   artifact.delta['song_id']))
+        row_distance = np.concatenate((distance[i], delta_distance[i]))
+        alive = artifact.alive(song_ids)
+        order = np.argsort(row_distance[alive], kind='stable')[:k]
+        found.append((row_distance[alive][order], song_ids[alive][order]))
+    return found
+
+def knn_vote(nearest):
+    """ The majority vote of the k nearest windows, ties go to the smallest
+    song_id exactly like KNeighborsClassifier.predict; None without any
+    window """
+    if len(nearest) == 0:
+        return None
+    labels, votes = np.unique(nearest, return_counts=True)
+    return labels[np.argmax(votes)]
+
+def knn_predict(artifact, snip_fgp2, k):
+    """ The song_id voted by the k nearest windows of the index
+
+    Parameters:
+        + artifact (IndexArtifact): the loaded index
+        + snip_fgp2: the multi-dimensional signature of the snippet
+        + k (int): the number of neighbours
+
+    Return:
+        + The predicted song_id, or None when the index is empty
+    """
+    _, nearest = knn_neighbors(artifact, snip_fgp2, k)
+    return knn_vote(nearest)
+
+def knn_predict_batch(artifact, snip_fgp2s, k):
+    """ knn_predict of several snippets, see knn_neighbors_batch
+
+    Return:
+        + a list with the predicted song_id of every snippet
+    """
+    return [knn_vote(nearest) for _, nearest in knn_neighbors_batch(artifact, snip_fgp2s, k)]
+
 # slow search of using high-dimensional fingerprints
 def search_match2(snip_fgp2, k):
     
     """ Using K-nearest neighbour alogrithm to search through the whole 
-    database of multi-dimensional signatures and find the best possible matches
+    database of multi-dimensional signatures and find the best possible matches.
+    The neighbours are found with a KD-tree built once per catalog generation,
+    the result is the same as fitting KNeighborsClassifier on the catalog.
     
     Parameters:
         snip_fgp2: multi-dimensional signatures
@@ -120,62 +326,380 @@ def search_match2(snip_fgp2, k):
         the prespecified tolerance level
     """
 
-    conn = psycopg2.connect(host="sculptor.stat.cmu.edu", database=c.DB_USER,
-                            user=c.DB_USER, password=c.DB_PASSWORD)
-    cur = conn.cursor()
-    cur.execute("SELECT fingerprint2 FROM fingerprints")
-    fgp2 = cur.fetchall()
-    cur.execute("SELECT song_id FROM fingerprints")
-    song_id = cur.fetchall()
-    sid_cleaned = reduce(np.append, song_id)
-    fgp2_cleaned = []
-    
-    for l in range(len(fgp2)):
-        n = reduce(np.append, fgp2[l])
-        fgp2_cleaned.append([float(n[ii]) for ii in range(len(n))])
-
-    knn = KNeighborsClassifier(n_neighbors=k, metric='euclidean')
-    knn.fit(fgp2_cleaned, sid_cleaned)
-    predict = knn.predict(snip_fgp2.reshape(1,-1))
-    song_name = retriv_name(int(predict[0]))
+    predict = knn_predict(load_index(), snip_fgp2, k)
+    if predict is None:
+        sm_logger.info('Oops, the catalog is empty...')
+        return None
+    song_name = retriv_name(int(predict))
 
     return song_name
 
 # fast search of using high-dimensional fingerprints
-def setup():
+_artifact = None  # the index loaded by setup(), kept alive for falconn
+
+def setup(index_dir=None, query_pool=False):
 
     """ A function used to set up the Locality-Sensitive Hashing for 
-    high-dimensional fingerprints. This function will extract the fingerprint2
-    from database and make these fingerprints as nxd nparray. The nxd array
-    will be used as the parameters to set up the LSH table.
+    high-dimensional fingerprints. The fingerprint2 matrix, its centroid and
+    the row map are memory-mapped from the index saved on disk; the index is
+    only rebuilt from the database when it is missing or older than the
+    current catalog generation.
+
+    Parameters:
+        + index_dir (str): the folder holding the index, by default
+        FREEZAM_INDEX_DIR or ./freezam_index
+        + query_pool (bool): return a thread-safe falconn query pool instead
+        of a single query object, used by the identify server
 
     Returns:
         + centroid: An nparray that contains the mean of each column in
         fingerprint2 matrix
         + lsh_tbl:  The constructed LSH table used for later on query
     """
-    conn = psycopg2.connect(host="sculptor.stat.cmu.edu", database=c.DB_USER,
-                            user=c.DB_USER, password=c.DB_PASSWORD)
-    cur = conn.cursor()
-    cur.execute("SELECT fingerprint2 FROM fingerprints")
-    fingerprint2 = cur.fetchall()
-    conn.close()
-
-    data = np.array([tup[0] for tup in fingerprint2])
-    data = data.astype(np.float32)
-    centroid = np.mean(data, axis=0) # learned from the author of falconn
-    data -= centroid  # make sense since each column represents octave band; trick
-                      # provide by the author of falconn
-    parameters = falconn.get_default_parameters(num_points=data.shape[0],
-                                            dimension=data.shape[1])
-    lsh_tbl= falconn.LSHIndex(parameters)
-    lsh_tbl.setup(data)
-    return centroid, lsh_tbl.construct_query_object()
-
-def lsh_search(query_obj,centroid,snip_fingerprint2):
+    global _artifact
+    artifact = load_index(index_dir)
+    lsh_tbl = lsh_table(artifact)
+    _artifact = artifact
+    if query_pool:
+        return artifact.centroid, lsh_tbl.construct_query_pool()
+    return artifact.centroid, lsh_tbl.construct_query_object()
+
+def lsh_table(artifact):
+    """ The falconn LSH table over the fingerprint2 of an index, kept alive
+    with the index. It covers the base, the small delta segments are scanned
+    directly by lsh_hits, so it is built once per base segment: the table
+    of the previous generation is reused (see index_store.ensure) until
+    compaction writes a new base.
+
+    Parameter:
+        + artifact (IndexArtifact): the loaded index
+
+    Return:
+        + falconn.LSHIndex, ready to construct query objects
+    """
+    if getattr(artifact, 'lsh_tbl', None) is not None:
+        return artifact.lsh_tbl
+    lsh_tbl = falconn.LSHIndex(ist.lsh_parameters(artifact.meta))
+    lsh_tbl.setup(artifact.fingerprint2)  # already centred on disk
+    artifact.lsh_tbl = lsh_tbl
+    return lsh_tbl
+
+def retriv_titles(song_ids):
+
+    """ Retrive the titles of several songs from the song table, with a
+    single query for the ones it does not hold
+
+    Parameter:
+        + song_ids: the song_ids of interest
+
+    Return:
+        + A dict from song_id to song title
+    """
+    titles = {}
+    song_ids = [int(i) for i in np.unique(song_ids)]
+    songs = _songs
+    if songs is not None:
+        # the songs added since the table was loaded are read below
+        titles = songs.titles(song_ids)
+        song_ids = [i for i in song_ids if i not in titles]
+        if not song_ids:
+            return titles
+    with db.cursor() as cur:
+        cur.execute("SELECT song_id, song_title FROM songs WHERE song_id = ANY(%s)",
+                    [song_ids])
+        found = dict(cur.fetchall())
+    metrics.inc('freezam_db_rows_fetched_total', len(found))
+    titles.update(found)
+    return titles
+
+def _delta_near(artifact, queries, threshold):
+    """ The rows of the delta segments within threshold of every query,
+    measured like falconn does for the base
+
+    Returns:
+        + windows (ndarray): the query of every hit
+        + rows (ndarray): the delta row of every hit
+    """
+    delta = artifact.delta['fingerprint2']
+    if len(delta) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if artifact.meta['lsh']['distance_function'] == 'NegativeInnerProduct':
+        distance = -queries @ delta.T
+    else:
+        # squared euclidean distance, without a queries x rows x d array
+        distance = (np.sum(queries**2, axis=1)[:, None] + np.sum(delta**2, axis=1)
+                    - 2*queries @ delta.T)
+    return np.nonzero(distance <= threshold)
+
+def lsh_hits(query_obj, centroid, snip_fingerprint2, artifact=None):
+    """ Query every snippet window and return the song_id and window center
+    of every match, together with the snippet window that matched it, for
+    the callers that vote over their own hits (e.g. live, across the
+    windows of a stream). Matches of deleted songs are dropped.
+
+    Parameters:
+        + query_obj, centroid, snip_fingerprint2: see lsh_rank
+        + artifact (IndexArtifact): the index query_obj was built on, the
+        one of setup() by default
+
+    Returns:
+        + song_ids (ndarray): the song_id of every hit
+        + window_centers (ndarray): the song window center of every hit
+        + windows (ndarray): the snippet window of every hit
+    """
+    artifact = artifact if artifact is not None else _artifact
+    queries = np.atleast_2d(snip_fingerprint2).astype(np.float32) - centroid
+    rows = []
+    windows = []
+    for j, query in enumerate(queries):
+        near = query_obj.find_near_neighbors(query, NEAR_TOLERANCE)
+        rows.extend(near)
+        windows.extend([j]*len(near))
+    # falconn returns row numbers of the index, resolve them with the row map
+    rows = np.asarray(rows, dtype=np.int64)
+    metrics.inc('freezam_lsh_candidates_total', len(rows))
+    return _resolve_hits(artifact, queries, rows, np.asarray(windows, dtype=np.int64))
+
+def _resolve_hits(artifact, queries, rows, windows):
+    """ Add the matches of the delta segments to the matching rows of the
+    base, look up their song_id and window center and drop deleted songs """
+    delta_windows, delta_rows = _delta_near(artifact, queries, NEAR_TOLERANCE)
+    song_ids = np.concatenate((artifact.song_id[rows],
+                               artifact.delta['song_id'][delta_rows]))
+    window_centers = np.concatenate((artifact.window_center[rows],
+                                     artifact.delta['window_center'][delta_rows]))
+    windows = np.concatenate((windows, delta_windows))
+    alive = artifact.alive(song_ids)
+    return song_ids[alive], window_centers[alive], windows[alive]
+
+def vote(song_ids, window_centers, snip_centers, n_windows, top=10):
+    """ Offset-consistency vote: a hit of snippet window j on a song window
+    at center c votes for the song starting at c - t_j. A true match piles its
+    votes on one offset, chance hits spread over many.
+
+    Parameters:
+        + song_ids (ndarray): the song_id of every hit
+        + window_centers (ndarray): the song window center of every hit
+        + snip_centers (ndarray): the center of the snippet window of every hit
+        + n_windows (int): the number of windows of the snippet
+        + top (int): the number of songs to return
+
+    Return:
+        + A list of (song_id, window_center, votes, confidence) sorted by
+        votes, keeping the best offset of every song. window_center is the
+        song window aligned with the first snippet window and confidence is
+        the share of snippet windows that agree on it.
+    """
+    if len(song_ids) == 0:
+        return []
+    offsets = np.rint(np.asarray(window_centers) - snip_centers).astype(np.int64)
+    pairs, votes = np.unique(np.stack([song_ids, offsets], axis=1), axis=0,
+                             return_counts=True)
+    # most votes first, then keep the first (best) offset of every song
+    order = np.lexsort((pairs[:, 0], -votes))
+    _, first = np.unique(pairs[order, 0], return_index=True)
+    best = order[np.sort(first)][:top]
+    return [(int(pairs[i, 0]), int(pairs[i, 1]), int(votes[i]),
+             float(votes[i])/n_windows) for i in best]
+
+def snippet_times(snip_fingerprint2, snip_t=None):
+    """ The window centers of the snippet as floats; by default the windows
+    are taken one second apart, the shift used for the catalog """
+    if snip_t is None:
+        return np.arange(len(np.atleast_2d(snip_fingerprint2)), dtype=np.float64)
+    return np.asarray(snip_t, dtype=np.float64)
+
+def lsh_vote(query_obj, centroid, snip_fingerprint2, snip_t=None, top=10,
+             artifact=None):
+    """ The offset-consistency vote (see vote) of the hits of every snippet
+    window, without the titles
+
+    Parameters:
+        + query_obj, centroid, snip_fingerprint2, snip_t, top: see lsh_rank
+        + artifact (IndexArtifact): the index query_obj was built on, the
+        one of setup() by default
+
+    Return:
+        + A list of (song_id, offset, votes, confidence) as returned by vote
+    """
+    snip_fingerprint2 = np.atleast_2d(snip_fingerprint2)
+    snip_t = snippet_times(snip_fingerprint2, snip_t)
+    with metrics.timer('lsh_probe'):
+        song_ids, window_centers, windows = lsh_hits(query_obj, centroid,
+                                                     snip_fingerprint2, artifact)
+    with metrics.timer('vote'):
+        return vote(song_ids, window_centers, snip_t[windows],
+                    len(snip_fingerprint2), top)
+
+def lsh_vote_batch(query_obj, centroid, snip_fingerprint2s, snip_ts=None, top=10,
+                   artifact=None):
+    """ lsh_vote of several snippets: their windows are probed as one matrix,
+    the delta segments are scanned and the hits resolved once for all of
+    them, then every snippet votes on its own hits
+
+    Parameters:
+        + query_obj, centroid, top, artifact: see lsh_vote
+        + snip_fingerprint2s: a list of snippet fingerprint2
+        + snip_ts: a list with the window centers of every snippet, or None
+
+    Return:
+        + a list with the votes of every snippet, as returned by vote
+    """
+    snip_fingerprint2s = [np.atleast_2d(fingerprint2) for fingerprint2 in snip_fingerprint2s]
+    snip_ts = snip_ts or [None]*len(snip_fingerprint2s)
+    sizes = [len(fingerprint2) for fingerprint2 in snip_fingerprint2s]
+    bounds = np.cumsum(sizes)
+    with metrics.timer('lsh_probe'):
+        song_ids, window_centers, windows = lsh_hits(
+            query_obj, centroid, np.concatenate(snip_fingerprint2s), artifact)
+    # the snippet of every hit and the hit window within that snippet
+    snippet = np.searchsorted(bounds, windows, 'right')
+    windows = windows - (bounds - sizes)[snippet]
+    voted = []
+    with metrics.timer('vote'):
+        for i, (fingerprint2, snip_t) in enumerate(zip(snip_fingerprint2s, snip_ts)):
+            mine = snippet == i
+            voted.append(vote(song_ids[mine], window_centers[mine],
+                              snippet_times(fingerprint2, snip_t)[windows[mine]],
+                              len(fingerprint2), top))
+    return voted
+
+def with_titles(voted, snip_t, titles=None):
+    """ Turn the result of vote into (song_id, title, window_center, score),
+    dropping the songs deleted in the meantime. titles maps song_id to
+    title, by default they are read from the database. """
+    if titles is None:
+        titles = retriv_titles([song[0] for song in voted]) if voted else {}
+    return [(sid, titles[sid], offset + int(round(snip_t[0])), confidence)
+            for sid, offset, _, confidence in voted if sid in titles]
+
+def lsh_rank(query_obj, centroid, snip_fingerprint2, snip_t=None, top=10):
+
+    """ Rank the songs matched by Locality-Sensitive Hashing with every
+    window of the snippet, voting on time-aligned hits
+
+    Parameters:
+        + query_obj: The query object (or query pool) created by falconn
+        + centroid: An nparray that contains the mean of each column in
+        fingerprint2 matrix from the current database
+        + snip_fingerprint2: An nparray that contains snippet fingerprint2
+        + snip_t: the window centers of the snippet; by default the windows
+        are taken one second apart, the shift used for the catalog
+        + top (int): the number of songs to return
+
+    Return:
+        + A list of (song_id, title, window_center, score) sorted by the
+        number of aligned hits, where score is the confidence in [0, 1]
+    """
+    voted = lsh_vote(query_obj, centroid, snip_fingerprint2, snip_t, top)
+    return with_titles(voted, snippet_times(snip_fingerprint2, snip_t))
+
+def setup_pq(index_dir=None, subvectors=pqi.SUBVECTORS):
+
+    """ Load the index and its product-quantized codes, compressing the
+    base first if needed. Unlike setup, no LSH table is built and the float
+    fingerprint2 stays on disk: only the codes are read on every query.
+
+    Parameters:
+        + index_dir (str): the folder holding the index
+        + subvectors (int): the bytes of every compressed window
+
+    Returns:
+        + artifact (IndexArtifact): the loaded index, for the row map, the
+        deltas and the re-ranking
+        + pq (PQIndex): the compressed fingerprint2 of its base
+    """
+    artifact = load_index(index_dir)
+    return artifact, pqi.ensure(artifact, subvectors)
+
+def _pq_hits(artifact, pq, snip_fingerprint2, rerank=True):
+    """ Like lsh_hits, with the nearest rows found by asymmetric distance
+    over the codes. With rerank the exact distance of these candidates is
+    read from the fingerprint2 on disk, otherwise the approximate one is
+    compared with the tolerance. """
+    queries = np.atleast_2d(snip_fingerprint2).astype(np.float32) - artifact.centroid
+    inner_product = artifact.meta['lsh']['distance_function'] == 'NegativeInnerProduct'
+    windows, rows, distance = pqi.search(pq, queries, inner_product=inner_product)
+    metrics.inc('freezam_pq_candidates_total', len(rows))
+    if rerank and len(rows) > 0:
+        with metrics.timer('pq_rerank'):
+            order = np.argsort(rows)  # read the file front to back
+            exact = np.asarray(artifact.fingerprint2[rows[order]])
+            if inner_product:
+                exact = -np.sum(exact*queries[windows[order]], axis=1)
+            else:
+                exact = np.sum((exact - queries[windows[order]])**2, axis=1)
+            distance = np.empty_like(exact)
+            distance[order] = exact
+    near = distance <= NEAR_TOLERANCE
+    return _resolve_hits(artifact, queries, rows[near], windows[near])
+
+def pq_vote(artifact, pq, snip_fingerprint2, snip_t=None, top=10, rerank=True):
+    """ The offset-consistency vote (see vote) of the windows matched in
+    the compressed index, without the titles
+
+    Parameters:
+        + artifact, pq: as given by setup_pq
+        + snip_fingerprint2, snip_t, top: see lsh_rank
+        + rerank (bool): check the candidates with their exact fingerprint2
+
+    Return:
+        + A list of (song_id, offset, votes, confidence) as returned by vote
+    """
+    snip_fingerprint2 = np.atleast_2d(snip_fingerprint2)
+    snip_t = snippet_times(snip_fingerprint2, snip_t)
+    with metrics.timer('pq_probe'):
+        song_ids, window_centers, windows = _pq_hits(artifact, pq, snip_fingerprint2,
+                                                     rerank)
+    with metrics.timer('vote'):
+        return vote(song_ids, window_centers, snip_t[windows],
+                    len(snip_fingerprint2), top)
+
+def pq_rank(artifact, pq, snip_fingerprint2, snip_t=None, top=10, rerank=True):
+
+    """ Rank the songs matched in the product-quantized index with every
+    window of the snippet, voting on time-aligned hits like lsh_rank
+
+    Parameters:
+        + artifact, pq: as given by setup_pq
+        + snip_fingerprint2, snip_t, top: see lsh_rank
+        + rerank (bool): check the candidates with their exact fingerprint2
+
+    Return:
+        + A list of (song_id, title, window_center, score), see lsh_rank
+    """
+    voted = pq_vote(artifact, pq, snip_fingerprint2, snip_t, top, rerank)
+    return with_titles(voted, snippet_times(snip_fingerprint2, snip_t))
+
+def hash_rank(hashes, offsets, index_dir=None, top=10):
+
+    """ Rank the songs sharing the most time-aligned constellation hashes
+    with the snippet. Lookups are exact matches in the inverted hash index,
+    so a snippet may start anywhere, not only on the 1 s window grid.
+
+    Parameters:
+        + hashes, offsets: the hashes of the snippet given by
+        conversion_and_read.constellation
+        + index_dir (str): the folder holding the index
+        + top (int): the number of songs to return
+
+    Return:
+        + A list of (song_id, title, start, score) sorted by the number of
+        aligned hashes, where start is the second of the song the snippet
+        starts at and score the share of snippet hashes that agree
+    """
+    index = hi.ensure(index_dir)
+    load_songs(index_dir, index.generation)
+    voted = hi.lookup(index, hashes, offsets, top)
+    return with_titles([(sid, round(offset*cr.PEAK_HOP, 2), votes, confidence)
+                        for sid, offset, votes, confidence in voted], [0])
+
+def lsh_search(query_obj,centroid,snip_fingerprint2,snip_t=None):
 
     """ A function used to find the best possible matches of a snippet
-    by using Locality-Sensitive Hashing on high-dimensional fingerprints
+    by using Locality-Sensitive Hashing on high-dimensional fingerprints.
+    Every window of the snippet is looked up and the songs are ranked by the
+    number of hits that agree on the same time offset.
 
     Parameters:
         + query_obj: The query object created by falconn package
@@ -183,31 +707,15 @@ def lsh_search(query_obj,centroid,snip_fingerprint2):
         fingerprint2 matrix from the current database
         + snip_fingerprint2: An nparray that contains snippet fingerprint2,
         the high-dimensional fingerprints
+        + snip_t: An nparray that contains the window centers of the snippet
     
     Returns:
-        + The id, title and window center of the best possible matched songs
-        within the default threshold
+        + The id, title, aligned window center and confidence of the best
+        possible matched songs within the default threshold
         + Notification of finding nothing if nothing is found within the 
         tolerance level
     """
-    possible_matches = []
-    fingerprint2 = snip_fingerprint2[0]  
-    fingerprint2 = fingerprint2.astype(np.float32)
-    distance = fingerprint2-centroid
-    tolerance_level = 10**(-2)
-    possible_matches.append(query_obj.find_near_neighbors(distance, tolerance_level))
-    
-    conn = psycopg2.connect(host="sculptor.stat.cmu.edu", database=c.DB_USER,
-                            user=c.DB_USER, password=c.DB_PASSWORD)
-    cur = conn.cursor()
-    matched_songs = []
-    for id in possible_matches[0]:
-        sql_cmd = """SELECT f.song_id, s.song_title, f.window_center
-                     FROM fingerprints f JOIN songs s ON f.song_id = s.song_id
-                     WHERE f.fingerprint_ID = %s"""
-        cur.execute(sql_cmd, [id])
-        matched_songs += cur.fetchall()
-    conn.close()
+    matched_songs = lsh_rank(query_obj, centroid, snip_fingerprint2, snip_t)
     
     if len(matched_songs) != 0:
         sm_logger.info("Matched songs found")
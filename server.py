@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import logging
+import threading
+import socketserver
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
+import conversion_and_read as cr
+import search_match as sm
+import index_store as ist
+import shards
+import metrics
+
+srv_logger = logging.getLogger('freezam.server')
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ The same HTTP protocol as ThreadingHTTPServer, spoken over a local
+    Unix socket """
+    daemon_threads = True
+
+
+class IdentifyHandler(BaseHTTPRequestHandler):
+    """ Answer identify requests with the index kept warm by the server
+
+    + POST /identify with the snippet bytes (any format) as the body returns a
+    json list of {song_id, title, window_center, score}
+    + GET /health returns the generation of the loaded index
+    + GET /metrics returns the stage timers and counters in the Prometheus
+    text format
+    """
+
+    def log_message(self, format, *args):
+        # client_address is empty for Unix sockets, log through our logger
+        srv_logger.debug(format, *args)
+
+    def _reply(self, status, payload, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(payload).encode('utf-8')
+        else:
+            body = payload.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            self._reply(200, {'generation': self.server.state['generation']})
+        elif path == '/metrics':
+            self._reply(200, metrics.prometheus_text(),
+                        'text/plain; version=0.0.4; charset=utf-8')
+        else:
+            self._reply(404, {'error': 'unknown path'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/identify':
+            self._reply(404, {'error': 'unknown path'})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        if length <= 0:
+            self._reply(400, {'error': 'empty snippet'})
+            return
+        snippet = self.rfile.read(length)
+        try:
+            with metrics.timer('identify'):
+                results = identify(self.server.state, snippet)
+        except Exception:
+            srv_logger.exception("Identify failed")
+            metrics.inc('freezam_identify_requests_total', status='error')
+            self._reply(500, {'error': 'could not identify the snippet'})
+            return
+        metrics.inc('freezam_identify_requests_total', status='ok')
+        self._reply(200, [{'song_id': sid, 'title': title,
+                           'window_center': center, 'score': score}
+                          for sid, title, center, score in results])
+
+
+def analyze_snippet(snippet, window_method, window_size, shift, m,
+                    analysis_rate=None):
+    """ Fingerprint the snippet bytes, run inside a worker process. The
+    snippet is decoded in memory, whatever its format.
+
+    Parameters:
+        + snippet (bytes): the content of the snippet file
+        + window_method, window_size, shift, m, analysis_rate: the analysis
+        parameters used for the catalog
+
+    Returns:
+        + fingerprint2 (ndarray): the m-dimensional summary of the snippet
+        + t (ndarray): the window centers of the snippet
+    """
+    _, fingerprint2, t = cr.analyze_audio(snippet, window_method, window_size,
+                                          shift, m, analysis_rate)
+    return fingerprint2, t
+
+def identify(state, snippet):
+    """ Identify one snippet with the warm index
+
+    Parameters:
+        + state (dict): the server state built by serve()
+        + snippet (bytes): the content of the snippet file
+
+    Return:
+        + A ranked list of (song_id, title, window_center, score)
+    """
+    (fingerprint2, t), recorded = state['pool'].submit(metrics.run_collected,
+                                                       analyze_snippet, snippet,
+                                                       *state['analysis']).result()
+    metrics.merge(recorded)
+    return sm.with_titles(vote(state, fingerprint2, t), sm.snippet_times(fingerprint2, t))
+
+def vote(state, fingerprint2, t):
+    """ The songs voted by the windows of a snippet in the warm index,
+    without their titles. The index is first brought up to the catalog
+    generation if it changed, see refresh.
+
+    Parameters:
+        + state (dict): the search state built by warm_state
+        + fingerprint2, t: the fingerprint2 and window centers of the snippet
+
+    Return:
+        + A list of (song_id, offset, votes, confidence), see search_match.vote
+    """
+    state = refresh(state)
+    if state['pq'] is not None:
+        return sm.pq_vote(state['artifact'], state['pq'], fingerprint2, t)
+    if state['coordinator'] is not None:
+        return state['coordinator'].lsh_vote(fingerprint2, t)
+    # the rows of the pool are resolved with the artifact it was built on,
+    # not with the one a concurrent refresh may have loaded since
+    return sm.lsh_vote(state['query_pool'], state['centroid'], fingerprint2, t,
+                       artifact=state['artifact'])
+
+def _searchers(index_dir=None, subvectors=None):
+    """ What vote needs to search the index of one process: the compressed
+    codes with subvectors, the LSH query pool otherwise """
+    if subvectors:
+        artifact, pq = sm.setup_pq(index_dir, subvectors)
+        return {'artifact': artifact, 'pq': pq, 'generation': artifact.generation}
+    # the pool searches the arrays of the artifact, keep them together
+    artifact = sm.load_index(index_dir)
+    query_pool = sm.lsh_table(artifact).construct_query_pool()
+    return {'artifact': artifact, 'centroid': artifact.centroid, 'query_pool': query_pool,
+            'pq': None, 'generation': artifact.generation}
+
+def warm_state(index_dir=None, n_shards=None, subvectors=None):
+    """ Load the index searched by the server, once; refresh keeps it up
+    to date with the catalog
+
+    Parameters:
+        + index_dir, n_shards, subvectors: see serve
+
+    Return:
+        + state (dict): what vote needs, and the generation of the index
+    """
+    state = {'coordinator': None, 'pq': None, 'index_dir': index_dir,
+             'subvectors': subvectors, 'lock': threading.Lock(),
+             'checked': time.monotonic(), 'reloading': False}
+    if n_shards and not subvectors:
+        state['coordinator'] = shards.ShardCoordinator(n_shards, index_dir)
+        state['generation'] = state['coordinator'].generation
+        sm.load_songs(index_dir, state['generation'])
+    else:
+        state.update(_searchers(index_dir, subvectors))
+    return state
+
+def refresh(state):
+    """ Bring the warm index up to the current catalog generation. The
+    generation is read at most every index_store.GENERATION_TTL seconds,
+    by one request at a time; the others keep searching the loaded index
+    while it is updated (see index_store.ensure).
+
+    Parameter:
+        + state (dict): the server state built by warm_state
+
+    Return:
+        + A copy of the state to search with, consistent for one request
+    """
+    now = time.monotonic()
+    with state['lock']:
+        if state['reloading'] or now - state['checked'] < ist.GENERATION_TTL:
+            return dict(state)
+        state['checked'] = now
+        state['reloading'] = True
+        loaded = state['generation']
+    fresh = {}
+    try:
+        generation = ist.catalog_generation()
+        if generation != loaded:
+            srv_logger.info("Catalog moved to generation %d, reloading the index",
+                            generation)
+            if state['coordinator'] is not None:
+                fresh['generation'] = state['coordinator'].refresh(generation)
+            else:
+                sm.load_index(state['index_dir'], recheck=True)
+                fresh = _searchers(state['index_dir'], state['subvectors'])
+            sm.load_songs(state['index_dir'], fresh['generation'])
+    except Exception:
+        # keep serving the loaded index, the next request tries again
+        srv_logger.exception("Cannot reload the index")
+    with state['lock']:
+        state.update(fresh)
+        state['reloading'] = False
+        return dict(state)
+
+def serve(window_size, shift, window_method, m, host='127.0.0.1', port=8765,
+          socket_path=None, workers=None, index_dir=None, analysis_rate=None,
+          n_shards=None, subvectors=None):
+
+    """ Run the identify daemon. The fingerprint index is loaded once and
+    kept in memory; snippets are fingerprinted by a pool of worker processes
+    and looked up by the threads serving the requests.
+
+    Parameters:
+        + window_size, shift, window_method, m: the analysis parameters used
+        for the catalog
+        + host (str): the local address to listen on
+        + port (int): the port to listen on
+        + socket_path (str): listen on this Unix socket instead of host:port
+        + workers (int): the number of analysis processes, by default the
+        number of cores
+        + index_dir (str): the folder holding the fingerprint index
+        + analysis_rate (int): the sampling rate the catalog was analyzed at
+        + n_shards (int): split the index by song_id across this many shard
+        processes instead of keeping it whole in the server process
+        + subvectors (int): search the fingerprint2 compressed to this many
+        bytes per window instead of the LSH tables (see pq_index); it keeps
+        the memory of the server small on large catalogs
+
+    Return:
+        Serve requests until interrupted
+    """
+    workers = workers or os.cpu_count()
+    pool = ProcessPoolExecutor(max_workers=workers)
+    state = warm_state(index_dir, n_shards, subvectors)
+    state['pool'] = pool
+    state['analysis'] = (window_method, window_size, shift, m, analysis_rate)
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        httpd = UnixHTTPServer(socket_path, IdentifyHandler)
+        where = socket_path
+    else:
+        httpd = ThreadingHTTPServer((host, port), IdentifyHandler)
+        where = '%s:%d' % (host, port)
+    httpd.state = state
+    srv_logger.info("Serving identify requests on %s with %d workers", where, workers)
+    print("Freezam is listening on " + where)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        pool.shutdown()
+        if state['coordinator'] is not None:
+            state['coordinator'].close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+    return
@@ -0,0 +1,253 @@
+import logging
+import threading
+import multiprocessing
+import numpy as np
+import index_store as ist
+import search_match as sm
+import metrics
+
+sh_logger = logging.getLogger('freezam.shards')
+
+
+class _EmptyTable:
+    """ Stands for the LSH query object of a shard without any song """
+
+    def find_near_neighbors(self, query, threshold):
+        return []
+
+
+def _load_shard(directory, shard, refresh, generation=None, previous=None):
+    """ The index of a shard, brought up to generation with refresh (see
+    index_store.ensure, which keeps the tables of previous over an unchanged
+    base) and compacted when it has no base to hash yet """
+    artifact = (ist.ensure(directory, generation, shard=shard, previous=previous)
+                if refresh else ist.load(directory))
+    if artifact is None:
+        raise ValueError("There is no index in " + directory)
+    if len(artifact.song_id) == 0 and len(artifact.delta['song_id']) > 0:
+        artifact = ist.compact(directory)  # no base to hash yet
+    return artifact
+
+def _serve_shard(conn, index_dir, shard, refresh):
+    """ The loop of one shard process: load (or build) the index of the
+    shard and answer the queries of the coordinator until None arrives; a
+    refresh query loads it again at the catalog generation
+
+    Parameters:
+        + conn: the end of the pipe shared with the coordinator
+        + index_dir (str): the folder holding the shards
+        + shard (tuple): (i, n), this process serves song_id % n == i
+        + refresh (bool): bring the index up to the catalog generation of
+        the database first, otherwise use it as it is on disk
+    """
+    directory = ist.shard_dir(index_dir, shard)
+    try:
+        artifact = _load_shard(directory, shard, refresh)
+    except Exception as error:
+        conn.send(('error', repr(error), metrics.drain()))
+        conn.close()
+        return
+    # every answer carries the metrics recorded since the previous one
+    conn.send(('ok', artifact.generation, metrics.drain()))
+    empty = len(artifact.song_id) == 0
+    query_obj = _EmptyTable() if empty else None
+
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        kind, args = request
+        try:
+            # every query holds a list of snippets, searched together
+            if kind == 'lsh':
+                if query_obj is None:
+                    query_obj = sm.lsh_table(artifact).construct_query_object()
+                result = sm.lsh_vote_batch(query_obj, artifact.centroid, *args,
+                                           artifact=artifact)
+            elif kind == 'knn':
+                result = ([(np.zeros(0), np.zeros(0, dtype=np.int64))]*len(args[0])
+                          if empty else sm.knn_neighbors_batch(artifact, *args))
+            elif kind == 'rough':
+                result = ([np.zeros(0, dtype=np.int64)]*len(args[0]) if empty
+                          else sm.rough_match_ids_batch(artifact, *args))
+            elif kind == 'refresh':
+                lsh_tbl = getattr(artifact, 'lsh_tbl', None)
+                artifact = _load_shard(directory, shard, True, *args, previous=artifact)
+                empty = len(artifact.song_id) == 0
+                if empty:
+                    query_obj = _EmptyTable()
+                elif lsh_tbl is None or getattr(artifact, 'lsh_tbl', None) is not lsh_tbl:
+                    query_obj = None  # a new base, hashed on the next query
+                result = artifact.generation
+            else:
+                raise ValueError("Unknown query " + kind)
+            conn.send(('ok', result, metrics.drain()))
+        except Exception as error:
+            sh_logger.exception("Shard %d of %d failed", *shard)
+            conn.send(('error', repr(error), metrics.drain()))
+    conn.close()
+    return
+
+
+class ShardCoordinator:
+    """ The catalog partitioned by song_id into n shards, each with its own
+    index (see index_store.shard_dir) served by a separate process. Every
+    query is sent to all the shards at once and their results are merged,
+    so memory and search time per process shrink with the number of shards.
+    A song lives in exactly one shard, so merging the top results of every
+    shard gives the same answer as a single index.
+
+        with ShardCoordinator(4) as coordinator:
+            coordinator.lsh_rank(fingerprint2, t)
+
+    Attributes:
+        + n_shards (int): the number of shards
+        + generation (int): the oldest catalog generation of the shards
+    """
+
+    def __init__(self, n_shards, index_dir=None, refresh=True):
+        """
+        Parameters:
+            + n_shards (int): the number of shard processes
+            + index_dir (str): the folder holding the shards
+            + refresh (bool): let every shard bring its index up to date
+            with the database (in parallel) before serving
+        """
+        # fork: spawn would run main.py again in every shard; the database
+        # module opens new connections in a forked process by itself
+        context = multiprocessing.get_context('fork')
+        self.n_shards = n_shards
+        self._lock = threading.Lock()
+        self._conns = []
+        self._procs = []
+        for i in range(n_shards):
+            parent, child = context.Pipe()
+            proc = context.Process(target=_serve_shard, daemon=True,
+                                   args=(child, index_dir, (i, n_shards), refresh))
+            proc.start()
+            child.close()
+            self._conns.append(parent)
+            self._procs.append(proc)
+        try:
+            self.generation = min(self._gather())
+        except Exception:
+            self.close()
+            raise
+        sh_logger.info("%d shards of generation %d are ready", n_shards,
+                       self.generation)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _gather(self):
+        """ One answer from every shard, in shard order """
+        answers = [conn.recv() for conn in self._conns]
+        for _, _, recorded in answers:
+            metrics.merge(recorded)
+        errors = [result for status, result, _ in answers if status != 'ok']
+        if errors:
+            raise RuntimeError("Shard query failed: " + "; ".join(errors))
+        return [result for _, result, _ in answers]
+
+    def _fan_out(self, kind, *args):
+        with self._lock:
+            for conn in self._conns:
+                conn.send((kind, args))
+            return self._gather()
+
+    def lsh_vote(self, snip_fingerprint2, snip_t=None, top=10):
+        """ search_match.lsh_vote over every shard
+
+        Return:
+            + A list of (song_id, offset, votes, confidence) sorted by votes
+        """
+        return self.lsh_vote_batch([snip_fingerprint2], [snip_t], top)[0]
+
+    def lsh_vote_batch(self, snip_fingerprint2s, snip_ts=None, top=10):
+        """ search_match.lsh_vote_batch over every shard, with one query
+        per shard for all the snippets
+
+        Return:
+            + A list with the votes of every snippet, see lsh_vote
+        """
+        answers = self._fan_out('lsh', snip_fingerprint2s, snip_ts, top)
+        return [sorted([song for shard in answers for song in shard[i]],
+                       key=lambda song: (-song[2], song[0]))[:top]
+                for i in range(len(snip_fingerprint2s))]
+
+    def lsh_rank(self, snip_fingerprint2, snip_t=None, top=10):
+        """ search_match.lsh_rank over every shard
+
+        Return:
+            + A list of (song_id, title, window_center, score) sorted by the
+            number of aligned hits
+        """
+        voted = self.lsh_vote(snip_fingerprint2, snip_t, top)
+        return sm.with_titles(voted, sm.snippet_times(snip_fingerprint2, snip_t))
+
+    def knn_predict(self, snip_fgp2, k):
+        """ search_match.knn_predict over every shard: the k nearest windows
+        of every shard are merged and the k nearest overall vote
+
+        Return:
+            + The predicted song_id, or None when every shard is empty
+        """
+        return self.knn_predict_batch([snip_fgp2], k)[0]
+
+    def knn_predict_batch(self, snip_fgp2s, k):
+        """ knn_predict of several snippets, with one query per shard
+
+        Return:
+            + A list with the predicted song_id of every snippet
+        """
+        answers = self._fan_out('knn', snip_fgp2s, k)
+        predicted = []
+        for i in range(len(snip_fgp2s)):
+            distance = np.concatenate([answer[i][0] for answer in answers])
+            nearest = np.concatenate([answer[i][1] for answer in answers])
+            order = np.argsort(distance, kind='stable')[:k]
+            predicted.append(sm.knn_vote(nearest[order]))
+        return predicted
+
+    def rough_match_ids(self, snip_fgp1):
+        """ search_match.rough_match_ids over every shard, ascending """
+        return self.rough_match_ids_batch([snip_fgp1])[0]
+
+    def rough_match_ids_batch(self, snip_fgp1s):
+        """ rough_match_ids of several snippets, with one query per shard """
+        answers = self._fan_out('rough', snip_fgp1s)
+        return [np.sort(np.concatenate([answer[i] for answer in answers]))
+                for i in range(len(snip_fgp1s))]
+
+    def refresh(self, generation=None):
+        """ Bring the index of every shard up to the catalog generation (see
+        index_store.ensure), in the shard processes, between two queries
+
+        Parameter:
+            + generation (int): the current catalog generation, read from
+            the database by every shard when not given
+
+        Return:
+            + the oldest generation of the shards
+        """
+        self.generation = min(self._fan_out('refresh', generation))
+        return self.generation
+
+    def close(self):
+        """ Stop the shard processes """
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for proc in self._procs:
+            proc.join(timeout=5)
+            if proc.is_alive():
+                proc.terminate()
+        for conn in self._conns:
+            conn.close()
+        self._conns = []
+        self._procs = []
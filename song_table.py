@@ -0,0 +1,339 @@
+import os
+import json
+import shutil
+import logging
+import numpy as np
+import database as db
+import dbconstruction as dbc
+import index_store as ist
+import metrics
+
+st_logger = logging.getLogger('freezam.song_table')
+
+SONG_FORMAT = 2  # bump when the on-disk layout changes
+COLUMNS = ('title', 'artist')
+
+
+class SongTable:
+    """ The title and artist of every song of the catalog, kept next to the
+    index so the results of a search are named without a query. The
+    strings of a column are stored back to back in one utf-8 blob and found
+    by the offsets of the song; the arrays are memory-mapped.
+
+    Like the index, the table is a base segment plus the small segments of
+    the songs added since it was written and the tombstones of the deleted
+    ones, merged into a new base by compact.
+
+    Attributes:
+        + meta (dict): the content of meta.json (format, generation, segments
+        ...)
+        + parts (list): the arrays of the base, then of every added segment:
+        the song_ids ascending and, for every column, its blob, the offsets
+        of its strings (one more than the songs) and the mask of the NULL
+        ones
+        + tombstones (ndarray): the song_ids deleted since the base was
+        written, sorted
+    """
+
+    def __init__(self, directory, meta, parts, tombstones=None):
+        self.directory = directory
+        self.meta = meta
+        self.generation = meta['generation']
+        self.parts = parts
+        self.tombstones = (tombstones if tombstones is not None
+                           else np.zeros(0, dtype=np.int64))
+        self._song_id = None
+
+    @property
+    def song_id(self):
+        """ The song_ids of the table that are not deleted, ascending """
+        if self._song_id is None:
+            song_id = np.concatenate([part['song_id'] for part in self.parts])
+            self._song_id = np.sort(song_id[~np.isin(song_id, self.tombstones)])
+        return self._song_id
+
+    def __len__(self):
+        return len(self.song_id)
+
+    @staticmethod
+    def _rows(part, song_ids):
+        """ The song_ids found in a segment and their rows """
+        ids = part['song_id']
+        if len(ids) == 0:
+            return song_ids[:0], song_ids[:0]
+        rows = np.minimum(np.searchsorted(ids, song_ids), len(ids) - 1)
+        found = song_ids == ids[rows]
+        return song_ids[found], rows[found]
+
+    def column(self, name, song_ids):
+        """ A dict from song_id to the value of column name (None for NULL)
+        of the song_ids in the table; the others and the deleted ones are
+        left out """
+        song_ids = np.unique(np.asarray(song_ids, dtype=np.int64))
+        song_ids = song_ids[~np.isin(song_ids, self.tombstones)]
+        values = {}
+        for part in self.parts:
+            blob = part[name + '_blob']
+            offsets = part[name + '_offsets']
+            null = part[name + '_null']
+            for sid, row in zip(*self._rows(part, song_ids)):
+                if null[row]:
+                    values[int(sid)] = None
+                else:
+                    values[int(sid)] = bytes(blob[offsets[row]:offsets[row + 1]]).decode('utf-8')
+        return values
+
+    def titles(self, song_ids):
+        """ A dict from song_id to title, see column """
+        return self.column('title', song_ids)
+
+    def artists(self, song_ids):
+        """ A dict from song_id to artist name, see column """
+        return self.column('artist', song_ids)
+
+    def entries(self):
+        """ Every song of the table as a dict from song_id to (title, artist) """
+        titles, artists = self.titles(self.song_id), self.artists(self.song_id)
+        return {sid: (titles[sid], artists[sid]) for sid in titles}
+
+
+def song_dir(index_dir=None):
+    """ The folder of the song table, inside the folder of the index """
+    return os.path.join(index_dir or ist.DEFAULT_INDEX_DIR, 'songs')
+
+def _pack(strings):
+    """ The utf-8 blob, offsets and NULL mask of a list of strings """
+    encoded = [(s or '').encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return blob, offsets, np.array([s is None for s in strings], dtype=bool)
+
+NAMES = ['song_id'] + [name + part for name in COLUMNS
+                       for part in ('_blob', '_offsets', '_null')]
+
+def _write_segment(segment_dir, entries):
+    """ Save the song_ids and columns of entries (song_id -> (title,
+    artist)) in segment_dir """
+    song_ids = sorted(entries)
+    os.makedirs(segment_dir, exist_ok=True)
+    np.save(os.path.join(segment_dir, 'song_id.npy'), np.array(song_ids, dtype=np.int64))
+    for i, name in enumerate(COLUMNS):
+        blob, offsets, null = _pack([entries[sid][i] for sid in song_ids])
+        np.save(os.path.join(segment_dir, name + '_blob.npy'), blob)
+        np.save(os.path.join(segment_dir, name + '_offsets.npy'), offsets)
+        np.save(os.path.join(segment_dir, name + '_null.npy'), null)
+
+def _write_meta(directory, meta):
+    """ Replace meta.json atomically, then drop the segments it no longer
+    refers to """
+    tmp_path = os.path.join(directory, 'meta.json.tmp')
+    with open(tmp_path, 'w') as fh:
+        json.dump(meta, fh, indent=2)
+    os.replace(tmp_path, os.path.join(directory, 'meta.json'))
+    used = set([meta['segment'], meta['tombstones']] + meta['added'])
+    for name in os.listdir(directory):
+        if name.startswith(('gen-', 'added-', 'tombstones-')) and name not in used:
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+def write(directory, generation, entries):
+    """ Write the table to disk as a new base segment, then replace
+    meta.json atomically and drop the older segments
+
+    Parameters:
+        + directory (str): the folder of the song table
+        + generation (int): the catalog generation the songs were read at
+        + entries (dict): song_id -> (title, artist)
+
+    Return:
+        + meta (dict): the meta data written to meta.json
+    """
+    segment = 'gen-%d' % generation
+    _write_segment(os.path.join(directory, segment), entries)
+    meta = {'format': SONG_FORMAT,
+            'generation': generation,
+            'segment': segment,
+            'num_songs': len(entries),
+            'added': [],
+            'tombstones': None}
+    _write_meta(directory, meta)
+    st_logger.info("Song table of generation %d written to %s", generation, directory)
+    return meta
+
+def write_added(table, generation, entries, deleted):
+    """ Append the changes of the catalog to the table as a segment of the
+    added songs and tombstones, without touching the segments already
+    written. The caller holds the lock of the table folder.
+
+    Parameters:
+        + table (SongTable): the table the changes apply to
+        + generation (int): the catalog generation after the changes
+        + entries (dict): song_id -> (title, artist) of the added songs
+        + deleted: the song_ids deleted since table.generation
+
+    Return:
+        + meta (dict): the meta data written to meta.json
+    """
+    meta = dict(table.meta, generation=generation)
+    if len(entries) > 0:
+        segment = 'added-%d' % generation
+        _write_segment(os.path.join(table.directory, segment), entries)
+        meta['added'] = meta['added'] + [segment]
+    tombstones = np.union1d(table.tombstones,
+                            np.asarray(deleted, dtype=np.int64)).astype(np.int64)
+    if len(tombstones) > len(table.tombstones):
+        meta['tombstones'] = 'tombstones-%d.npy' % generation
+        np.save(os.path.join(table.directory, meta['tombstones']), tombstones)
+    _write_meta(table.directory, meta)
+    st_logger.info("Song table updated to generation %d: %d song(s) added, %d deleted",
+                   generation, len(entries), len(deleted))
+    return meta
+
+def _read_songs(cur, song_ids=None):
+    """ song_id -> (title, artist) of song_ids, or of every song """
+    if song_ids is None:
+        cur.execute("SELECT song_id, song_title, artist_name FROM songs")
+    else:
+        cur.execute("""SELECT song_id, song_title, artist_name FROM songs
+                       WHERE song_id = ANY(%s)""", [list(song_ids)])
+    rows = cur.fetchall()
+    metrics.inc('freezam_db_rows_fetched_total', len(rows))
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+def build(index_dir=None):
+    """ Read the title and artist of every song from the database and write
+    the song table of the current catalog
+
+    Parameter:
+        + index_dir (str): the folder holding the index
+
+    Return:
+        + SongTable
+    """
+    directory = song_dir(index_dir)
+    with ist._locked(directory):
+        with db.cursor() as cur:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            generation = dbc.current_generation(cur)
+            entries = _read_songs(cur)
+        write(directory, generation, entries)
+    return load(index_dir)
+
+def update(index_dir=None):
+    """ Bring the song table up to the current generation by reading the
+    added songs only, as logged in catalog_changes, and appending them with
+    the tombstones of the deleted ones (see write_added)
+
+    Parameter:
+        + index_dir (str): the folder holding the index
+
+    Return:
+        + The updated SongTable, or None if there is no table or the changes
+        since its generation were not all logged (build it instead)
+    """
+    directory = song_dir(index_dir)
+    with ist._locked(directory):
+        table = load(index_dir)
+        if table is None:
+            return None
+        with db.cursor() as cur:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            generation = dbc.current_generation(cur)
+            if generation == table.generation:
+                return table
+            changes = ist.changes_since(cur, table.generation, generation)
+            if changes is None:
+                return None
+            added, deleted = changes
+            new_entries = _read_songs(cur, added)
+        write_added(table, generation, new_entries, deleted)
+    return load(index_dir)
+
+def needs_compaction(table):
+    """ Whether the added segments or tombstones have grown large enough to
+    be merged into the base, with the thresholds of the index """
+    base_songs = max(table.meta['num_songs'], 1)
+    added = sum(len(part['song_id']) for part in table.parts[1:])
+    return (added > ist.COMPACT_FRACTION*base_songs
+            or len(table.meta['added']) > ist.MAX_DELTAS
+            or len(table.tombstones) > ist.COMPACT_FRACTION*base_songs)
+
+def compact(index_dir=None):
+    """ Merge the added segments into a new base and drop the deleted songs.
+    Everything is read from the table itself, the database is not queried.
+
+    Parameter:
+        + index_dir (str): the folder holding the index
+
+    Return:
+        + The compacted SongTable, or None if there is no table
+    """
+    directory = song_dir(index_dir)
+    with ist._locked(directory):
+        table = load(index_dir)
+        if table is None:
+            return None
+        if len(table.meta['added']) == 0 and len(table.tombstones) == 0:
+            return table
+        write(directory, table.generation, table.entries())
+    st_logger.info("Song table of generation %d compacted", table.generation)
+    return load(index_dir)
+
+def load(index_dir=None):
+    """ Memory-map the song table saved in index_dir
+
+    Parameter:
+        + index_dir (str): the folder holding the index
+
+    Return:
+        + SongTable, or None if there is no usable song table
+    """
+    directory = song_dir(index_dir)
+    try:
+        with open(os.path.join(directory, 'meta.json')) as fh:
+            meta = json.load(fh)
+        if meta.get('format') != SONG_FORMAT:
+            return None
+        parts = [{name: np.load(os.path.join(directory, segment, name + '.npy'),
+                                mmap_mode='r')
+                  for name in NAMES}
+                 for segment in [meta['segment']] + meta['added']]
+        tombstones = None
+        if meta['tombstones'] is not None:
+            tombstones = np.load(os.path.join(directory, meta['tombstones']))
+    except (OSError, ValueError, KeyError):
+        return None
+    if len(parts[0]['song_id']) != meta['num_songs']:
+        return None
+    return SongTable(directory, meta, parts, tombstones)
+
+def ensure(index_dir=None, generation=None):
+    """ Load the song table, updating it from catalog_changes (or rebuilding
+    it) if it is missing or older than the catalog, and compacting it once
+    the changes have grown large
+
+    Parameters:
+        + index_dir (str): the folder holding the index
+        + generation (int): the current catalog generation, read from the
+        database when not given
+
+    Return:
+        + A SongTable that matches the current catalog
+    """
+    table = load(index_dir)
+    if generation is None:
+        generation = ist.catalog_generation()
+    if table is not None and table.generation == generation:
+        return table
+    if table is not None:
+        table = update(index_dir)
+        if table is not None:
+            if needs_compaction(table):
+                table = compact(index_dir)
+            return table
+    st_logger.info("Song table is missing or stale, rebuilding it")
+    return build(index_dir)
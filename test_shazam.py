@@ -2,13 +2,15 @@
 ## pytest -v test_shazam.py
 ## All test functions must start with test_.
 
+import io
 import os
 import pytest
-import psycopg2
-import credentials as c
+import numpy as np
+import database as db
 import conversion_and_read as cr 
 import search_match as sm
 import dbmanagement as dbm
+import index_store as ist
 
 def test_conversion():
     """ Here we will test if a song can be converted into .wav format
@@ -31,38 +33,32 @@ def test_fingerprints():
 def test_add():
     """Here we will test if a song is successfully added in the database"""
 
-    conn = psycopg2.connect(host="sculptor.stat.cmu.edu", database=c.DB_USER,
-                            user=c.DB_USER, password=c.DB_PASSWORD)
-    cur = conn.cursor()
-    cur.execute(""" SELECT COUNT(*) FROM songs WHERE song_title = SHERlocked
-                artist_name = unknown""")
-    count = cur.fetchone()[0]
+    with db.cursor() as cur:
+        cur.execute(""" SELECT COUNT(*) FROM songs WHERE song_title = SHERlocked
+                    artist_name = unknown""")
+        count = cur.fetchone()[0]
     assert count != 0
 
 def test_duplicates():
     """Here we will test if remove_duplicates function work in the database """
 
-    conn = psycopg2.connect(host="sculptor.stat.cmu.edu", database=c.DB_USER,
-                            user=c.DB_USER, password=c.DB_PASSWORD)
-    cur = conn.cursor()
-    cur.execute(""" SELECT COUNT(CONCAT(song_title, ' ', artist_name)) 
-                    FROM songs """)
-    count1 = cur.fetchone()[0]
-    cur.execute(""" SELECT COUNT(DISTINCT CONCAT(song_title, ' ', artist_name))
-                    FROM songs """)
-    count2 = cur.fetchone()[0]
+    with db.cursor() as cur:
+        cur.execute(""" SELECT COUNT(CONCAT(song_title, ' ', artist_name)) 
+                        FROM songs """)
+        count1 = cur.fetchone()[0]
+        cur.execute(""" SELECT COUNT(DISTINCT CONCAT(song_title, ' ', artist_name))
+                        FROM songs """)
+        count2 = cur.fetchone()[0]
     assert count1-count2 == 0
 
 def test_delete():
     "Here we will test on the deletion of a song"
     dbm.delete('The Game Is On','David Arnold & Michael Price')
-    conn = psycopg2.connect(host="sculptor.stat.cmu.edu", database=c.DB_USER,
-                            user=c.DB_USER, password=c.DB_PASSWORD)
-    cur = conn.cursor()
-    cur.execute(""" SELECT COUNT(CONCAT(song_title = 'The Game Is On', ' ', 
-                                        artist_name = 'David Arnold & Michael Price')) 
-                    FROM song """)
-    count = cur.fetchone()[0]
+    with db.cursor() as cur:
+        cur.execute(""" SELECT COUNT(CONCAT(song_title = 'The Game Is On', ' ', 
+                                            artist_name = 'David Arnold & Michael Price')) 
+                        FROM song """)
+        count = cur.fetchone()[0]
     assert count == 0
     
 def test_search_1():
@@ -79,3 +75,520 @@ def test_lsh_search():
     s,a,f1,f2,t = cr.single_analyzer("The Game Is On.mp3","hanning",10,1,8)
     centroid,query_obj = sm.setup()
     assert 'The Game Is On' in sm.lsh_search(query_obj,centroid,f2)
+
+def test_index_artifact(tmp_path):
+    "Here we will test that the saved index is loaded back with its row map"
+    fingerprint2 = np.random.rand(50, 8)
+    song_id = np.repeat([1, 2], 25)
+    window_center = np.tile(np.arange(5, 30), 2)
+    fingerprint1 = np.random.rand(50)
+    ist.write(str(tmp_path), 7, song_id, window_center, fingerprint1, fingerprint2)
+    artifact = ist.load(str(tmp_path))
+    assert artifact.generation == 7
+    assert artifact.fingerprint2.shape == (50, 8)
+    assert np.allclose(artifact.fingerprint2 + artifact.centroid, fingerprint2, atol=1e-6)
+    assert artifact.song_id[30] == 2 and artifact.window_center[30] == 10
+    assert list(artifact.song_ids) == [1, 2]
+
+def test_rough_counts(tmp_path):
+    "Here we will test the vectorized rough search against a plain scan"
+    fingerprint1 = np.random.rand(60).astype(np.float32)
+    song_id = np.repeat([3, 5, 9], 20)
+    ist.write(str(tmp_path), 1, song_id, np.tile(np.arange(20), 3), fingerprint1,
+              np.random.rand(60, 8))
+    artifact = ist.load(str(tmp_path))
+    matching_cnt, window_num = sm.rough_counts(artifact, fingerprint1[25], 0.05)
+    expected = [np.sum(abs(fingerprint1[song_id == i] - fingerprint1[25]) <= 0.05)
+                for i in (3, 5, 9)]
+    assert list(matching_cnt) == expected
+    assert list(window_num) == [20, 20, 20]
+
+def test_packed_fingerprints():
+    "Here we will test that the packed fingerprints of a song read back unchanged"
+    fingerprint1 = np.array([0.5, 0.25])
+    fingerprint2 = np.array([[0.5, 1.0], [0.0, 0.75]])
+    row = dbm._fingerprint_row(3, fingerprint1, fingerprint2, np.array([5.0, 6.0]),
+                               db.array_digest(fingerprint2))
+    assert row[:3] == (3, 2, 2)
+    assert np.array_equal(db.unpack_array(row[3].adapted), [5.0, 6.0])
+    assert np.array_equal(db.unpack_array(row[4].adapted), fingerprint1)
+    assert np.array_equal(db.unpack_array(row[5].adapted, row[2]), fingerprint2)
+    assert row[6] == db.array_digest(fingerprint2)
+
+def test_knn_predict(tmp_path):
+    "Here we will test the prebuilt KD-tree against a KNN classifier fit"
+    from sklearn.neighbors import KNeighborsClassifier
+    fingerprint2 = np.random.rand(90, 8).astype(np.float32)
+    song_id = np.repeat([1, 4, 6], 30)
+    ist.write(str(tmp_path), 1, song_id, np.tile(np.arange(30), 3),
+              np.random.rand(90), fingerprint2)
+    artifact = ist.load(str(tmp_path))
+    knn = KNeighborsClassifier(n_neighbors=3, metric='euclidean')
+    knn.fit(fingerprint2, song_id)
+    for query in np.random.rand(10, 8):
+        assert sm.knn_predict(artifact, query, 3) == knn.predict(query.reshape(1,-1))[0]
+    assert os.path.exists(os.path.join(str(tmp_path), 'gen-1', 'kdtree.pkl'))
+
+def test_knn_empty_index(tmp_path):
+    "Here we will test that an empty index gives no neighbours instead of an error"
+    ist.write(str(tmp_path), 1, np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0),
+              np.zeros((0, 8)))
+    artifact = ist.load(str(tmp_path))
+    distance, nearest = sm.knn_neighbors(artifact, np.random.rand(8), 3)
+    assert len(distance) == 0 and len(nearest) == 0
+    assert sm.knn_predict(artifact, np.random.rand(8), 3) is None
+    assert sm.knn_predict_batch(artifact, list(np.random.rand(2, 8)), 3) == [None, None]
+    # only a delta segment, and k=0
+    ist.write_delta(artifact, 2, np.repeat(4, 10), np.arange(10), np.random.rand(10),
+                    np.random.rand(10, 8), [])
+    artifact = ist.load(str(tmp_path))
+    assert list(artifact.song_ids) == [4]
+    assert sm.knn_predict(artifact, np.random.rand(8), 3) == 4
+    assert len(sm.knn_neighbors(artifact, np.random.rand(8), 0)[1]) == 0
+
+def test_vote():
+    "Here we will test that hits agreeing on one offset win the vote"
+    # song 2 is hit by windows 0, 1, 2 at a constant offset of 40 seconds,
+    # song 1 by windows 0 and 1 at different offsets
+    song_ids = np.array([2, 1, 2, 1, 2])
+    window_centers = np.array([45, 12, 46, 30, 47])
+    snip_centers = np.array([5, 5, 6, 6, 7])
+    voted = sm.vote(song_ids, window_centers, snip_centers, 3)
+    assert voted[0] == (2, 40, 3, 1.0)
+    assert voted[1][0] == 1 and voted[1][2] == 1
+
+def test_stream_spectrogram():
+    "Here we will test that the streaming spectrogram equals the full one"
+    from scipy import signal
+    samples = np.random.randn(1000*37)
+    f, t, spec = signal.spectrogram(samples, fs=1000, window='hann',
+                                    nperseg=10*1000, noverlap=9*1000)
+    blocks = (samples[i:i+3000] for i in range(0, len(samples), 3000))
+    parts = list(cr.stream_spectrogram(blocks, 1000, 'hann', 10, 1, windows_per_block=4))
+    assert np.allclose(np.concatenate([part[0] for part in parts], axis=1), spec)
+    assert np.allclose(np.concatenate([part[2] for part in parts]), t)
+
+def test_fingerprints_2():
+    "Here we will test fingerprint2 against the band by band definition"
+    f = np.linspace(0, 22050, 2049)
+    spec = np.random.rand(2049, 12)
+    spec[300:310, 4] = 10  # ties resolve to the first peak
+    fingerprints = cr.fingerprints_2(spec, 4, f)
+    start_pt = 2048//2**5
+    for i in range(4):
+        start, end = (2**i)*start_pt, (2**(i+1))*start_pt
+        band = cr.fingerprints_1(spec[start:end], f[start:end])
+        assert np.allclose(fingerprints[:, i], band)
+
+def test_downsampled_analysis():
+    "Here we will test the spectrogram of the downsampled analysis"
+    assert cr.fft_size(80000) == 80000
+    assert cr.fft_size(110250) >= 110250
+    tone = np.sin(2*np.pi*1000*np.arange(8000*20)/8000)
+    spec, f, t = cr.win_spectrogram(tone, 'hann', 10, 1, 8000, cr.fft_size(80000))
+    assert spec.shape[1] == 11
+    assert np.allclose(cr.fingerprints_1(spec, f), 1000/4000)
+
+def test_fingerprint_cache(tmp_path):
+    "Here we will test the fingerprint cache and its eviction"
+    import fingerprint_cache as fc
+    cache_dir = str(tmp_path)
+    arrays = (np.random.rand(20), np.random.rand(20, 8), np.arange(5, 25))
+    key = fc.cache_key('digest', 'hanning', 10, 1, 8)
+    assert key != fc.cache_key('digest', 'hanning', 10, 1, 8, 8000)
+    assert fc.get(key, cache_dir) is None
+    fc.put(key, arrays, cache_dir)
+    cached = fc.get(key, cache_dir)
+    assert len(cached) == 3 and np.array_equal(cached[1], arrays[1])
+    assert fc.evict(0, cache_dir) == 1
+    assert fc.get(key, cache_dir) is None
+
+def test_cached_analyzer(tmp_path, monkeypatch):
+    "Here we will test that a cached analysis is named after the file read"
+    import fingerprint_cache as fc
+    calls = []
+    def analyzer(file_path, *args, **kwargs):
+        calls.append(file_path)
+        return cr.song_name(file_path) + (np.zeros(3), np.ones((3, 8)), np.arange(3))
+    monkeypatch.setattr(cr, 'single_analyzer', analyzer)
+    for name in ('first.wav', 'copy.wav'):
+        (tmp_path / name).write_bytes(b'same audio')
+    cache_dir = str(tmp_path / 'cache')
+    song = fc.cached_analyzer(str(tmp_path / 'first.wav'), 'hann', 10, 1, 8,
+                              cache_dir=cache_dir)
+    assert song[:2] == ('first', 'unknown')
+    song = fc.cached_analyzer(str(tmp_path / 'copy.wav'), 'hann', 10, 1, 8,
+                              cache_dir=cache_dir)
+    assert song[:2] == ('copy', 'unknown') and np.array_equal(song[3], np.ones((3, 8)))
+    assert calls == [str(tmp_path / 'first.wav')]
+
+def test_array_digest():
+    "Here we will test that the audio digest matches the stored blob"
+    fingerprint2 = np.random.rand(10, 8)
+    import hashlib
+    blob = bytes(db.pack_array(fingerprint2).adapted)
+    assert db.array_digest(fingerprint2) == hashlib.sha256(blob).hexdigest()
+    assert db.array_digest(fingerprint2) != db.array_digest(fingerprint2[1:])
+
+def test_delta_segments(tmp_path):
+    "Here we will test searches over delta segments and tombstones, and compaction"
+    fingerprint2 = np.random.rand(60, 8)
+    fingerprint1 = np.random.rand(60).astype(np.float32)
+    song_id = np.repeat([1, 2, 3], 20)
+    window_center = np.tile(np.arange(20), 3)
+    ist.write(str(tmp_path), 1, song_id, window_center, fingerprint1, fingerprint2)
+    # song 4 is added and song 2 deleted at generation 2
+    added2 = np.random.rand(10, 8)
+    added1 = np.random.rand(10).astype(np.float32)
+    ist.write_delta(ist.load(str(tmp_path)), 2, np.repeat(4, 10), np.arange(10),
+                    added1, added2, [2])
+    artifact = ist.load(str(tmp_path))
+    assert artifact.generation == 2 and list(artifact.song_ids) == [1, 2, 3, 4]
+    matching_cnt, window_num = sm.rough_counts(artifact, added1[3], 0)
+    assert matching_cnt[3] >= 1 and list(window_num) == [20, 20, 20, 10]
+    assert sm.rough_counts(artifact, fingerprint1[25], 0)[0][1] == 0
+    assert sm.knn_predict(artifact, added2[3], 1) == 4
+    assert sm.knn_predict(artifact, fingerprint2[25], 1) != 2
+
+    artifact = ist.compact(str(tmp_path))
+    assert artifact.meta['deltas'] == [] and len(artifact.tombstones) == 0
+    assert list(artifact.song_ids) == [1, 3, 4]
+    assert np.allclose(artifact.fingerprint2[40:] + artifact.centroid, added2, atol=1e-6)
+    assert sorted(os.listdir(str(tmp_path))) == ['.lock', 'gen-2', 'meta.json']
+
+def test_delta_keeps_lsh_table(tmp_path, monkeypatch):
+    "Here we will test that a delta update reuses the LSH table of the base"
+    import falconn
+    setups = []
+    setup = falconn.LSHIndex.setup
+    monkeypatch.setattr(falconn.LSHIndex, 'setup',
+                        lambda table, data: setups.append(len(data)) or setup(table, data))
+    fingerprint2 = np.random.rand(60, 8)
+    ist.write(str(tmp_path), 1, np.repeat([1, 2, 3], 20), np.tile(np.arange(20), 3),
+              np.random.rand(60), fingerprint2)
+    artifact = ist.ensure(str(tmp_path), 1)
+    query_obj = sm.lsh_table(artifact).construct_query_object()
+    assert setups == [60]
+    # song 4 added and song 2 deleted: only a delta and a tombstone
+    ist.write_delta(artifact, 2, np.repeat(4, 10), np.arange(10), np.random.rand(10),
+                    fingerprint2[:10] + 3, [2])
+    updated = ist.ensure(str(tmp_path), 2, previous=artifact)
+    assert updated.generation == 2 and sm.lsh_table(updated) is artifact.lsh_tbl
+    assert setups == [60]
+    voted = sm.lsh_vote(query_obj, updated.centroid, fingerprint2[:5] + 3, artifact=updated)
+    assert voted[0][0] == 4
+    # compaction writes a new base, hashed again
+    ist.compact(str(tmp_path))
+    compacted = ist.ensure(str(tmp_path), 2, previous=updated)
+    assert compacted.meta['segment'] != updated.meta['segment']
+    assert sm.lsh_table(compacted) is not artifact.lsh_tbl and setups == [60, 50]
+
+def test_batched_search(tmp_path):
+    "Here we will test that snippets searched together get their own results"
+    fingerprint2 = np.random.rand(60, 8)
+    fingerprint1 = np.random.rand(60).astype(np.float32)
+    song_id = np.repeat([1, 2, 3], 20)
+    ist.write(str(tmp_path), 1, song_id, np.tile(np.arange(20), 3), fingerprint1,
+              fingerprint2)
+    ist.write_delta(ist.load(str(tmp_path)), 2, np.repeat(4, 10), np.arange(10),
+                    np.random.rand(10).astype(np.float32), np.random.rand(10, 8), [2])
+    artifact = ist.load(str(tmp_path))
+    snippets = [fingerprint2[3:8], fingerprint2[45:47], fingerprint2[50:51]]
+    query_obj = sm.lsh_table(artifact).construct_query_object()
+    assert (sm.lsh_vote_batch(query_obj, artifact.centroid, snippets, artifact=artifact) ==
+            [sm.lsh_vote(query_obj, artifact.centroid, snippet, artifact=artifact)
+             for snippet in snippets])
+    queries = list(np.random.rand(4, 8))
+    assert (sm.knn_predict_batch(artifact, queries, 3) ==
+            [sm.knn_predict(artifact, query, 3) for query in queries])
+    windows = [fingerprint1[0:5], fingerprint1[41:43], fingerprint1[55:56]]
+    matching_cnt, window_num = sm.rough_counts_batch(artifact, windows, 1e-3)
+    for i, fgp1 in enumerate(windows):
+        alone = sm.rough_counts(artifact, fgp1, 1e-3)
+        assert list(matching_cnt[i]) == list(alone[0]) and matching_cnt[i].sum() >= len(fgp1)
+        assert list(window_num[i]) == list(alone[1])
+    assert len(sm.rough_match_ids_batch(artifact, windows)) == 3
+
+def test_shard_coordinator(tmp_path):
+    "Here we will test that shard processes answer like a single index"
+    import shards
+    fingerprint2 = np.random.rand(120, 8)
+    fingerprint1 = np.random.rand(120)
+    song_id = np.repeat(np.arange(1, 7), 20)
+    window_center = np.tile(np.arange(20), 6)
+    ist.write(str(tmp_path / 'full'), 1, song_id, window_center, fingerprint1,
+              fingerprint2)
+    for i in range(2):
+        part = song_id % 2 == i
+        ist.write(ist.shard_dir(str(tmp_path), (i, 2)), 1, song_id[part],
+                  window_center[part], fingerprint1[part], fingerprint2[part],
+                  shard=(i, 2))
+    full = ist.load(str(tmp_path / 'full'))
+    with shards.ShardCoordinator(2, str(tmp_path), refresh=False) as coordinator:
+        assert coordinator.generation == 1
+        for query in np.random.rand(10, 8):
+            assert coordinator.knn_predict(query, 3) == sm.knn_predict(full, query, 3)
+        queries = list(np.random.rand(5, 8))
+        assert (coordinator.knn_predict_batch(queries, 3) ==
+                [sm.knn_predict(full, query, 3) for query in queries])
+        # song 8 joins shard 0 at generation 2
+        ist.write(ist.shard_dir(str(tmp_path), (0, 2)), 2,
+                  np.concatenate((song_id[song_id % 2 == 0], np.repeat(8, 20))),
+                  np.tile(np.arange(20), 4), np.random.rand(80),
+                  np.concatenate((fingerprint2[song_id % 2 == 0], fingerprint2[:20] + 5)),
+                  shard=(0, 2))
+        ist.write(ist.shard_dir(str(tmp_path), (1, 2)), 2, song_id[song_id % 2 == 1],
+                  window_center[song_id % 2 == 1], fingerprint1[song_id % 2 == 1],
+                  fingerprint2[song_id % 2 == 1], shard=(1, 2))
+        assert coordinator.refresh(2) == 2 and coordinator.generation == 2
+        assert coordinator.knn_predict(fingerprint2[3] + 5, 3) == 8
+
+def test_server_refresh(monkeypatch):
+    "Here we will test that the server reloads its index when the catalog changes"
+    import server
+    generation, loads = [1], []
+    def searchers(index_dir, subvectors):
+        loads.append(generation[0])
+        return {'generation': generation[0], 'pq': None, 'centroid': None,
+                'query_pool': 'pool%d' % generation[0],
+                'artifact': 'artifact%d' % generation[0]}
+    monkeypatch.setattr(server, '_searchers', searchers)
+    monkeypatch.setattr(ist, 'catalog_generation', lambda: generation[0])
+    monkeypatch.setattr(sm, 'load_index', lambda *args, **kwargs: None)
+    monkeypatch.setattr(sm, 'load_songs', lambda *args: None)
+    monkeypatch.setattr(ist, 'GENERATION_TTL', 0)
+    state = server.warm_state()
+    assert server.refresh(state)['generation'] == 1 and loads == [1]
+    generation[0] = 3
+    assert server.refresh(state)['generation'] == 3 and loads == [1, 3]
+    assert state['generation'] == 3 and not state['reloading']
+    monkeypatch.setattr(ist, 'GENERATION_TTL', 60)
+    generation[0] = 4
+    assert server.refresh(state)['generation'] == 3 and loads == [1, 3]
+    # the hits are resolved with the artifact of the pool searched
+    monkeypatch.setattr(sm, 'lsh_vote', lambda query_pool, *args, artifact=None:
+                        (query_pool, artifact))
+    assert server.vote(state, None, None) == ('pool3', 'artifact3')
+
+def test_snippet_paths(tmp_path):
+    "Here we will test the snippets of a batch from a folder or a manifest"
+    import identify_batch as ib
+    for name in ('b.wav', 'a.mp3'):
+        (tmp_path / name).write_bytes(b'')
+    assert ib.snippet_paths(str(tmp_path)) == [str(tmp_path / 'a.mp3'),
+                                               str(tmp_path / 'b.wav')]
+    manifest = tmp_path / 'manifest.txt'
+    manifest.write_text("# clips\nb.wav\n\n/music/c.mp3\n")
+    assert ib.snippet_paths(str(manifest)) == [str(tmp_path / 'b.wav'), '/music/c.mp3']
+
+def test_metrics():
+    "Here we will test the stage timers and the merge of worker metrics"
+    import metrics
+    metrics.reset()
+    with metrics.timer('spectrogram'):
+        pass
+    metrics.inc('freezam_lsh_candidates_total', 5)
+    recorded = metrics.drain()
+    assert metrics.snapshot() == {'counters': {}, 'histograms': {}}
+    metrics.merge(recorded)
+    metrics.merge(recorded)
+    text = metrics.prometheus_text()
+    assert 'freezam_lsh_candidates_total 10' in text
+    assert 'freezam_stage_seconds_count{stage="spectrogram"} 2' in text
+    metrics.reset()
+
+def test_constellation(tmp_path):
+    "Here we will test that a snippet cut off the window grid is found by its hashes"
+    import hash_index as hi
+    rate = 8000
+    rng = np.random.RandomState(0)
+    songs = {}
+    for song_id in (1, 2, 3):
+        notes = [np.sin(2*np.pi*rng.uniform(100, 3000)*np.arange(rate//2)/rate)
+                 for _ in range(80)]
+        songs[song_id] = np.concatenate(notes) + 0.05*rng.randn(40*rate)
+    hashed = {song_id: cr.peak_hashes(*cr.spectral_peaks(samples, rate))
+              for song_id, samples in songs.items()}
+    hi.write(hi.hash_dir(str(tmp_path)), (1, 3),
+             np.concatenate([h for h, _ in hashed.values()]),
+             np.repeat(list(hashed), [len(h) for h, _ in hashed.values()]),
+             np.concatenate([o for _, o in hashed.values()]))
+    index = hi.load(str(tmp_path))
+    begin = int(12.34*rate)
+    snippet = songs[2][begin:begin + 8*rate] + 0.3*rng.randn(8*rate)
+    voted = hi.lookup(index, *cr.peak_hashes(*cr.spectral_peaks(snippet, rate)))
+    assert voted[0][0] == 2
+    assert abs(voted[0][1]*cr.PEAK_HOP - 12.34) <= 2*cr.PEAK_HOP
+
+def test_pq_index(tmp_path):
+    "Here we will test the search over fingerprint2 compressed by product quantization"
+    import pq_index as pqi
+    fingerprint2 = np.random.rand(600, 8)
+    song_id = np.repeat([1, 2, 3], 200)
+    window_center = np.tile(np.arange(200), 3)
+    ist.write(str(tmp_path), 1, song_id, window_center, np.random.rand(600), fingerprint2)
+    artifact = ist.load(str(tmp_path))
+    pq = pqi.ensure(artifact, 4)
+    assert pq.codes.shape == (600, 4) and pq.codes.dtype == np.uint8
+    assert pqi.ensure(artifact, 4).meta == pq.meta
+    snippet = fingerprint2[250:260] + 0.001*np.random.randn(10, 8)
+    for rerank in (True, False):
+        voted = sm.pq_vote(artifact, pq, snippet, rerank=rerank)
+        assert voted[0][:2] == (2, 50)
+    assert pqi.ensure(artifact, 8).codes.shape == (600, 8)
+
+def test_title_batcher():
+    "Here we will test that concurrent requests read their titles with one query"
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    import async_server as aserv
+    queries = []
+
+    def fetch(song_ids):
+        queries.append(song_ids)
+        return {sid: 'title%d' % sid for sid in song_ids}
+
+    async def run():
+        batcher = aserv.TitleBatcher(ThreadPoolExecutor(1), fetch)
+        return await asyncio.gather(batcher.titles([3, 1]), batcher.titles([2]),
+                                    batcher.titles([]))
+
+    first, second, empty = asyncio.run(run())
+    assert queries == [[1, 2, 3]]
+    assert first[3] == 'title3' and second[2] == 'title2' and empty == {}
+
+def test_stream_hashes():
+    "Here we will test that the hashes of a stream read in pieces are the ones of the whole"
+    rate = 8000
+    rng = np.random.RandomState(1)
+    notes = [np.sin(2*np.pi*rng.uniform(100, 3000)*np.arange(rate//3)/rate)
+             for _ in range(40)]
+    samples = np.concatenate(notes) + 0.05*rng.randn(40*(rate//3))
+    pcm = io.BytesIO((samples*10000).astype('<i2').tobytes())
+    blocks = list(cr.pcm_blocks(pcm, 0.37, rate))
+    assert np.allclose(np.concatenate(blocks), (samples*10000).astype('<i2')/2)
+    freq_bin, frame = cr.spectral_peaks(np.concatenate(blocks), rate)
+    streamed = list(cr.stream_peaks(iter(blocks), rate))
+    assert len(streamed) > 1
+    assert np.array_equal(np.concatenate([peaks[0] for peaks in streamed]), freq_bin)
+    assert np.array_equal(np.concatenate([peaks[1] for peaks in streamed]), frame)
+    hashes = list(cr.stream_hashes(iter(blocks), rate))
+    assert (sorted(zip(*cr.peak_hashes(freq_bin, frame))) ==
+            sorted(zip(np.concatenate([h for h, _ in hashes]),
+                       np.concatenate([o for _, o in hashes]))))
+    found = []
+    passed = list(cr.hashed_blocks(iter(blocks), rate, found))
+    assert np.array_equal(np.concatenate(passed), np.concatenate(blocks))
+    assert np.array_equal(cr.join_hashes(found)[0], cr.join_hashes(hashes)[0])
+
+def test_hashes_memory():
+    "Here we will test that a long song is fingerprinted and hashed in bounded memory"
+    import tracemalloc
+    rate = 8000
+    rng = np.random.RandomState(2)
+
+    def blocks():
+        for _ in range(225):  # 30 minutes, 115 MB of samples
+            yield np.concatenate([np.sin(2*np.pi*rng.uniform(100, 3000)*
+                                         np.arange(rate//2)/rate)
+                                  for _ in range(16)]) + 0.05*rng.randn(8*rate)
+
+    found = []
+    tracemalloc.start()
+    for _ in cr.stream_spectrogram(cr.hashed_blocks(blocks(), rate, found), rate,
+                                   'hann', 10, 1):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    hashes, offsets = cr.join_hashes(found)
+    assert offsets.max() > 29*60/cr.PEAK_HOP
+    assert peak < 50*1024**2
+
+def test_generation_cache(monkeypatch):
+    "Here we will test that the catalog generation is not read on every query"
+    from types import SimpleNamespace
+    reads, generation = [], [1]
+    def catalog_generation():
+        reads.append(generation[0])
+        return generation[0]
+    monkeypatch.setattr(ist, 'catalog_generation', catalog_generation)
+    monkeypatch.setattr(ist, 'ensure', lambda index_dir, generation, previous=None:
+                        SimpleNamespace(generation=generation, index_dir='idx'))
+    monkeypatch.setattr(sm, 'load_songs', lambda *args: None)
+    monkeypatch.setattr(sm, '_index', None)
+    monkeypatch.setattr(ist, 'GENERATION_TTL', 60)
+    index = sm.load_index()
+    assert sm.load_index() is index and sm.load_index() is index
+    assert reads == [1]
+    generation[0] = 2
+    assert sm.load_index() is index
+    assert sm.load_index(recheck=True).generation == 2 and reads == [1, 2]
+    monkeypatch.setattr(ist, 'GENERATION_TTL', 0)
+    sm.load_index()
+    assert reads == [1, 2, 2]
+
+def test_song_table(tmp_path, monkeypatch):
+    "Here we will test that the titles of the results are read from the song table"
+    import song_table as st
+    directory = st.song_dir(str(tmp_path))
+    os.makedirs(directory)
+    st.write(directory, 3, {5: ('Sólo', 'Ana'), 2: ('Bird', None), 9: (None, 'Nobody')})
+    table = st.load(str(tmp_path))
+    assert len(table) == 3 and table.generation == 3
+    assert table.titles([9, 2, 7, 5, 2]) == {2: 'Bird', 5: 'Sólo', 9: None}
+    assert table.artists([2, 5]) == {2: None, 5: 'Ana'}
+    monkeypatch.setattr(sm, '_songs', table)
+    assert sm.retriv_titles(np.array([5, 2])) == {2: 'Bird', 5: 'Sólo'}
+    assert sm.retriv_name(5) == 'Sólo'
+    base = os.path.join(directory, 'gen-3', 'title_blob.npy')
+    written = os.stat(base).st_mtime_ns
+    st.write_added(table, 4, {11: ('Late', 'Ana')}, [2, 7])
+    table = st.load(str(tmp_path))
+    assert os.stat(base).st_mtime_ns == written
+    assert table.generation == 4 and list(table.song_id) == [5, 9, 11]
+    assert table.titles([2, 5, 11]) == {5: 'Sólo', 11: 'Late'}
+    st.write_added(table, 5, {}, [11])
+    assert st.load(str(tmp_path)).entries() == {5: ('Sólo', 'Ana'), 9: (None, 'Nobody')}
+    assert st.needs_compaction(st.load(str(tmp_path)))
+    table = st.compact(str(tmp_path))
+    assert table.meta['added'] == [] and len(table.tombstones) == 0
+    assert table.entries() == {5: ('Sólo', 'Ana'), 9: (None, 'Nobody')}
+    assert sorted(os.listdir(directory)) == ['.lock', 'gen-5', 'meta.json']
+    st.write(directory, 6, {})
+    assert st.load(str(tmp_path)).titles([5]) == {}
+
+def _analyze_or_fail(file_path, *args):
+    "An analyzer for push_all that fails on the files named bad"
+    name = os.path.basename(file_path)
+    if name.startswith('bad'):
+        raise ValueError("cannot decode " + name)
+    if name.startswith('dead'):
+        os._exit(1)  # a worker killed in the middle of a file
+    return name, 'artist', np.zeros(3), np.zeros((3, 8)), np.arange(3), None
+
+def test_push_all_failures(tmp_path, monkeypatch):
+    "Here we will test that push_all survives files and workers that fail"
+    import threading
+    from concurrent.futures.process import BrokenProcessPool
+    written = []
+    monkeypatch.setattr(dbm, '_analyze_file', _analyze_or_fail)
+    monkeypatch.setattr(dbm, 'add_batch', lambda songs: written.extend(songs) or
+                        list(range(len(songs))))
+    for name in ('a.mp3', 'bad.mp3', 'c.mp3'):
+        (tmp_path / name).write_bytes(b'')
+    dbm.push_all(str(tmp_path), 10, 1, 'hanning', 8, workers=2, use_cache=False)
+    assert sorted(song[0] for song in written) == ['a.mp3', 'c.mp3']
+    (tmp_path / 'dead.mp3').write_bytes(b'')
+    with pytest.raises(BrokenProcessPool):
+        dbm.push_all(str(tmp_path), 10, 1, 'hanning', 8, workers=1, use_cache=False)
+    assert 'freezam-writer' not in [thread.name for thread in threading.enumerate()]
+
+def test_light_imports():
+    "Here we will test that delete and rm_duplicate start without numpy, scipy or pydub"
+    import sys
+    import subprocess
+    statement = ("import sys, dbmanagement; print([name for name in "
+                 "('numpy', 'scipy', 'pydub') if name in sys.modules])")
+    result = subprocess.run([sys.executable, '-c', statement], capture_output=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.stdout.strip() == b'[]'